@@ -1,28 +1,75 @@
 __version__ = '0.4.3'
 
-from . import config
-from . import features
-from . import loops
-from . import checkpoint
-from . import modules
-from . import extract
-from . import io_spec
-from . import models
-from . import networks
-from . import demos
-from . import ui
-from . import views
-
-from .checkpoint import *
-from .config import *
-from .features import *
-from .loops import *
-from .modules import *
-from .extract import *
-from .models import *
-from .networks import *
-from .ui import *
-from .utils import *
-from .views import *
-from .io_spec import *
-from .demos import *
\ No newline at end of file
+# subpackages are imported when one of their names is first accessed (e.g. `mmk.TrainARMLoop` imports `loops`)
+# so that `import mimikit` doesn't pull in the training and notebook stacks.
+# Names resolve as if the modules were star-imported in this order (the last one wins):
+_STAR_IMPORTS = (
+    "checkpoint",
+    "model_pool",
+    "config",
+    "features",
+    "loops",
+    "modules",
+    "extract",
+    "models",
+    "networks",
+    "ui",
+    "utils",
+    "views",
+    "io_spec",
+    "demos",
+    "runtime",
+    "export",
+    "quantization",
+)
+_SUBMODULES = (
+    "config",
+    "features",
+    "loops",
+    "checkpoint",
+    "model_pool",
+    "modules",
+    "extract",
+    "io_spec",
+    "models",
+    "networks",
+    "demos",
+    "ui",
+    "views",
+    "utils",
+    "runtime",
+    "export",
+    "quantization",
+)
+_INDEX = None
+
+
+def _index():
+    global _INDEX
+    if _INDEX is None:
+        from ._exports import star_exports
+
+        index = {}
+        for module in _STAR_IMPORTS:
+            index.update(dict.fromkeys(star_exports(f"{__name__}.{module}"), module))
+        _INDEX = index
+    return _INDEX
+
+
+def __getattr__(name):
+    import importlib
+
+    if name in _SUBMODULES:
+        return importlib.import_module(f".{name}", __name__)
+    if name == "__all__":
+        return [*_index()]
+    module = _index().get(name)
+    if module is None:
+        raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+    value = getattr(importlib.import_module(f".{module}", __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted({*globals(), *_SUBMODULES, *_index()})
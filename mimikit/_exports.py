@@ -0,0 +1,78 @@
+import ast
+import os
+from typing import Dict, Optional, Tuple
+
+__all__ = [
+    "star_exports",
+]
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _source(module: str) -> Optional[str]:
+    path = os.path.join(ROOT, *module.split("."))
+    for candidate in (os.path.join(path, "__init__.py"), path + ".py"):
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def _resolve(module: str, is_package: bool, level: int, name: Optional[str]) -> str:
+    parts = module.split(".")
+    base = parts if is_package else parts[:-1]
+    base = base[:len(base) - (level - 1)] if level > 1 else base
+    return ".".join(base + ([name] if name else []))
+
+
+def _literal_all(tree: ast.Module) -> Optional[list]:
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(getattr(t, "id", None) == "__all__" for t in node.targets):
+            try:
+                return list(ast.literal_eval(node.value))
+            except (ValueError, TypeError):  # e.g. [_ for _ in dir() if not _.startswith("_")]
+                return None
+    return None
+
+
+def star_exports(module: str, _cache: Dict[str, Tuple[str, ...]] = {}) -> Tuple[str, ...]:
+    """
+    the names that `from <module> import *` binds, found by reading the sources of `module`
+    and of the modules it star-imports without importing them.
+    """
+    if module in _cache:
+        return _cache[module]
+    path = _source(module)
+    if path is None:
+        return ()
+    is_package = path.endswith("__init__.py")
+    with open(path, "r") as f:
+        tree = ast.parse(f.read())
+    # the names bound in the module, in order
+    namespace: Dict[str, None] = {}
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            namespace[node.name] = None
+        elif isinstance(node, ast.Assign):
+            for target in node.targets:
+                if isinstance(target, ast.Name):
+                    namespace[target.id] = None
+        elif isinstance(node, ast.AnnAssign) and isinstance(node.target, ast.Name):
+            namespace[node.target.id] = None
+        elif isinstance(node, ast.ImportFrom) and node.level > 0:
+            target = _resolve(module, is_package, node.level, node.module)
+            if is_package and node.module is not None and "." not in node.module and node.level == 1:
+                # importing a submodule binds it in its package
+                namespace[node.module] = None
+            for alias in node.names:
+                if alias.name == "*":
+                    namespace.update(dict.fromkeys(star_exports(target)))
+                else:
+                    namespace[alias.asname or alias.name] = None
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                namespace[(alias.asname or alias.name).split(".")[0]] = None
+    names = _literal_all(tree)
+    if names is None:
+        names = [k for k in namespace if not k.startswith("_")]
+    _cache[module] = exports = tuple(names)
+    return exports
@@ -1,6 +1,11 @@
 import abc
 import dataclasses as dtc
-from typing import Optional
+import functools
+import glob
+import queue
+import threading
+import time
+from typing import Optional, Callable, Dict, Sequence
 from typing_extensions import Protocol
 from omegaconf import OmegaConf, ListConfig, DictConfig
 
@@ -17,13 +22,17 @@ import torch
 import h5mapper as h5m
 import os
 
-from .config import Config, Configurable
+from .config import Config, Configurable, _get_type_object
 from .networks.arm import NetworkConfig
 from .features.dataset import DatasetConfig
 
 __all__ = [
     'Checkpoint',
-    'CheckpointBank'
+    'CheckpointBank',
+    'CheckpointWriter',
+    'to_host',
+    'average_state_dicts',
+    'benchmark_config_loading',
 ]
 
 
@@ -58,23 +67,34 @@ class CheckpointBank(h5m.TypedFile):
              network: ConfigurableModule,
              training_config: Optional[TrainingConfig] = None,
              optimizer: Optional[nn.Module] = None,
-             trainer_state: Optional[dict] = None
+             trainer_state: Optional[dict] = None,
+             network_state: Optional[dict] = None,
+             optimizer_state: Optional[dict] = None,
              ) -> "CheckpointBank":
-
-        net_dict = network.state_dict()
-        opt_dict = optimizer.state_dict() if optimizer is not None else {}
-        cls.network.set_ds_kwargs(net_dict)
+        """
+        write the checkpoint in temporary files renamed once complete.
+        The configs are stored in the h5 file and the weights in a memory-mappable `.pt` file next to it.
+        `network_state` and `optimizer_state` replace the current state dicts if given.
+        """
+        net_dict = network.state_dict() if network_state is None else network_state
+        opt_dict = optimizer.state_dict() if optimizer is not None else optimizer_state
         #if optimizer is not None:
         #    cls.optimizer.set_ds_kwargs(opt_dict)
         os.makedirs(os.path.split(filename)[0], exist_ok=True)
+        tmp = filename + ".tmp"
+
+        weights_path = os.path.splitext(filename)[0] + ".pt"
+        torch.save({k: v.detach().cpu().contiguous() for k, v in net_dict.items()}, weights_path + ".tmp")
+        os.replace(weights_path + ".tmp", weights_path)
 
-        bank = cls(filename, mode="w")
+        bank = cls(tmp, mode="w")
         bank.network.attrs["config"] = network.config.serialize()
-        bank.network.add("state_dict", h5m.TensorDict.format(net_dict))
 
-        if optimizer is not None:
+        if opt_dict is not None:
             #bank.optimizer.add("state_dict", h5m.TensorDict.format(opt_dict))
-            torch.save(opt_dict, os.path.splitext(filename)[0] + ".opt")
+            opt_path = os.path.splitext(filename)[0] + ".opt"
+            torch.save(opt_dict, opt_path + ".tmp")
+            os.replace(opt_path + ".tmp", opt_path)
                         
         if training_config is not None:
             bank.attrs["dataset"] = training_config.dataset.serialize()
@@ -90,9 +110,149 @@ class CheckpointBank(h5m.TypedFile):
         
         bank.flush()
         bank.close()
+        # readers never see a partial file
+        os.replace(tmp, filename)
+        bank.filename = filename
         return bank
 
 
+def to_host(obj, pin_memory: Optional[bool] = None):
+    """
+    copy the tensors in `obj` (a tensor or nested dicts, lists and tuples) to cpu memory,
+    pinned if `pin_memory` (default: with cuda) so that the copies don't block.
+    """
+    if isinstance(obj, torch.Tensor):
+        obj = obj.detach()
+        pin = torch.cuda.is_available() if pin_memory is None else pin_memory
+        out = torch.empty(obj.shape, dtype=obj.dtype, device="cpu", pin_memory=pin and obj.is_cuda)
+        return out.copy_(obj, non_blocking=obj.is_cuda)
+    if isinstance(obj, dict):
+        copied = type(obj)((k, to_host(v, pin_memory)) for k, v in obj.items())
+        if hasattr(obj, "_metadata"):
+            copied._metadata = obj._metadata
+        return copied
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_host(v, pin_memory) for v in obj)
+    return obj
+
+
+class CheckpointWriter:
+    """
+    write checkpoints in a background thread.
+
+    `submit()` copies the states to host memory and returns right away, the files are written
+    in order by the writer thread. Errors of the writer are raised by the next `submit()` or `wait()`.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread: Optional[threading.Thread] = None
+        self.error: Optional[BaseException] = None
+
+    def submit(self,
+               checkpoint: "Checkpoint",
+               network: ConfigurableModule,
+               training_config: Optional[TrainingConfig] = None,
+               optimizer: Optional[torch.optim.Optimizer] = None,
+               trainer_state: Optional[dict] = None,
+               network_state: Optional[dict] = None):
+        self.raise_error()
+        network_state = to_host(network.state_dict() if network_state is None else network_state)
+        optimizer_state = to_host(optimizer.state_dict()) if optimizer is not None else None
+        if torch.cuda.is_available():
+            # the copies are complete before the training goes on
+            torch.cuda.synchronize()
+        self.call(CheckpointBank.save, checkpoint.os_path, network, training_config,
+                  trainer_state=trainer_state, network_state=network_state, optimizer_state=optimizer_state)
+        return checkpoint
+
+    def call(self, func: Callable, *args, **kwargs):
+        """run `func(*args, **kwargs)` in the writer thread after the pending writes"""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._work, daemon=True)
+            self.thread.start()
+        self.queue.put((func, args, kwargs))
+
+    def _work(self):
+        while True:
+            func, args, kwargs = self.queue.get()
+            try:
+                func(*args, **kwargs)
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def wait(self):
+        """block until all the submitted checkpoints are written"""
+        self.queue.join()
+        self.raise_error()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("writing a checkpoint failed") from error
+
+
+@functools.lru_cache(maxsize=64)
+def _open_bank(path: str, mtime: float) -> CheckpointBank:
+    # one read handle per file (and version of the file)
+    return CheckpointBank(path, 'r')
+
+
+def _build_on_meta(cls, cfg: NetworkConfig, state_dict) -> Optional[ConfigurableModule]:
+    """
+    build the network without initializing its weights and use the tensors of `state_dict` as its weights.
+    None if the network can not be built like this (e.g. it computes with its weights or has buffers
+    that are not in its state dict).
+    """
+    try:
+        with torch.device("meta"):
+            net = cls.from_config(cfg)
+        net.load_state_dict(state_dict, strict=True, assign=True)
+    except (RuntimeError, NotImplementedError, TypeError, ValueError):
+        return None
+    if any(t.is_meta for t in (*net.parameters(), *net.buffers())):
+        return None
+    return net
+
+
+def average_state_dicts(state_dicts: Sequence[Dict[str, torch.Tensor]],
+                        weights: Optional[Sequence[float]] = None,
+                        ) -> Dict[str, torch.Tensor]:
+    """
+    weighted average of compatible state dicts (uniform if `weights` is None, which are normalized).
+
+    The average is computed one tensor at a time in float32 so that memory-mapped state dicts
+    are only read tensor by tensor. Non floating point tensors are those of the first state dict.
+    """
+    if weights is None:
+        weights = [1.] * len(state_dicts)
+    if len(weights) != len(state_dicts):
+        raise ValueError(f"got {len(weights)} weights for {len(state_dicts)} state dicts")
+    total = float(sum(weights))
+    if total == 0:
+        raise ValueError("weights sum to 0")
+    weights = [w / total for w in weights]
+    first = state_dicts[0]
+    for i, sd in enumerate(state_dicts[1:], 1):
+        if sd.keys() != first.keys():
+            raise ValueError(f"state dict {i} doesn't have the same keys as the first one: "
+                             f"{sorted(set(sd.keys()) ^ set(first.keys()))}")
+    averaged = {}
+    for k, v in first.items():
+        if any(sd[k].shape != v.shape for sd in state_dicts):
+            raise ValueError(f"tensors '{k}' don't have the same shapes")
+        if not v.is_floating_point():
+            averaged[k] = v.clone()
+            continue
+        acc = torch.zeros(v.shape, dtype=torch.float32)
+        for sd, w in zip(state_dicts, weights):
+            acc.add_(sd[k].to(torch.float32), alpha=w)
+        averaged[k] = acc.to(v.dtype)
+    return averaged
+
+
 @dtc.dataclass
 class Checkpoint:
     id: str
@@ -121,12 +281,27 @@ class Checkpoint:
     def os_path(self):
         return os.path.join(self.root_dir, f"{self.id}/epoch={self.epoch}.ckpt")
 
+    @property
+    def weights_path(self):
+        return os.path.splitext(self.os_path)[0] + ".pt"
+
     def delete(self):
         os.remove(self.os_path)
+        for ext in (".opt", ".pt"):
+            path = os.path.splitext(self.os_path)[0] + ext
+            if os.path.isfile(path):
+                os.remove(path)
+        _open_bank.cache_clear()
 
-    @cached_property
+    @property
     def bank(self) -> CheckpointBank:
-        return CheckpointBank(self.os_path, 'r')
+        return _open_bank(self.os_path, os.path.getmtime(self.os_path))
+
+    def state_dict(self, mmap: bool = True) -> Dict[str, torch.Tensor]:
+        """the weights of the network, memory-mapped if possible (checkpoints saved before `.pt` files are copied)"""
+        if os.path.isfile(self.weights_path):
+            return torch.load(self.weights_path, map_location="cpu", weights_only=True, mmap=mmap)
+        return self.bank.network.get("state_dict")
 
     @cached_property
     def dataset_config(self) -> DatasetConfig:
@@ -138,15 +313,18 @@ class Checkpoint:
 
     @cached_property
     def training_config(self) -> TrainingConfig:
-        bank = CheckpointBank(self.os_path, 'r')
-        return Config.deserialize(bank.attrs["training"])
+        return Config.deserialize(self.bank.attrs["training"])
 
     @cached_property
     def network(self) -> ConfigurableModule:
         cfg: NetworkConfig = self.network_config
         cfg.io_spec.bind_to(self.dataset_config)
         cls = cfg.owner_class
-        state_dict = self.bank.network.get("state_dict")
+        state_dict = self.state_dict()
+        if os.path.isfile(self.weights_path):
+            net = _build_on_meta(cls, cfg, state_dict)
+            if net is not None:
+                return net
         net = cls.from_config(cfg)
         net.load_state_dict(state_dict, strict=True)
         return net
@@ -171,4 +349,72 @@ class Checkpoint:
         if state is not None:
             return OmegaConf.create(state)
         return None
-    # Todo: method to add state_dict mul by weights -> def average(self, *others)
+
+    def average(self, *others: "Checkpoint", weights: Optional[Sequence[float]] = None) -> ConfigurableModule:
+        """
+        a network with the weighted average of the weights of this checkpoint and of `others`
+        (e.g. the last epochs of a training), which must have the same network class and weight shapes.
+        """
+        checkpoints = (self, *others)
+        classes = {ck.network_config.owner_class for ck in checkpoints}
+        if len(classes) > 1:
+            raise ValueError(f"can not average networks of different classes: {classes}")
+        state_dict = average_state_dicts([ck.state_dict() for ck in checkpoints], weights)
+        cfg: NetworkConfig = self.network_config
+        cfg.io_spec.bind_to(self.dataset_config)
+        net = _build_on_meta(cfg.owner_class, cfg, state_dict)
+        if net is None:
+            net = cfg.owner_class.from_config(cfg)
+            net.load_state_dict(state_dict, strict=True)
+        return net
+
+    def quantize(self,
+                 n_batches: int = 8,
+                 batch_size: int = 4,
+                 batch_length: Optional[int] = None,
+                 static_convs: bool = True) -> ConfigurableModule:
+        """
+        the network of this checkpoint with int8 weights for generation on cpu (e.g. by a `GenerateLoopV2`
+        with `device="cpu"`). Its 1x1 convolutions are calibrated on batches of the checkpoint's dataset.
+        See `mimikit.quantization` for comparing it with the float network.
+        """
+        from .quantization import quantization_batches, quantize_network
+
+        net = self.network
+        batches = quantization_batches(net, self.dataset, n_batches, batch_size, batch_length) \
+            if static_convs else []
+        return quantize_network(net, (inputs for inputs, _ in batches), static_convs=static_convs)
+
+
+def benchmark_config_loading(root_dir: str, n_repeats: int = 3) -> Dict[str, float]:
+    """
+    time the deserialization of the configs of all the checkpoints under `root_dir`
+    with `Config.deserialize` and with the OmegaConf structured round-trip it replaces.
+    Returns the seconds per checkpoint of both and the speedup.
+    """
+    raw = []
+    paths = sorted(glob.glob(os.path.join(root_dir, "**", "*.ckpt"), recursive=True))
+    for path in paths:
+        bank = CheckpointBank(path, "r")
+        raw += [(bank.network.attrs["config"], None), (bank.attrs["dataset"], DatasetConfig)]
+        if "training" in bank.attrs:
+            raw += [(bank.attrs["training"], None)]
+        bank.close()
+    if not raw:
+        raise FileNotFoundError(f"no checkpoint found in '{root_dir}'")
+
+    def omegaconf_deserialize(yaml, as_type):
+        cfg = OmegaConf.create(yaml)
+        if as_type is None and hasattr(cfg, "type"):
+            as_type = _get_type_object(cfg.type)
+        return Config.object(cfg, as_type)
+
+    results = {}
+    for name, func in (("omegaconf", omegaconf_deserialize), ("deserialize", Config.deserialize)):
+        start = time.perf_counter()
+        for _ in range(n_repeats):
+            for yaml, as_type in raw:
+                func(yaml, as_type)
+        results[f"{name}_sec_per_checkpoint"] = (time.perf_counter() - start) / n_repeats / len(paths)
+    results["speedup"] = results["omegaconf_sec_per_checkpoint"] / results["deserialize_sec_per_checkpoint"]
+    return results
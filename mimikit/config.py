@@ -2,9 +2,11 @@ import abc
 import sys
 from copy import deepcopy
 from omegaconf import OmegaConf, ListConfig, DictConfig
+from omegaconf._utils import get_yaml_loader
 from typing import List, Tuple, Union, Dict, Any
 import dataclasses as dtc
 from functools import reduce, partial
+import yaml
 
 __all__ = [
     "private_runtime_field",
@@ -17,17 +19,69 @@ def private_runtime_field(default):
     return dtc.field(init=False, repr=False, metadata=dict(omegaconf_ignore=True), default_factory=lambda: default)
 
 
+# resolved types of mimikit's classes (user classes can be redefined, e.g. in notebooks, and aren't cached)
+_TYPES: Dict[str, type] = {}
+
+
 # noinspection PyTypeChecker
 def _get_type_object(type_) -> type:
+    if type_ in _TYPES:
+        return _TYPES[type_]
     if ":" in type_:
         module, qualname = type_.split(":")
     else:
         module, qualname = "mimikit", type_
     try:
         m = sys.modules[module]
-        return reduce(lambda o, a: getattr(o, a), qualname.split("."), m)
-    except AttributeError or KeyError:
+        obj = reduce(lambda o, a: getattr(o, a), qualname.split("."), m)
+    except (AttributeError, KeyError):
         raise ImportError(f"could not find class '{qualname}' from module {module} in current environment")
+    if module == "mimikit" or module.startswith("mimikit."):
+        _TYPES[type_] = obj
+    return obj
+
+
+_FIELDS: Dict[type, Tuple[frozenset, frozenset]] = {}
+
+
+def _init_fields(cls) -> Tuple[frozenset, frozenset]:
+    """names of the (init, non-init) fields of a dataclass"""
+    if cls not in _FIELDS:
+        init = frozenset(f.name for f in dtc.fields(cls) if f.init)
+        non_init = frozenset(f.name for f in dtc.fields(cls)
+                             if not f.init and not f.metadata.get("omegaconf_ignore", False))
+        _FIELDS[cls] = init, non_init
+    return _FIELDS[cls]
+
+
+def _build(obj, as_type=None):
+    """build the configs in `obj` (parsed yaml) like `Config.object` does, without OmegaConf"""
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            if k in STATIC_TYPED_KEYS:
+                obj[k] = _build(v, _get_type_object(STATIC_TYPED_KEYS[k]))
+            elif k == "extractors":
+                extractor = _get_type_object("Extractor")
+                obj[k] = tuple(_build(x, extractor) for x in v)
+            elif isinstance(v, (dict, list)):
+                obj[k] = _build(v)
+        if as_type is not None:
+            cls = as_type
+        elif "type" in obj:
+            cls = _get_type_object(obj["type"])
+        else:  # untyped raw dict
+            return obj
+        if not dtc.is_dataclass(cls):
+            return cls(**obj)
+        init, non_init = _init_fields(cls)
+        instance = cls(**{k: v for k, v in obj.items() if k in init})
+        for k in non_init:
+            if k in obj:
+                setattr(instance, k, obj[k])
+        return instance
+    elif isinstance(obj, list):
+        return [_build(x, as_type) for x in obj]
+    return obj
 
 
 STATIC_TYPED_KEYS = {
@@ -84,10 +138,14 @@ class Config:
 
     @staticmethod
     def deserialize(raw_yaml, as_type=None):
-        cfg = OmegaConf.create(raw_yaml)
-        if as_type is None and hasattr(cfg, "type"):
-            as_type = _get_type_object(cfg.type)
-        return Config.object(cfg, as_type)
+        """
+        build the config serialized in `raw_yaml`.
+        Parsed yaml is turned into dataclasses directly (see `Config.object` for the OmegaConf equivalent).
+        """
+        obj = yaml.load(raw_yaml, Loader=get_yaml_loader())
+        if isinstance(obj, dict) and (as_type is not None or "type" in obj):
+            return _build(obj, as_type)
+        return Config.object(OmegaConf.create(raw_yaml), as_type)
 
     @staticmethod
     def object(cfg: Union[ListConfig, DictConfig, Dict, List, Tuple, Any], as_type=None):
@@ -0,0 +1,252 @@
+"""
+Export the generate step of networks as self-contained TorchScript (or ONNX) graphs.
+
+The exported step computes `(inputs, state, t, temperature) -> (outputs, new_state)`:
+`inputs` are the `rf` last steps of each input feature, `state` is a tuple of tensors
+(initialized as described by the `state_spec` of the step) and `t` is the index of the step.
+Generation can then run outside of python's `ARM.generate_step` (e.g. in thread pools without the GIL).
+"""
+import json
+from typing import Optional, Tuple, List, Dict, Union, Sequence
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from .modules.targets import CategoricalSampler
+from .networks.arm import ARM
+from .runtime import fill
+
+__all__ = [
+    "WindowStep",
+    "ExportedStep",
+    "export_step",
+    "validate_export",
+]
+
+META_FILE = "mmk_step.json"
+
+StateSpec = List[Tuple[Tuple[int, ...], str, float]]
+
+
+class WindowStep(nn.Module):
+    """
+    the generate step of networks whose outputs only depend on their `rf` last inputs.
+    The state is the number of steps generated by each example.
+    """
+    warmup_steps = False
+
+    def __init__(self, network: ARM):
+        super(WindowStep, self).__init__()
+        self.network = network
+        self.with_temperature = "temperature" in network.generate_params
+
+    def state_spec(self) -> StateSpec:
+        return [((-1,), "int64", 0.)]
+
+    def forward(self,
+                inputs: Tuple[torch.Tensor, ...],
+                state: Tuple[torch.Tensor, ...],
+                t: torch.Tensor,
+                temperature: torch.Tensor):
+        params = dict(temperature=temperature) if self.with_temperature else {}
+        outputs = self.network.generate_step(inputs, t=0, **params)
+        if not isinstance(outputs, tuple):
+            outputs = outputs,
+        return outputs, (state[0] + 1,)
+
+
+def initial_state(spec: StateSpec, batch_size: int, device="cpu") -> Tuple[torch.Tensor, ...]:
+    return tuple(
+        torch.full([batch_size if d == -1 else d for d in shape], value, dtype=getattr(torch, dtype), device=device)
+        for shape, dtype, value in spec
+    )
+
+
+def _samplers(network: nn.Module) -> List[CategoricalSampler]:
+    return [m for m in network.modules() if isinstance(m, CategoricalSampler)]
+
+
+def _step_noise(network: nn.Module, noise_chunk: Optional[int]) -> Dict[CategoricalSampler, int]:
+    """
+    make the samplers draw their noise step by step (as the exported graphs do)
+    and reset their caches. Returns their previous chunk sizes.
+    """
+    previous = {}
+    for sampler in _samplers(network):
+        previous[sampler] = sampler.noise_chunk
+        if noise_chunk is not None:
+            sampler.noise_chunk = noise_chunk
+        sampler._noise, sampler._noise_pos, sampler._params = None, 0, {}
+    return previous
+
+
+def _example_inputs(network: ARM, batch_size: int) -> Tuple[torch.Tensor, ...]:
+    io_spec = network.config.io_spec
+    signal = torch.zeros(batch_size, io_spec.sr)
+    inputs = tuple(spec.transform(signal) for spec in io_spec.inputs)
+    if inputs[0].size(1) < network.rf:
+        raise ValueError(f"one second of inputs is shorter than the receptive field of the network ({network.rf})")
+    return tuple(x[:, -network.rf:].to(network.device) for x in inputs)
+
+
+def export_step(network: ARM,
+                path: str,
+                format: str = "torchscript",
+                batch_size: int = 1,
+                ) -> str:
+    """
+    trace the stateful step of `network` (see `ARM.stateful_step()`) and save it to `path`.
+
+    TorchScript files embed the metadata needed by `ExportedStep`, ONNX files are written
+    with a json file of metadata next to them (and the warm-up graph, if any, as `<path>.warmup.onnx`).
+    Graphs are traced for `batch_size` examples.
+    """
+    if format not in ("torchscript", "onnx"):
+        raise ValueError(f"unknown export format '{format}'")
+    was_training = network.training
+    network.eval()
+    step = network.stateful_step()
+    spec = step.state_spec()
+    inputs = _example_inputs(network, batch_size)
+    state = initial_state(spec, batch_size, network.device)
+    t = torch.tensor(network.rf)
+    temperature = torch.ones(batch_size, device=network.device)
+    meta = dict(
+        network=type(network).__qualname__,
+        rf=network.rf,
+        batch_size=batch_size,
+        n_inputs=len(inputs),
+        state_spec=spec,
+        warmup=step.warmup_steps,
+    )
+    previous = _step_noise(network, 1)
+    try:
+        with torch.no_grad():
+            if format == "torchscript":
+                methods = {"forward": (inputs, state, t, temperature)}
+                if step.warmup_steps:
+                    methods["warmup"] = (inputs, state, t)
+                traced = torch.jit.trace_module(step, methods, check_trace=False)
+                torch.jit.save(traced, path, _extra_files={META_FILE: json.dumps(meta)})
+            else:
+                n_out = len(network.config.io_spec.targets)
+                input_names = [*(f"input{i}" for i in range(len(inputs))),
+                               *(f"state{i}" for i in range(len(state))), "t", "temperature"]
+                output_names = [*(f"output{i}" for i in range(n_out)), *(f"new_state{i}" for i in range(len(state)))]
+                torch.onnx.export(step, (inputs, state, t, temperature), path,
+                                  input_names=input_names, output_names=output_names)
+                if step.warmup_steps:
+                    warmup = _Warmup(step)
+                    torch.onnx.export(warmup, (inputs, state, t), path + ".warmup.onnx",
+                                      input_names=input_names[:-1],
+                                      output_names=[f"new_state{i}" for i in range(len(state))])
+                with open(path + ".json", "w") as f:
+                    json.dump(meta, f)
+    finally:
+        for sampler, chunk in previous.items():
+            sampler.noise_chunk = chunk
+        _step_noise(network, None)
+        network.train(was_training)
+    return path
+
+
+class _Warmup(nn.Module):
+    def __init__(self, step):
+        super(_Warmup, self).__init__()
+        self.step = step
+
+    def forward(self, inputs, state, t):
+        return self.step.warmup(inputs, state, t)
+
+
+class ExportedStep:
+    """run the generation loop of a step exported to TorchScript"""
+
+    def __init__(self, module: torch.jit.ScriptModule, meta: dict):
+        self.module = module
+        self.meta = meta
+        self.rf = meta["rf"]
+
+    @classmethod
+    def load(cls, path: str, device: Union[str, torch.device] = "cpu") -> "ExportedStep":
+        extra = {META_FILE: ""}
+        module = torch.jit.load(path, map_location=device, _extra_files=extra)
+        return cls(module, json.loads(extra[META_FILE]))
+
+    def initial_state(self, batch_size: int, device="cpu") -> Tuple[torch.Tensor, ...]:
+        return initial_state([(tuple(s), d, v) for s, d, v in self.meta["state_spec"]], batch_size, device)
+
+    @torch.no_grad()
+    def generate(self,
+                 prompts: Tuple[torch.Tensor, ...],
+                 n_steps: int,
+                 temperature: Union[float, Sequence[float], torch.Tensor] = 1.,
+                 ) -> Tuple[torch.Tensor, ...]:
+        """the prompts followed by `n_steps` generated steps, like `GenerateLoopV2` without inversion"""
+        B, device = prompts[0].size(0), prompts[0].device
+        if B != self.meta["batch_size"]:
+            raise ValueError(f"the step was exported for batches of {self.meta['batch_size']} examples, got {B}")
+        temperature = torch.as_tensor(np.broadcast_to(np.asarray(temperature, dtype=np.float32), (B,)).copy()
+                                      if not isinstance(temperature, torch.Tensor) else temperature,
+                                      device=device).float()
+        rf, prior_t = self.rf, prompts[0].size(1)
+        state = self.initial_state(B, device)
+        if self.meta["warmup"]:
+            # same schedule as `SampleRNN.before_generate()`
+            offset = prior_t % rf
+            for t in range(rf, prior_t - offset):
+                window = tuple(p[:, t + offset - rf:t + offset] for p in prompts)
+                state = self.module.warmup(window, state, torch.tensor(t))
+        tensors = tuple(fill(x, prior_t=("data", prior_t), n_steps=("blank", n_steps)) for x in prompts)
+        until = 0
+        for t in range(prior_t, prior_t + n_steps):
+            if t < until:
+                continue
+            window = tuple(x[:, t - rf:t] for x in tensors)
+            outputs, state = self.module(window, state, torch.tensor(t), temperature)
+            for tensor, out in zip(tensors, outputs):
+                n_out = min(out.size(1), tensor.size(1) - t)
+                tensor.data[:, t:t + n_out] = out[:, :n_out]
+                until = t + n_out
+        return tensors
+
+
+def validate_export(network: ARM,
+                    path: str,
+                    prompts: Tuple[torch.Tensor, ...],
+                    n_steps: int,
+                    temperature: float = 1.,
+                    seed: int = 0,
+                    ) -> Dict[str, float]:
+    """
+    generate from `prompts` with `GenerateLoopV2` and with the TorchScript step at `path`
+    from the same seed and compare their outputs.
+    Samplers draw their noise step by step in both runs.
+    """
+    from .loops.generate import GenerateLoopV2
+
+    B = prompts[0].size(0)
+    previous = _step_noise(network, 1)
+    try:
+        torch.manual_seed(seed)
+        loop = GenerateLoopV2(
+            GenerateLoopV2.Config(parameters=dict(temperature=[temperature] * B),
+                                  display_waveform=False, write_waveform=False,
+                                  yield_inversed_outputs=False, device="cpu"),
+            network=network, n_steps=n_steps,
+            dataloader=[[torch.arange(B), *prompts]], logger=None
+        )
+        reference = list(loop.run())[0]
+    finally:
+        for sampler, chunk in previous.items():
+            sampler.noise_chunk = chunk
+        _step_noise(network, None)
+    torch.manual_seed(seed)
+    exported = ExportedStep.load(path).generate(prompts, n_steps, temperature)
+    prior_t = prompts[0].size(1)
+    diffs = [(r[:, prior_t:].float() - e[:, prior_t:].float()).abs() for r, e in zip(reference, exported)]
+    return dict(
+        max_abs_diff=max(float(d.max()) for d in diffs),
+        equal_fraction=float(torch.cat([(d == 0).float().flatten() for d in diffs]).mean()),
+    )
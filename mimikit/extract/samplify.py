@@ -4,11 +4,14 @@ from typing import Dict, List
 import numpy as np
 import librosa
 import matplotlib.pyplot as plt
-from numba import njit, float32, intp, int64, boolean, prange, types, typed
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from ..loops.callbacks import tqdm
 from ..features.functionals import Derivative, Envelop, Interpolate, Functional, Identity
+from ..utils import lazy_njit
+
+# numba's prange in the compiled kernels (see `lazy_njit`)
+prange = range
 
 __all__ = [
     "Samplifyer",
@@ -70,8 +73,8 @@ def attack_decay(y):
     return z_i, dec_i
 
 
-@njit(types.UniTuple(float32[:], 2)(types.ListType(float32[::1]), int64[::1], float32[::1], int64[::1]),
-      parallel=True, cache=True)
+@lazy_njit("UniTuple(float32[:], 2)(ListType(float32[::1]), int64[::1], float32[::1], int64[::1])",
+           parallel=True)
 def left_right_scores(fine_envs, coarse_cuts, coarse_env, half_window):
     left_scores = np.zeros_like(coarse_cuts, dtype=np.float32)
     right_scores = np.zeros_like(coarse_cuts, dtype=np.float32)
@@ -85,7 +88,7 @@ def left_right_scores(fine_envs, coarse_cuts, coarse_env, half_window):
     return left_scores, right_scores
 
 
-@njit(types.UniTuple(intp, 2)(intp, intp, float32[::1], float32[::1]))
+@lazy_njit("UniTuple(intp, 2)(intp, intp, float32[::1], float32[::1])")
 def _refine(start, stop, env, grad):
     if start == stop:
         return start, stop
@@ -97,8 +100,8 @@ def _refine(start, stop, env, grad):
 # print(left_right_scores.inspect_types())
 
 
-@njit(intp[::1](boolean[::1], intp[::1], intp[::1], intp[::1], types.ListType(float32[::1]), types.ListType(float32[::1])),
-      parallel=True)
+@lazy_njit("intp[::1](boolean[::1], intp[::1], intp[::1], intp[::1], ListType(float32[::1]), ListType(float32[::1]))",
+           parallel=True)
 def refine_cuts(z_crossings, coarse_cuts, coarse_peaks, sides, fine_envs, fine_grads):
     cuts = np.zeros_like(coarse_cuts)
     for i in prange(len(coarse_cuts)):
@@ -249,6 +252,8 @@ class Samplifyer(Functional):
         self.maxs_rank[(1 - self.coarse_env[self.coarse_peaks]).argsort()] = np.arange(len(self.coarse_peaks))
 
         # III. refine the cuts
+        from numba import typed
+
         fine_grads = typed.List([level.grad for level in self.levels[1:]])
         self.fine_envs = fine_envs = typed.List([level.env for level in self.levels[1:]])
         # a) TODO: find out if we need to refine left or right of the coarse cuts
@@ -4,10 +4,13 @@ from librosa.sequence import dtw
 from scipy.ndimage.filters import minimum_filter1d
 from sklearn.metrics import pairwise_distances as pwd
 from typing import List
-from numba import njit, prange, float64, intp
 import matplotlib.pyplot as plt
 import matplotlib as mpl
 mpl.rcParams['agg.path.chunksize'] = 10000
+from ..utils import lazy_njit
+
+# numba's prange in the compiled kernels (see `lazy_njit`)
+prange = range
 
 __all__ = [
     'from_recurrence_matrix'
@@ -18,7 +21,7 @@ def optimal_path(x, y):
     return dtw(C=pwd(abs(x), abs(y), metric='cosine'), subseq=True)[1][::-1]
 
 
-@njit(float64[:, :](float64[:, :], intp), fastmath=True, cache=False, parallel=True)
+@lazy_njit("float64[:, :](float64[:, :], intp)", fastmath=True, parallel=True)
 def pwdk_cosine(X, k):
     """
     pairwise distance within a kernel size - cosine version
@@ -59,7 +62,7 @@ def pwdk_cosine(X, k):
     return dist
 
 
-@njit(float64[:](float64[:, :], float64[:, :]), fastmath=True, cache=False, parallel=True)
+@lazy_njit("float64[:](float64[:, :], float64[:, :])", fastmath=True, parallel=True)
 def convolve_diagonals(diagonals, kernel):
     """
     convolve `diagonals` with `kernel`
@@ -10,12 +10,15 @@ from scipy.interpolate import interp1d
 from sklearn.decomposition import PCA as skPCA, \
     FactorAnalysis as skFactorAnalysis, NMF as skNMF
 from sklearn.preprocessing import StandardScaler
-from numba import njit, prange, float32, intp
 import dataclasses as dtc
 import abc
 
 from .item_spec import Sample, Frame, Unit, convert
 from ..config import Config
+from ..utils import lazy_njit
+
+# numba's prange in the compiled kernels (see `lazy_njit`)
+prange = range
 
 __all__ = [
     'Continuous',
@@ -916,7 +919,7 @@ class Interpolate(Functional):
                                                N, mode="linear").squeeze()
 
 
-@njit(float32[:](float32[:], intp), fastmath=True, cache=False)
+@lazy_njit("float32[:](float32[:], intp)", fastmath=True)
 def odd_reflect_pad_1d(x, k):
     """1d version of calling np.pad with **{mode='reflect', reflect_type='odd'}"""
     k_half = k // 2
@@ -928,7 +931,7 @@ def odd_reflect_pad_1d(x, k):
     return y
 
 
-@njit(float32[:](float32[:], intp), fastmath=True, cache=False, parallel=False)
+@lazy_njit("float32[:](float32[:], intp)", fastmath=True, parallel=False)
 def derivative_np_1d(y, max_lag):
     grads = np.zeros(y.shape, dtype=np.float32)
     for lag in prange(1, max_lag + 1):
@@ -940,7 +943,7 @@ def derivative_np_1d(y, max_lag):
     return grads
 
 
-@njit(float32[:, :](float32[:, :], intp), fastmath=True, cache=False, parallel=True)
+@lazy_njit("float32[:, :](float32[:, :], intp)", fastmath=True, parallel=True)
 def derivative_np_2d(y, max_lag):
     grads = np.zeros(y.shape, dtype=np.float32)
     for i in prange(y.shape[0]):
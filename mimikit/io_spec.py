@@ -125,7 +125,7 @@ class Objective(Config, type_field=False):
     @staticmethod
     def cross_entropy(output, target):
         criterion = nn.CrossEntropyLoss(reduction="mean")
-        return criterion(output.view(-1, output.size(-1)), target.view(-1))
+        return criterion(output.reshape(-1, output.size(-1)).float(), target.reshape(-1))
 
 
 @dtc.dataclass
@@ -3,5 +3,9 @@ from .generate import *
 from .logger import *
 from .train_loops import *
 from .samplers import *
+from .scheduler import *
+from .loader_tuning import *
+from .serve import *
+from .profiling import *
 
 __all__ = [_ for _ in dir() if not _.startswith("_")]
@@ -1,20 +1,29 @@
 import os
+import dataclasses as dtc
+import queue
+import threading
+from contextlib import contextmanager, nullcontext
+from copy import copy
+from functools import partial
 from time import time
-from typing import Iterable
+from typing import Iterable, Optional, List, Tuple
+import torch
 import pytorch_lightning as pl
 from pytorch_lightning.trainer.states import TrainerState
 from pytorch_lightning import Callback
 from IPython import get_ipython
 
-from ..checkpoint import Checkpoint
+from ..checkpoint import Checkpoint, CheckpointBank, CheckpointWriter, to_host
 
 __all__ = [
     'is_notebook',
     'EpochProgressBarCallback',
     'TrainingProgressBar',
     'GradNormCallback',
+    'EMACallback',
     'MMKCheckpoint',
     'GenerateCallback',
+    'snapshot',
     'tqdm'
 ]
 
@@ -102,17 +111,99 @@ class GradNormCallback(Callback):
         self.gradnorms += [pl_module.grad_norm(1.)]
 
 
+class EMACallback(Callback):
+    """
+    keep an exponential moving average of the weights of `pl_module.net` after each optimizer step.
+
+    The decay is warmed up as `min(decay, (1 + n) / (10 + n))` over the `n` updates since `start_step`.
+    The average lives on the device of the weights; `swapped(net)` temporarily puts it in the network.
+    """
+
+    def __init__(self, decay: float = 0.999, start_step: int = 0):
+        self.decay = decay
+        self.start_step = start_step
+        self.n_updates = 0
+        self.keys: List[str] = []
+        self.current: List[torch.Tensor] = []
+        self.averaged: List[torch.Tensor] = []
+
+    def reset(self, net):
+        state = net.state_dict()
+        self.keys = [k for k, v in state.items() if v.is_floating_point()]
+        # the tensors of the state dict share their storage with the weights
+        self.current = [state[k] for k in self.keys]
+        self.averaged = [v.detach().clone() for v in self.current]
+        self.n_updates = 0
+
+    @torch.no_grad()
+    def update(self, net):
+        if not self.averaged or self.averaged[0].device != self.current[0].device:
+            self.reset(net)
+            return
+        self.n_updates += 1
+        decay = min(self.decay, (1 + self.n_updates) / (10 + self.n_updates))
+        torch._foreach_lerp_(self.averaged, [t.detach() for t in self.current], 1. - decay)
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        if trainer.global_step >= self.start_step:
+            self.update(pl_module.net)
+
+    def state_dict(self, net=None):
+        """the averaged weights (and the other tensors of the state dict of `net`)"""
+        state = dict(net.state_dict()) if net is not None else {}
+        state.update(zip(self.keys, self.averaged))
+        return state
+
+    @contextmanager
+    def swapped(self, net):
+        if not self.averaged:
+            yield net
+            return
+        with torch.no_grad():
+            backup = [t.detach().clone() for t in self.current]
+            torch._foreach_copy_(self.current, self.averaged)
+        try:
+            yield net
+        finally:
+            with torch.no_grad():
+                torch._foreach_copy_(self.current, backup)
+
+
 class MMKCheckpoint(Callback):
+    """
+    save checkpoints every `epochs` epochs (and at the end of the training).
+
+    With `asynchronous=True`, the states are copied to host memory and the files are written
+    by a `CheckpointWriter` while the training goes on.
+    Only the `keep_last` last checkpoints and the `keep_best` ones with the best epoch average
+    of `monitor` are kept on disk if one of these is not None.
+    With an `ema` callback, the averaged weights are also saved as the checkpoints of id "ema"
+    in the directory of the training.
+    """
 
     def __init__(self,
                  epochs=None,
-                 root_dir=''
+                 root_dir='',
                  # todo: save_optimizer
+                 asynchronous=False,
+                 keep_last: Optional[int] = None,
+                 keep_best: Optional[int] = None,
+                 monitor: str = "loss",
+                 mode: str = "min",
+                 ema: Optional[EMACallback] = None,
                  ):
         super().__init__()
         self.epochs = epochs
         self.root_dir = root_dir
         self.config = None
+        self.writer = CheckpointWriter() if asynchronous else None
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.monitor = monitor
+        self.mode = mode
+        self.ema = ema
+        # (epoch, monitored value) of the checkpoints on disk
+        self.saved: List[Tuple[int, float]] = []
 
     def on_fit_start(self, trainer, pl_module: "TrainARMLoop") -> None:
         config = pl_module.config
@@ -123,6 +214,8 @@ class MMKCheckpoint(Callback):
         self.config = config
 
     def on_train_epoch_end(self, trainer, pl_module, unused=None) -> None:
+        if not trainer.is_global_zero:
+            return
         epoch, global_step = trainer.current_epoch + 1, trainer.global_step
         if trainer.state == TrainerState.status.INTERRUPTED or \
                 epoch == trainer.max_epochs or self.should_save(epoch, global_step):
@@ -148,22 +241,173 @@ class MMKCheckpoint(Callback):
                              validate_loop=trainer.validate_loop.state_dict(),
                              test_loop=trainer.test_loop.state_dict(),
                              predict_loop=trainer.predict_loop.state_dict())
-        Checkpoint(id=training_id, epoch=epoch, root_dir=root_dir) \
-            .create(pl_module.net, self.config, optimizer=opt, trainer_state=trainer_state)
+        ckpt = Checkpoint(id=training_id, epoch=epoch, root_dir=root_dir)
+        if self.writer is not None:
+            self.writer.submit(ckpt, pl_module.net, self.config, optimizer=opt, trainer_state=to_host(trainer_state))
+        else:
+            ckpt.create(pl_module.net, self.config, optimizer=opt, trainer_state=trainer_state)
+        if self.ema is not None and self.ema.averaged:
+            self.save_ema(pl_module, epoch)
+        self.saved = [(e, v) for e, v in self.saved if e != epoch] + [(epoch, self.monitored_value(pl_module))]
+        to_delete = self.to_delete()
+        if to_delete:
+            delete = partial(self.delete, [Checkpoint(id=id_, epoch=e, root_dir=root)
+                                           for e in to_delete
+                                           for id_, root in ((training_id, root_dir), ("ema", self.root_dir))])
+            self.writer.call(delete) if self.writer is not None else delete()
+            self.saved = [(e, v) for e, v in self.saved if e not in to_delete]
+
+    def save_ema(self, pl_module, epoch):
+        ckpt = Checkpoint(id="ema", epoch=epoch, root_dir=self.root_dir)
+        state = self.ema.state_dict(pl_module.net)
+        if self.writer is not None:
+            self.writer.submit(ckpt, pl_module.net, self.config, network_state=state)
+        else:
+            CheckpointBank.save(ckpt.os_path, pl_module.net, self.config, network_state=state)
+
+    def monitored_value(self, pl_module) -> float:
+        metrics, counts = getattr(pl_module, "_ep_metrics", {}), getattr(pl_module, "_batch_count", {})
+        if self.monitor not in metrics:
+            return float("nan")
+        return float(metrics[self.monitor] / counts[self.monitor])
+
+    def to_delete(self) -> List[int]:
+        if self.keep_last is None and self.keep_best is None:
+            return []
+        keep = set()
+        if self.keep_last is not None:
+            keep |= {e for e, _ in self.saved[len(self.saved) - self.keep_last:]}
+        if self.keep_best is not None and self.keep_best > 0:
+            sign = 1. if self.mode == "min" else -1.
+            ranked = sorted((v for v in self.saved if v[1] == v[1]), key=lambda ev: sign * ev[1])
+            keep |= {e for e, _ in ranked[:self.keep_best]}
+        return [e for e, _ in self.saved if e not in keep]
+
+    @staticmethod
+    def delete(checkpoints):
+        for ckpt in checkpoints:
+            if os.path.isfile(ckpt.os_path):
+                ckpt.delete()
+
+    def wait(self):
+        if self.writer is not None:
+            self.writer.wait()
+
+    def on_train_end(self, trainer, pl_module) -> None:
+        self.wait()
+
+    def on_exception(self, trainer, pl_module, exception) -> None:
+        self.wait()
+
+
+class _DeferredDisplay:
+    """write outputs right away but queue their display for the main thread"""
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.pending = queue.Queue()
+
+    def write(self, audio, **template_params):
+        self.logger.write(audio, **template_params)
+
+    def display(self, audio, **template_params):
+        if isinstance(audio, torch.Tensor):
+            audio = audio.detach().cpu()
+        self.pending.put((audio, template_params))
+
+    def flush(self):
+        while not self.pending.empty():
+            audio, template_params = self.pending.get()
+            self.logger.display(audio, **template_params)
+
+
+def snapshot(net, device="cpu"):
+    """a fresh copy of `net` with its current weights on `device` (`net` is left where it is)"""
+    state = {k: v.detach().to(device, copy=True) for k, v in net.state_dict().items()}
+    copied = type(net).from_config(net.config)
+    copied.load_state_dict(state)
+    return copied.to(device)
 
 
 class GenerateCallback(pl.callbacks.Callback):
+    """
+    run the generate loop every `every_n_epochs`.
+
+    With `asynchronous=True`, the loop runs in a background thread on a snapshot of the weights
+    placed on `device` (cpu if None) and training goes on meanwhile. Outputs are written when they
+    are ready and displayed by the training thread at the next batch. An epoch that ends while
+    the previous generation is still running doesn't start a new one.
+    With an `ema` callback, the outputs are generated with the averaged weights.
+    """
 
     def __init__(self,
                  generate_loop=None,
-                 every_n_epochs=10
+                 every_n_epochs=10,
+                 asynchronous=False,
+                 device: Optional[str] = None,
+                 ema: Optional[EMACallback] = None,
                  ):
         self.loop = generate_loop
         self.every_n_epochs = every_n_epochs
+        self.asynchronous = asynchronous
+        self.device = device
+        self.ema = ema
+        self.thread: Optional[threading.Thread] = None
+        self.display: Optional[_DeferredDisplay] = None
 
     def on_train_epoch_end(self, trainer: pl.Trainer, model):
-        if (trainer.current_epoch + 1) % self.every_n_epochs != 0:
+        if not trainer.is_global_zero or (trainer.current_epoch + 1) % self.every_n_epochs != 0:
             return
         self.loop.template_vars = dict(epoch=trainer.current_epoch + 1)
-        for _ in self.loop.run():
+        if not self.asynchronous:
+            with self.averaged_weights():
+                for _ in self.loop.run():
+                    continue
+            return
+        if self.is_running:
+            model.print(f"skipping generation of epoch {trainer.current_epoch + 1}: the previous one is still running")
+            return
+        self.start(self.loop.network)
+
+    @property
+    def is_running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, network):
+        device = self.device or "cpu"
+        loop = copy(self.loop)
+        with self.averaged_weights():
+            loop.network = snapshot(network, device)
+        loop.config = dtc.replace(loop.config, device=device)
+        if loop.logger is not None:
+            self.display = loop.logger = _DeferredDisplay(self.loop.logger)
+        self.thread = threading.Thread(target=self._run, args=(loop,), daemon=True)
+        self.thread.start()
+
+    def averaged_weights(self):
+        if self.ema is None or getattr(self.loop, "network", None) is None:
+            return nullcontext()
+        return self.ema.swapped(self.loop.network)
+
+    @staticmethod
+    def _run(loop):
+        # grad mode is thread-local: this doesn't touch the training thread
+        for _ in loop.run():
             continue
+
+    def flush(self):
+        if self.display is not None:
+            self.display.flush()
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        if self.display is not None and not self.display.pending.empty():
+            self.flush()
+
+    def on_train_end(self, trainer, pl_module):
+        self.wait()
@@ -10,7 +10,9 @@ from .callbacks import tqdm
 
 __all__ = [
     "GenerateLoopV2",
+    "BlockDecoder",
     'prepare_prompt',
+    'parameters_at',
     'generate_tqdm',
 ]
 
@@ -20,6 +22,7 @@ from ..utils import default_device
 from ..config import Config
 from ..features.item_spec import ItemSpec, Second, Frame, convert, Sample
 from ..networks.arm import ARM
+from ..runtime import fill, parameters_at, sampling_parameters, n_generate_steps, generate_steps
 from .samplers import IndicesSampler
 
 
@@ -44,35 +47,6 @@ def generate_tqdm(rng):
                 leave=False, unit="step", mininterval=1.)
 
 
-FillType = Union[Literal["blank", "data"], torch.Tensor]
-
-
-def fill(
-        x: Optional[torch.Tensor],
-        prior_t: Tuple[FillType, int],
-        n_steps: Tuple[FillType, int],
-):
-    if isinstance(x, np.ndarray):
-        x = torch.from_numpy(x)
-    if x is not None:
-        to_cat = [x]
-        dt, dev = x.dtype, x.device
-        B, D = x.size(0), x.shape[2:]
-    else:
-        to_cat = []
-        dt, dev = torch.float32, "cpu"
-        B, D = 1, (1,)
-    for fill_type, n in [prior_t, n_steps]:
-        if isinstance(fill_type, torch.Tensor):
-            assert fill_type.shape == (B,)
-            to_cat += [fill_type.expand(B, n, 1)]
-        elif fill_type == "blank":
-            to_cat += [torch.zeros(B, n, *D, dtype=dt, device=dev)]
-        elif fill_type == "data":
-            pass
-    return torch.cat(to_cat, dim=1)
-
-
 class PromptIndices(h5m.Input):
     def __init__(self, n):
         self.getter = h5m.Getter()
@@ -97,18 +71,11 @@ class GenerateLoopV2:
         write_waveform: bool = False
         yield_inversed_outputs: bool = True
         callback: Optional[Callable[[Tuple[torch.Tensor, ...]], None]] = None
+        device: Optional[str] = None  # default_device() if None
 
     @classmethod
     def get_n_steps(cls, config: Config, network: ARM):
-        io_spec = network.config.io_spec
-        sr = io_spec.sr
-        unit = io_spec.unit
-        output_n_samples = int(sr * config.output_duration_sec)
-        if isinstance(unit, Frame):
-            tmp = convert(output_n_samples, Sample(1), unit, as_length=True)
-            return tmp + 1
-        else:
-            return output_n_samples
+        return n_generate_steps(network, config.output_duration_sec)
 
     @classmethod
     def get_dataloader(cls, config, dataset: h5m.TypedFile, network: ARM):
@@ -172,7 +139,7 @@ class GenerateLoopV2:
         self._initial_device = net.device
         self._was_training = net.training
         net.eval()
-        self.device = default_device()
+        self.device = self.config.device or default_device()
         net.to(self.device)
         torch.set_grad_enabled(False)
 
@@ -192,31 +159,16 @@ class GenerateLoopV2:
                           for x in batch)
             self.network.before_generate(batch, prompt_idx)
 
-            rf, prior_t, n_steps = self.network.rf, batch[0].size(1), self.n_steps
+            prior_t, n_steps = batch[0].size(1), self.n_steps
 
             tensors = h5m.process_batch(
                 batch, lambda x: isinstance(x, torch.Tensor),
                 partial(fill, prior_t=("data", prior_t), n_steps=("blank", n_steps))
             )
             # todo: initialize targets & couple auto regressive features
-            params = self.config.parameters
-            params = {} if params is None else params
-            params = {k: v for k, v in params.items() if k in self.network.generate_params}
+            params = self.get_parameters()
             # generate
-            until = 0
-            for t in generate_tqdm(range(prior_t, prior_t + n_steps)):
-                if t < until:
-                    continue
-                inputs = tuple(tensor[:, t - rf:t] for tensor in tensors)
-                outputs = self.network.generate_step(inputs, t=t, **params)
-                if not isinstance(outputs, tuple):
-                    outputs = outputs,
-                for tensor, out in zip(tensors, outputs):
-                    # let the net return None when ignoring this step
-                    if out is not None:
-                        n_out = min(out.size(1), tensor.size(1)-t)
-                        tensor.data[:, t:t + n_out] = out[:, :n_out]
-                        until = t + n_out
+            generate_steps(self.network, tensors, prior_t, n_steps, params, progress=generate_tqdm)
 
             # wrap up
             final_outputs = tuple(x.data for x in tensors)
@@ -228,6 +180,77 @@ class GenerateLoopV2:
                 self.config.callback(final_outputs)
         self.teardown()
 
+    def stream(self, block_size: int = 2048):
+        """
+        generate like `run()` but yield the freshly generated steps by blocks of `block_size` steps
+        (inversed if `config.yield_inversed_outputs`) as soon as they are ready.
+
+        Only the last `rf` steps of each prompt are kept in memory and the generation only advances
+        when the consumer asks for the next block (backpressure).
+        Closing the generator stops the generation and restores the network.
+        """
+        self.setup()
+        try:
+            for batch in self.dataloader:
+                prompt_idx, batch = batch[0], batch[1:]
+                batch = tuple((torch.from_numpy(x) if isinstance(x, np.ndarray) else x).to(self.device)
+                              for x in batch)
+                yield from self._stream_batch(batch, prompt_idx, block_size)
+        finally:
+            self.teardown()
+
+    def _stream_batch(self, batch, prompt_idx, block_size):
+        net = self.network
+        net.before_generate(batch, prompt_idx)
+        rf, prior_t, n_steps = net.rf, batch[0].size(1), self.n_steps
+        params = self.get_parameters()
+        if self.config.yield_inversed_outputs:
+            decoders = tuple(BlockDecoder(feature) for feature in net.config.io_spec.targets)
+        else:
+            decoders = None
+
+        def ring_buffer(x):
+            # `rf` steps of history followed by room for one block
+            history = x[:, -rf:]
+            shape = x.size(0), rf - history.size(1), *x.shape[2:]
+            history = torch.cat((torch.zeros(*shape, dtype=x.dtype, device=x.device), history), dim=1)
+            return fill(history, prior_t=("data", rf), n_steps=("blank", block_size))
+
+        buffers = tuple(ring_buffer(x) for x in batch)
+        t, pos, end = prior_t, rf, prior_t + n_steps
+        try:
+            while t < end:
+                inputs = tuple(buf[:, pos - rf:pos] for buf in buffers)
+                outputs = net.generate_step(inputs, t=t, **parameters_at(params, t - prior_t))
+                if not isinstance(outputs, tuple):
+                    outputs = outputs,
+                # like in `run()`, a step without outputs leaves a blank and moves on
+                n_out = 1
+                for buf, out in zip(buffers, outputs):
+                    if out is not None:
+                        n_out = min(out.size(1), buf.size(1) - pos, end - t)
+                        buf.data[:, pos:pos + n_out] = out[:, :n_out]
+                t, pos = t + n_out, pos + n_out
+                if pos == buffers[0].size(1) or t >= end:
+                    blocks = tuple(buf[:, rf:pos].clone() for buf in buffers)
+                    if decoders is not None:
+                        blocks = tuple(decode(block) for decode, block in zip(decoders, blocks))
+                    yield blocks
+                    # keep `rf` steps of history and blank the rest
+                    for buf in buffers:
+                        buf.data[:, :rf] = buf.data[:, pos - rf:pos].clone()
+                        buf.data[:, rf:] = 0
+                    pos = rf
+        finally:
+            net.after_generate(tuple(buf.data for buf in buffers), prompt_idx)
+
+    def get_parameters(self):
+        """
+        the sampling parameters of the network. Arrays are moved once to the device and
+        2d arrays are (batch x time) schedules sliced by `parameters_at()`
+        """
+        return sampling_parameters(self.network, self.config.parameters, self.device)
+
     def process_outputs(
             self,
             final_outputs: Tuple[torch.Tensor, ...],
@@ -252,6 +275,38 @@ class GenerateLoopV2:
         return outputs if self.config.yield_inversed_outputs else final_outputs
 
 
+class BlockDecoder:
+    """
+    inverse a target feature block by block.
+
+    Framed features (e.g. spectrograms) are inversed together with the last frames of the previous block
+    so that their overlapping samples are reconstructed and only the samples of the new block are returned.
+    """
+
+    def __init__(self, feature):
+        self.inv = feature.inv
+        unit = feature.unit
+        if isinstance(unit, Frame):
+            self.hop_length = unit.hop_length
+            self.n_context = -(-unit.frame_size // unit.hop_length) - 1
+        else:
+            self.hop_length, self.n_context = 1, 0
+        self.context = None
+
+    def __call__(self, block: torch.Tensor) -> torch.Tensor:
+        if self.n_context == 0:
+            return self.inv(block)
+        if self.context is None:
+            x = block
+        else:
+            x = torch.cat((self.context, block), dim=1)
+        self.context = x[:, -self.n_context:]
+        y = self.inv(x)
+        if x is block:
+            return y
+        return y[:, -block.size(1) * self.hop_length:]
+
+
 class EncodeDecodeLoop:
     @dtc.dataclass
     class Config(Config):
@@ -266,6 +321,7 @@ class EncodeDecodeLoop:
         write_waveform: bool = False
         yield_inversed_outputs: bool = True
         callback: Optional[Callable[[Tuple[torch.Tensor, ...]], None]] = None
+        device: Optional[str] = None  # default_device() if None
 
     @classmethod
     def get_dataloader(cls, config, dataset: h5m.TypedFile, network: ARM):
@@ -326,7 +382,7 @@ class EncodeDecodeLoop:
         self._initial_device = net.device
         self._was_training = net.training
         net.eval()
-        self.device = default_device()
+        self.device = self.config.device or default_device()
         net.to(self.device)
         torch.set_grad_enabled(False)
 
@@ -0,0 +1,92 @@
+import dataclasses as dtc
+import itertools
+import time
+from typing import Optional, Tuple
+
+import torch
+import h5mapper as h5m
+
+from ..config import Config
+from ..networks.arm import ARM
+from ..utils import available_cpus
+
+__all__ = [
+    "LoaderSettings",
+    "autotune_loader",
+]
+
+
+@dtc.dataclass
+class LoaderSettings(Config):
+    num_workers: int = 0
+    prefetch_factor: int = 2
+    pin_memory: bool = False
+    torch_threads: int = 1
+    batches_per_sec: float = 0.
+
+    def apply(self, train_cfg):
+        """the training config with these loader settings"""
+        return dtc.replace(train_cfg,
+                           num_workers=self.num_workers,
+                           prefetch_factor=self.prefetch_factor,
+                           pin_memory=self.pin_memory)
+
+
+def _time_loader(loader, n_batches: int, device: Optional[str]) -> float:
+    it = iter(loader)
+    # the first batch pays for starting the workers
+    next(it)
+    start, n = time.perf_counter(), 0
+    for batch in itertools.islice(it, n_batches):
+        if device is not None:
+            h5m.process_batch(batch, lambda x: isinstance(x, torch.Tensor),
+                              lambda x: x.to(device, non_blocking=True))
+        n += 1
+    if device == "cuda":
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+    # shutdown the (persistent) workers of this trial
+    if getattr(loader, "_iterator", None) is not None:
+        loader._iterator._shutdown_workers()
+    del it
+    return n / elapsed if elapsed > 0 else 0.
+
+
+def autotune_loader(
+        dataset: h5m.TypedFile,
+        network: ARM,
+        train_cfg,
+        n_batches: int = 16,
+        workers: Optional[Tuple[int, ...]] = None,
+        prefetch_factors: Tuple[int, ...] = (2, 4),
+) -> LoaderSettings:
+    """
+    time `n_batches` of the training loader of `network` for combinations of
+    number of workers, prefetch factor, pin_memory and torch threads and return the fastest settings.
+
+    The threads left to torch in the main process are the cpus not used by the workers.
+    """
+    from .train_loops import TrainARMLoop
+
+    n_cpus = available_cpus()
+    if workers is None:
+        workers = sorted({0, *(2 ** i for i in range(8) if 2 ** i < n_cpus)})
+    with_cuda = torch.cuda.is_available()
+    pin_memory = (False, True) if with_cuda else (False,)
+    initial_threads = torch.get_num_threads()
+    best = LoaderSettings(batches_per_sec=-1.)
+    try:
+        for n_workers, pin in itertools.product(workers, pin_memory):
+            threads = max(1, n_cpus - n_workers)
+            for prefetch in (prefetch_factors if n_workers > 0 else prefetch_factors[:1]):
+                settings = LoaderSettings(
+                    num_workers=n_workers, prefetch_factor=prefetch, pin_memory=pin, torch_threads=threads
+                )
+                torch.set_num_threads(threads)
+                loader = TrainARMLoop.get_dataloader(dataset, network, settings.apply(train_cfg))
+                settings.batches_per_sec = _time_loader(loader, n_batches, "cuda" if with_cuda else None)
+                if settings.batches_per_sec > best.batches_per_sec:
+                    best = settings
+    finally:
+        torch.set_num_threads(initial_threads)
+    return best
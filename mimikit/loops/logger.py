@@ -28,6 +28,13 @@ class LoggingHooks(LightningModule):
         # convenience to have printing of the loss at the end of the epoch
         self._ep_metrics = {}
         self._batch_count = {}
+        self._flushed_at = None
+
+    def on_validation_epoch_start(self):
+        # validation metrics are those of the last validation run
+        for k in [k for k in getattr(self, "_ep_metrics", {}) if k.startswith("val_")]:
+            self._ep_metrics.pop(k)
+            self._batch_count.pop(k)
 
     def on_before_backward(self, loss: torch.Tensor) -> None:
         if torch.isnan(loss.detach()) or torch.isinf(loss.detach().abs()):
@@ -57,21 +64,26 @@ class LoggingHooks(LightningModule):
         to_print = "Epoch %i " % self.current_epoch
         to_log = {}
         for k, v in self._ep_metrics.items():
-            to_print += "- %s : %.4f " % (k, v / self._batch_count[k])
-            to_log[k] = (v / self._batch_count[k]).item()
+            # average over the processes of distributed trainings
+            v = self.trainer.strategy.reduce(v / self._batch_count[k], reduce_op="mean")
+            to_print += "- %s : %.4f " % (k, v)
+            to_log[k] = v.item()
         self.print(to_print)
         if getattr(self, "logger", None) is not None:
             self.logger.log_metrics(to_log, self.current_epoch)
+        self._flushed_at = self.global_step
 
     def on_train_epoch_end(self, *args):
         super(LoggingHooks, self).on_train_epoch_end(*args)
-        if self.trainer.val_dataloaders is not None and any(self.trainer.val_dataloaders):
-            # wait until validation end
+        if getattr(self, "_flushed_at", None) == self.global_step:
+            # already flushed by the validation at the end of this epoch
             return
-        else:
-            self._flush_ep_metrics()
+        self._flush_ep_metrics()
 
     def on_validation_epoch_end(self, *args):
+        if not hasattr(self, "_ep_metrics"):
+            # sanity check before training
+            return
         self._flush_ep_metrics()
 
     def on_fit_start(self):
@@ -0,0 +1,155 @@
+import os
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Dict, Optional, Tuple
+
+import torch
+from pytorch_lightning import Callback
+
+__all__ = [
+    "StageTimer",
+    "ProfilerCallback",
+]
+
+
+class StageTimer:
+    """
+    accumulate the wall-clock time (in ms) of the stages of a training step.
+
+    Stages are also recorded as `torch.profiler.record_function` ranges so that they
+    show up in traces. With `cuda_sync=True` pending cuda kernels are awaited at the start and
+    end of each stage (slower, but the times are those of the stages and not of their launches).
+    A disabled timer does nothing.
+    """
+
+    def __init__(self, enabled: bool = True, cuda_sync: bool = False):
+        self.enabled = enabled
+        self.cuda_sync = cuda_sync
+        self.times: Dict[str, float] = {}
+        self._starts: Dict[str, float] = {}
+        self._ranges = {}
+
+    def _sync(self):
+        if self.cuda_sync:
+            torch.cuda.synchronize()
+
+    def start(self, stage: str):
+        if not self.enabled:
+            return
+        self._sync()
+        self._ranges[stage] = torch.profiler.record_function(stage).__enter__()
+        self._starts[stage] = time.perf_counter()
+
+    def stop(self, stage: str):
+        if not self.enabled or stage not in self._starts:
+            return
+        self._sync()
+        elapsed = time.perf_counter() - self._starts.pop(stage)
+        self._ranges.pop(stage).__exit__(None, None, None)
+        self.times[stage] = self.times.get(stage, 0.) + elapsed * 1000
+
+    @contextmanager
+    def __call__(self, stage: str):
+        self.start(stage)
+        try:
+            yield
+        finally:
+            self.stop(stage)
+
+    def wrap(self, stage: str, func):
+        @wraps(func)
+        def timed(*args, **kwargs):
+            with self(stage):
+                return func(*args, **kwargs)
+        return timed
+
+    def wrap_callbacks(self, callbacks):
+        """time the hooks that the `callbacks` implement as `callback/<ClassName>`"""
+        if not self.enabled:
+            return callbacks
+        for cb in callbacks:
+            if getattr(cb, "_timed", False):
+                continue
+            cb._timed = True
+            for name in dir(Callback):
+                if not (name.startswith("on_") or name in ("setup", "teardown")):
+                    continue
+                if getattr(type(cb), name, None) is getattr(Callback, name):
+                    continue
+                setattr(cb, name, self.wrap(f"callback/{type(cb).__name__}", getattr(cb, name)))
+        return callbacks
+
+    def pop(self) -> Dict[str, float]:
+        """the accumulated times, which are reset"""
+        times, self.times = self.times, {}
+        return times
+
+
+class ProfilerCallback(Callback):
+    """
+    report the stage times of a `StageTimer`, samples/sec, tokens/sec (samples x time steps)
+    and the peak cuda memory of each training batch.
+
+    They are added to the outputs of the batches (hence averaged in the epoch metrics of `LoggingHooks`)
+    and the throughputs are shown in the progress bar.
+    The training steps in `trace_steps` (first, last) are exported to `trace_path` as a chrome trace.
+    """
+
+    def __init__(self,
+                 timer: StageTimer,
+                 trace_steps: Optional[Tuple[int, int]] = None,
+                 trace_path: str = "trace.json",
+                 ):
+        self.timer = timer
+        self.trace_steps = trace_steps
+        self.trace_path = trace_path
+        self.profiler: Optional[torch.profiler.profile] = None
+        self._last_end = None
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        self._last_end = time.perf_counter()
+        self.timer.pop()
+        self.timer.start("data")
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx):
+        if self.trace_steps is not None and self.profiler is None and trainer.global_step == self.trace_steps[0]:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities += [torch.profiler.ProfilerActivity.CUDA]
+            self.profiler = torch.profiler.profile(activities=activities)
+            self.profiler.__enter__()
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        self.timer.stop("optimizer")
+        now = time.perf_counter()
+        elapsed, self._last_end = now - self._last_end, now
+        x = batch[0][0] if isinstance(batch[0], (tuple, list)) else batch[0]
+        n_samples = x.size(0)
+        n_tokens = n_samples * (x.size(1) if x.ndim > 1 else 1)
+        stats = {f"time/{stage}": ms for stage, ms in self.timer.pop().items()}
+        stats["samples_per_sec"] = n_samples / elapsed
+        stats["tokens_per_sec"] = n_tokens / elapsed
+        if torch.cuda.is_available():
+            stats["peak_memory_mb"] = torch.cuda.max_memory_allocated() / 2 ** 20
+        if isinstance(outputs, dict):
+            outputs.update({k: torch.tensor(v) for k, v in stats.items()})
+        pl_module.log("samples/sec", stats["samples_per_sec"], prog_bar=True, on_step=True, on_epoch=False, batch_size=1)
+        pl_module.log("tokens/sec", stats["tokens_per_sec"], prog_bar=True, on_step=True, on_epoch=False, batch_size=1)
+        if self.profiler is not None:
+            self.profiler.step()
+            if trainer.global_step >= self.trace_steps[1]:
+                self.export_trace()
+        self.timer.start("data")
+
+    def on_train_end(self, trainer, pl_module):
+        self.timer.stop("data")
+        self.export_trace()
+
+    def export_trace(self):
+        if self.profiler is None:
+            return
+        self.profiler.__exit__(None, None, None)
+        os.makedirs(os.path.dirname(os.path.abspath(self.trace_path)), exist_ok=True)
+        self.profiler.export_chrome_trace(self.trace_path)
+        self.profiler = None
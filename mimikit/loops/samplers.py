@@ -1,17 +1,71 @@
 import math
+import dataclasses as dtc
+from typing import Optional, Sequence, Tuple, List, Dict
 
+import numpy as np
 import torch
-from torch.utils.data import Sampler, RandomSampler, BatchSampler
+import torch.distributed as dist
+from torch.utils.data import Sampler, DataLoader
+import h5py
+import h5mapper as h5m
 
 __all__ = [
     'TBPTTSampler',
-    'IndicesSampler'
+    'IndicesSampler',
+    'RandomBatchSampler',
+    'BatchedSlice',
+    'is_batchable',
+    'serve_batched',
+    'InRegions',
+    'FixedBatchSampler',
+    'source_regions',
+    'split_regions',
+    'item_regions',
 ]
 
 
-class TBPTTSampler(Sampler):
+class _Replicated:
+    """
+    shard the batches of a sampler across the processes of a distributed training.
+
+    All the processes draw the same schedule (seeded with `seed + epoch`, see `set_epoch`)
+    and keep their own part of it. `num_replicas` and `rank` default to the ones of the
+    initialized process group (or to 1 and 0) when the sampler is iterated.
+    """
+
+    def _init_replicas(self, num_replicas=None, rank=None, seed=None):
+        self._num_replicas = num_replicas
+        self._rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    @property
+    def num_replicas(self) -> int:
+        if self._num_replicas is not None:
+            return self._num_replicas
+        return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+    @property
+    def rank(self) -> int:
+        if self._rank is not None:
+            return self._rank
+        return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def generator(self) -> Optional[torch.Generator]:
+        if self.seed is None and self.num_replicas == 1:
+            # global rng
+            return None
+        return torch.Generator().manual_seed((self.seed or 0) + self.epoch)
+
+
+class TBPTTSampler(_Replicated, Sampler):
     """
     yields batches of indices for performing Truncated Back Propagation Through Time
+
+    in distributed trainings, each process gets `batch_size` whole tracks per batch.
     """
 
     def __init__(self,
@@ -20,31 +74,78 @@ class TBPTTSampler(Sampler):
                  chunk_length=8 * 16000,  # total length of a track
                  seq_len=512,  # nbr of samples per backward pass
                  oversampling=1,
+                 num_replicas=None,
+                 rank=None,
+                 seed=None,
                  ):
         super().__init__(None)
+        self._init_replicas(num_replicas, rank, seed)
         self.n_samples = n_samples
         self.chunk_length = min(chunk_length, n_samples)
         self.seq_len = seq_len
         self.n_chunks = max(1, self.n_samples // self.chunk_length - int(oversampling > 1))
         self.remainder = max(self.n_samples % self.chunk_length, 1)
         self.n_per_chunk = self.chunk_length // self.seq_len
-        self.batch_size = batch_size
         self.oversampling = oversampling
+        self._batch_size = batch_size
+
+    @property
+    def batch_size(self) -> int:
+        n_tracks = self.n_chunks * self.oversampling
+        if n_tracks < self.num_replicas:
+            raise ValueError(f"can not share {n_tracks} tbptt tracks between {self.num_replicas} processes")
+        # with fewer tracks than batch_size, all the tracks make one batch
+        return min(self._batch_size, n_tracks // self.num_replicas)
+
+    def schedule(self) -> torch.Tensor:
+        """start indices of a whole epoch for this process, shape (n_batches, batch_size)"""
+        B, R = self.batch_size, self.num_replicas
+        n_tops = self.oversampling * self.n_chunks // (B * R)
+        g = self.generator()
+        top = torch.randperm(self.n_chunks * self.oversampling, generator=g)[:n_tops * R * B]
+        offsets = torch.randint(0, self.remainder, (n_tops * R * B,), generator=g)
+        # every process keeps its own tracks from start to end
+        top_idx = (offsets + (top % self.n_chunks) * self.chunk_length).view(n_tops, R, B)[:, self.rank]
+        starts = torch.arange(self.n_per_chunk).view(1, -1, 1) * self.seq_len
+        return (top_idx.unsqueeze(1) + starts).view(-1, B)
 
     def __iter__(self):
-        indices = torch.arange(self.n_chunks * self.oversampling)
-        smp = RandomSampler(indices)
-        for top in BatchSampler(smp, self.batch_size, False):
-            # for _ in range(self.oversampling):
-            offsets = torch.randint(0, self.remainder, (self.batch_size,))
-            top_idx = tuple(o + ((t % self.n_chunks) * self.chunk_length)
-                            for t, o in zip(top, offsets))
-            for start in range(self.n_per_chunk):
-                # start indices of the batch
-                yield tuple(t + (start * self.seq_len) for t in top_idx)
+        yield from self.schedule().tolist()
 
     def __len__(self):
-        return (self.oversampling * self.n_chunks // self.batch_size) * self.n_per_chunk
+        return (self.oversampling * self.n_chunks // (self.batch_size * self.num_replicas)) * self.n_per_chunk
+
+
+class RandomBatchSampler(_Replicated, Sampler):
+    """
+    yields shuffled batches of indices in [0, n) (the last one might be smaller)
+
+    in distributed trainings, each process gets `n // num_replicas` distinct indices per epoch.
+    """
+
+    def __init__(self, n, batch_size, num_replicas=None, rank=None, seed=None):
+        super().__init__(None)
+        self._init_replicas(num_replicas, rank, seed)
+        self.n = n
+        self.batch_size = batch_size
+
+    def permutation(self) -> torch.Tensor:
+        """the shuffled indices of this process for the current epoch"""
+        R = self.num_replicas
+        perm = torch.randperm(self.n, generator=self.generator())
+        return perm[self.rank:(self.n // R) * R:R]
+
+    def schedule(self) -> torch.Tensor:
+        """start indices of the full batches of an epoch, shape (n_batches, batch_size)"""
+        perm = self.permutation()
+        n_full = perm.size(0) // self.batch_size
+        return perm[:n_full * self.batch_size].view(n_full, self.batch_size)
+
+    def __iter__(self):
+        yield from self.permutation().split(self.batch_size)
+
+    def __len__(self):
+        return math.ceil((self.n // self.num_replicas) / self.batch_size)
 
 
 class IndicesSampler(Sampler):
@@ -73,9 +174,179 @@ class IndicesSampler(Sampler):
 
     def draw_indices(self, N, indices):
         if isinstance(indices, tuple):
-            return tuple(
-                self.sampling_stride * (torch.randint(self.min_i, self.max_i, (1,)).item() // self.sampling_stride)
-                if i is None else i
-                for i in indices)
+            # draw all the random ones at once
+            drawn = torch.randint(self.min_i, self.max_i, (len(indices),))
+            drawn = (self.sampling_stride * (drawn // self.sampling_stride)).tolist()
+            return tuple(d if i is None else i for i, d in zip(indices, drawn))
         else:
             return torch.randint(self.min_i, self.max_i, (N,))
+
+
+@dtc.dataclass
+class BatchedSlice(h5m.AsSlice):
+    """
+    like `h5m.AsSlice` (along dim 0) but for a whole batch of indices:
+    the slices are cut from a single read of the region covering them when it isn't much larger than the batch.
+    """
+    jitter: int = 0
+    # max ratio between the size of the covering region and the size of the batch for a single read
+    max_overhead: int = 8
+
+    def __call__(self, proxy, item, jitter=0):
+        item = np.asarray(item)
+        if item.ndim == 0:
+            return super(BatchedSlice, self).__call__(proxy, int(item), jitter=jitter)
+        i = item * self.downsampling
+        if self.jitter > 0:
+            i = i + np.random.randint(-self.jitter, self.jitter, i.shape)
+        i = np.clip(i, 0, len(self) * self.downsampling) + self.shift
+        lo, hi = int(i.min()), int(i.max()) + self.length
+        if hi - lo <= self.max_overhead * len(i) * self.length:
+            region = proxy[lo:hi]
+            # !important!: fancy indexing copies, see `h5m.AsSlice`
+            return region[(i - lo)[:, None] + np.arange(self.length)]
+        return np.stack([proxy[j:j + self.length] for j in i])
+
+
+class _RowWise:
+    """apply a per-example transform to each example of a batch"""
+
+    def __init__(self, transform):
+        self.transform = transform
+
+    def __call__(self, batch):
+        return np.stack([self.transform(x) for x in batch])
+
+
+def is_batchable(batch) -> bool:
+    """whether all the inputs of `batch` can be read by `serve_batched`"""
+    items = []
+    h5m.process_batch(batch, lambda x: isinstance(x, h5m.Input), items.append)
+    return all(type(item.getter) is h5m.AsSlice and item.getter.dim == 0 for item in items)
+
+
+def serve_batched(dataset: h5m.TypedFile, batch, sampler: Sampler, sampling_jitter=0, **loader_kwargs):
+    """
+    like `dataset.serve(batch, batch_sampler=sampler, ...)` but every batch of `sampler` is read at once
+    with `BatchedSlice` getters and isn't collated item by item.
+
+    `sampler` is built from the number of items of the dataset if it is a callable.
+    """
+    def batched(item: h5m.Input):
+        getter = item.getter
+        if type(getter) is not h5m.AsSlice or getter.dim != 0:
+            raise TypeError(f"can not read '{type(getter).__qualname__}' by batch")
+        getter = BatchedSlice(dim=0, shift=getter.shift, length=getter.length,
+                              downsampling=getter.downsampling, jitter=sampling_jitter)
+        return h5m.Input(data=item.data, getter=getter,
+                         transform=_RowWise(item.transform) if item.transform is not None else None,
+                         to_tensor=item.to_tensor)
+
+    ds = h5m.ProgrammableDataset(dataset, h5m.process_batch(batch, lambda x: isinstance(x, h5m.Input), batched))
+    if callable(sampler) and not isinstance(sampler, Sampler):
+        sampler = sampler(len(ds))
+    return DataLoader(ds, sampler=sampler, batch_size=None, **loader_kwargs)
+
+
+class InRegions(Sampler):
+    """
+    map the indices of `sampler`, drawn in [0, total length of the `regions`),
+    to the indices of the `regions` (start, stop) as if they were concatenated.
+    """
+
+    def __init__(self, sampler: Sampler, regions: Sequence[Tuple[int, int]]):
+        super().__init__(None)
+        self.sampler = sampler
+        self.regions = regions
+        starts = torch.tensor([r[0] for r in regions])
+        lengths = torch.tensor([r[1] - r[0] for r in regions])
+        self.ends = lengths.cumsum(0)
+        self.shifts = starts - (self.ends - lengths)
+
+    @staticmethod
+    def total_length(regions: Sequence[Tuple[int, int]]) -> int:
+        return sum(stop - start for start, stop in regions)
+
+    def map(self, indices) -> torch.Tensor:
+        indices = torch.as_tensor(indices)
+        r = torch.searchsorted(self.ends, indices, right=True).clamp_max(len(self.ends) - 1)
+        return indices + self.shifts[r]
+
+    def set_epoch(self, epoch: int):
+        if hasattr(self.sampler, "set_epoch"):
+            self.sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        for batch in self.sampler:
+            yield self.map(batch).tolist()
+
+    def __len__(self):
+        return len(self.sampler)
+
+
+class FixedBatchSampler(_Replicated, Sampler):
+    """yields the same batches of `indices` at every epoch, split between the processes of distributed trainings"""
+
+    def __init__(self, indices: Sequence[int], batch_size: int, num_replicas=None, rank=None):
+        super().__init__(None)
+        self._init_replicas(num_replicas, rank)
+        self.batches = torch.as_tensor(indices).split(batch_size)
+
+    def __iter__(self):
+        R = self.num_replicas
+        for batch in self.batches[self.rank:len(self) * R:R]:
+            yield batch.tolist()
+
+    def __len__(self):
+        return len(self.batches) // self.num_replicas
+
+
+def source_regions(proxy) -> Dict[str, Tuple[int, int]]:
+    """(start, stop) of each source of the owner of `proxy` along the first axis of its (concatenated) data"""
+    ds = proxy.handle()[proxy.name]
+    regions = {}
+    for source, i in proxy.owner.index.items():
+        ref = proxy.refs[i]
+        if not ref:
+            continue
+        # see `h5m.Proxy.iset()`
+        start, _, count, block = h5py.h5r.get_region(ref, ds.id).get_regular_hyperslab()
+        regions[source] = int(start[0]), int(start[0] + count[0] * block[0])
+    return regions
+
+
+def split_regions(
+        regions: Dict[str, Tuple[int, int]],
+        fraction: float,
+        by: str = "file",
+) -> Tuple[List[Tuple[int, int]], List[Tuple[int, int]]]:
+    """
+    split `regions` in (train, validation) regions:
+    the last files (at least one) or the last `fraction` of each file are held out.
+    """
+    ordered = sorted(regions.values())
+    if by == "file":
+        n_val = max(1, int(round(fraction * len(ordered))))
+        if n_val >= len(ordered):
+            raise ValueError(f"can not hold out {n_val} of {len(ordered)} files")
+        return ordered[:-n_val], ordered[-n_val:]
+    elif by == "time":
+        bounds = [(start, stop - int(fraction * (stop - start)), stop) for start, stop in ordered]
+        return [(a, b) for a, b, _ in bounds], [(b, c) for _, b, c in bounds if c > b]
+    raise ValueError(f"unknown split '{by}', expected 'file' or 'time'")
+
+
+def item_regions(regions: Sequence[Tuple[int, int]], batch) -> List[Tuple[int, int]]:
+    """the regions of items of `batch` (indices of its getters) whose slices are entirely in `regions`"""
+    getters = []
+    h5m.process_batch(batch, lambda x: isinstance(x, h5m.Input), lambda x: getters.append(x.getter))
+    downsampling = max(getattr(g, "downsampling", 1) for g in getters)
+    shift = min(getattr(g, "shift", 0) for g in getters)
+    extent = max(getattr(g, "shift", 0) + getattr(g, "length", 1) for g in getters)
+    out = []
+    for start, stop in regions:
+        first = max(0, -(-(start - shift) // downsampling))
+        last = (stop - extent) // downsampling + 1
+        if last > first:
+            out += [(first, last)]
+    return out
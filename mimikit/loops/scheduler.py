@@ -0,0 +1,214 @@
+from collections import deque
+from typing import Optional, Any, Dict, Tuple, List, Iterator, Union
+import dataclasses as dtc
+import numpy as np
+import torch
+
+from ..config import Config
+from ..networks.arm import ARM
+from ..utils import default_device
+
+__all__ = [
+    "GenerateScheduler",
+]
+
+
+@dtc.dataclass
+class _Request:
+    id: int
+    # (n_prompt_steps, ...) for each input feature, left-padded to a multiple of rf
+    prompt: Tuple[torch.Tensor, ...]
+    n_steps: int
+    parameters: Dict[str, float]
+
+
+@dtc.dataclass
+class _Slot:
+    request: _Request
+    # index of the next prompt step to teacher-force
+    k: int
+    # buffer position of the first generated step not collected yet (None while prefilling)
+    start: Optional[int] = None
+    n_generated: int = 0
+    chunks: List[List[torch.Tensor]] = dtc.field(default_factory=list)
+
+
+class GenerateScheduler:
+    """
+    continuous batching of independent generation requests.
+
+    The batch has `batch_size` slots which all advance with one clock. Submitted prompts are admitted
+    in the free slots every `network.rf` steps, their state is reset with `network.reset_slots()`
+    and they are teacher-forced through their prompt (at least `rf` steps) before they start generating.
+    Finished requests are retired as soon as they have their `n_steps`, which frees their slot for
+    the next waiting prompt.
+    """
+
+    @dtc.dataclass
+    class Config(Config):
+        batch_size: int = 16
+        # number of steps kept in memory per slot before the outputs are collected
+        buffer_size: int = 4096
+        # default values of the sampling parameters, requests without a value get 1.
+        parameters: Optional[Dict[str, Any]] = None
+        yield_inversed_outputs: bool = True
+        device: Optional[str] = None  # default_device() if None
+
+    def __init__(self, config: "GenerateScheduler.Config", network: ARM):
+        self.config = config
+        self.network = network
+        self.queue = deque()
+        self.slots: List[Optional[_Slot]] = [None] * config.batch_size
+        self.buffers: Optional[Tuple[torch.Tensor, ...]] = None
+        self.parameters: Dict[str, torch.Tensor] = {}
+        self.device = None
+        self._initial_device = None
+        self._was_training = False
+        self._n_submitted = 0
+
+    def submit(self,
+               prompt: Union[torch.Tensor, np.ndarray, Tuple[Union[torch.Tensor, np.ndarray], ...]],
+               n_steps: int,
+               **parameters: float) -> int:
+        """
+        queue a prompt (one `(n_prompt_steps, ...)` array per input feature of the network)
+        and return the id of its request.
+        """
+        if not isinstance(prompt, tuple):
+            prompt = prompt,
+        prompt = tuple(torch.from_numpy(p) if isinstance(p, np.ndarray) else p for p in prompt)
+        rf = self.network.rf
+        n_prompt = prompt[0].size(0)
+        # at least `rf` steps of history and `rf` steps of teacher-forcing, aligned on the clock
+        length = max(-(-n_prompt // rf), 2) * rf
+        prompt = tuple(
+            torch.cat((torch.zeros(length - n_prompt, *p.shape[1:], dtype=p.dtype), p.cpu()))
+            for p in prompt)
+        request = _Request(self._n_submitted, prompt, n_steps,
+                           {k: v for k, v in parameters.items() if k in self.network.generate_params})
+        self._n_submitted += 1
+        self.queue.append(request)
+        return request.id
+
+    def setup(self):
+        net = self.network
+        self._initial_device = net.device
+        self._was_training = net.training
+        net.eval()
+        self.device = self.config.device or default_device()
+        net.to(self.device)
+        torch.set_grad_enabled(False)
+
+    def teardown(self):
+        self.network.to(self._initial_device)
+        self.network.train() if self._was_training else None
+        torch.set_grad_enabled(True)
+
+    def run(self) -> Iterator[Tuple[int, Tuple[torch.Tensor, ...]]]:
+        """
+        generate until no request is waiting or running and yield `(request_id, outputs)`
+        as soon as a request is finished. Requests can be submitted while iterating.
+        """
+        if not self.queue:
+            return
+        self.setup()
+        net, rf = self.network, self.network.rf
+        self._init_buffers(self.queue[0].prompt)
+        net.before_generate(tuple(buf[:, :rf] for buf in self.buffers), torch.arange(self.config.batch_size))
+        t, pos = rf, rf
+        try:
+            while self.queue or any(slot is not None for slot in self.slots):
+                if all(slot is None for slot in self.slots):
+                    # nothing to compute until the next admission
+                    t += -t % rf
+                if t % rf == 0:
+                    self._admit(pos)
+                inputs = tuple(buf[:, pos - rf:pos] for buf in self.buffers)
+                outputs = net.generate_step(inputs, t=t, **self.parameters)
+                if not isinstance(outputs, tuple):
+                    outputs = outputs,
+                n_out = 1
+                for buf, out in zip(self.buffers, outputs):
+                    if out is not None:
+                        n_out = min(out.size(1), buf.size(1) - pos)
+                        buf.data[:, pos:pos + n_out] = out[:, :n_out]
+                self._teacher_force(pos, n_out)
+                t, pos = t + n_out, pos + n_out
+                yield from self._retire(pos)
+                if pos == self.buffers[0].size(1):
+                    pos = self._roll(pos)
+        finally:
+            net.after_generate(tuple(buf.data for buf in self.buffers), torch.arange(self.config.batch_size))
+            self.slots = [None] * self.config.batch_size
+            self.buffers = None
+            self.teardown()
+
+    def _init_buffers(self, prompt: Tuple[torch.Tensor, ...]):
+        B, size = self.config.batch_size, self.network.rf + self.config.buffer_size
+        self.buffers = tuple(
+            torch.zeros(B, size, *p.shape[1:], dtype=p.dtype, device=self.device)
+            for p in prompt)
+        defaults = self.config.parameters or {}
+        self.parameters = {
+            k: torch.full((B,), float(v), device=self.device)
+            for k, v in defaults.items() if k in self.network.generate_params
+        }
+
+    def _admit(self, pos: int):
+        rf = self.network.rf
+        admitted = []
+        for s, slot in enumerate(self.slots):
+            if slot is not None or not self.queue:
+                continue
+            request = self.queue.popleft()
+            for buf, p in zip(self.buffers, request.prompt):
+                buf.data[s, pos - rf:pos] = p[:rf].to(self.device)
+            for k, v in request.parameters.items():
+                if k not in self.parameters:
+                    self.parameters[k] = torch.ones(len(self.slots), device=self.device)
+                self.parameters[k][s] = v
+            self.slots[s] = _Slot(request, k=rf)
+            admitted += [s]
+        if admitted:
+            self.network.reset_slots(torch.tensor(admitted, device=self.device))
+
+    def _teacher_force(self, pos: int, n_out: int):
+        for slot_idx, slot in enumerate(self.slots):
+            if slot is None or slot.start is not None:
+                continue
+            prompt = slot.request.prompt
+            m = min(n_out, prompt[0].size(0) - slot.k)
+            for buf, p in zip(self.buffers, prompt):
+                buf.data[slot_idx, pos:pos + m] = p[slot.k:slot.k + m].to(self.device)
+            slot.k += m
+            if slot.k == prompt[0].size(0):
+                slot.start = pos + m
+
+    def _collect(self, s: int, slot: _Slot, pos: int):
+        n = min(pos - slot.start, slot.request.n_steps - slot.n_generated)
+        slot.chunks += [[buf[s, slot.start:slot.start + n].clone() for buf in self.buffers]]
+        slot.n_generated += n
+
+    def _retire(self, pos: int):
+        for s, slot in enumerate(self.slots):
+            if slot is None or slot.start is None:
+                continue
+            if slot.n_generated + pos - slot.start < slot.request.n_steps:
+                continue
+            self._collect(s, slot, pos)
+            self.slots[s] = None
+            outputs = tuple(torch.cat(chunks).unsqueeze(0) for chunks in zip(*slot.chunks))
+            if self.config.yield_inversed_outputs:
+                features = self.network.config.io_spec.targets
+                outputs = tuple(feature.inv(out) for feature, out in zip(features, outputs))
+            yield slot.request.id, outputs
+
+    def _roll(self, pos: int) -> int:
+        rf = self.network.rf
+        for s, slot in enumerate(self.slots):
+            if slot is not None and slot.start is not None:
+                self._collect(s, slot, pos)
+                slot.start = rf
+        for buf in self.buffers:
+            buf.data[:, :rf] = buf.data[:, pos - rf:pos].clone()
+        return rf
@@ -0,0 +1,396 @@
+"""
+Local generation protocol (all lengths are unsigned 32 bits big endian integers):
+
+    request  := length, header, prompt
+    response := length, header, *(length, block), 0
+
+- headers are utf-8 encoded json objects
+- prompt and blocks are mono float32 little endian PCM at the sample rate of the checkpoint
+- the request header of a generation is {"checkpoint": key, "n_samples": int, "seconds": float, "temperature": float}
+- the request header {"command": "info"} returns the keys and sample rates of the served checkpoints
+"""
+import argparse
+import asyncio
+import json
+import struct
+import dataclasses as dtc
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from typing import Optional, Tuple, Dict, List, AsyncIterator
+
+import numpy as np
+import torch
+
+from ..config import Config
+from ..checkpoint import Checkpoint
+from ..utils import default_device
+from .generate import GenerateLoopV2
+
+__all__ = [
+    "GenerateServer",
+    "GenerateClient",
+    "benchmark",
+]
+
+_LENGTH = struct.Struct(">I")
+
+
+def _pack(header: dict) -> bytes:
+    data = json.dumps(header).encode("utf-8")
+    return _LENGTH.pack(len(data)) + data
+
+
+async def _read_length(reader: asyncio.StreamReader) -> int:
+    return _LENGTH.unpack(await reader.readexactly(_LENGTH.size))[0]
+
+
+async def _read_header(reader: asyncio.StreamReader) -> dict:
+    n = await _read_length(reader)
+    return json.loads((await reader.readexactly(n)).decode("utf-8"))
+
+
+@dtc.dataclass
+class _Request:
+    prompt: np.ndarray
+    seconds: float
+    temperature: Optional[float]
+    # blocks of generated samples, `None` marks the end of the response
+    blocks: asyncio.Queue
+    cancelled: bool = False
+
+
+async def _drain(queue: asyncio.Queue):
+    while (await queue.get()) is not None:
+        continue
+
+
+class _ResidentModel:
+    """a network kept in memory and the queue of the requests waiting for it"""
+
+    def __init__(self, checkpoint: Checkpoint, device: str):
+        self.checkpoint = checkpoint
+        self.network = checkpoint.network.to(device)
+        self.network.eval()
+        self.sr = self.network.config.io_spec.sr
+        self.queue: Optional[asyncio.Queue] = None
+
+
+class GenerateServer:
+    """
+    serve checkpoints over a local socket.
+
+    Networks are loaded once and stay on `device`.
+    Requests for the same checkpoint that arrive within `batch_timeout_ms` of each other
+    are generated together as one batch and their outputs are streamed back block by block.
+    """
+
+    @dtc.dataclass
+    class Config(Config):
+        checkpoints: Tuple[str, ...] = ()
+        host: str = "127.0.0.1"
+        port: int = 8765
+        unix_socket: Optional[str] = None
+        max_batch_size: int = 16
+        batch_timeout_ms: float = 5.
+        block_size: int = 4096
+        max_queued_blocks: int = 8
+        device: Optional[str] = None
+
+    @classmethod
+    def from_config(cls, config: "GenerateServer.Config"):
+        device = config.device or default_device()
+        models = {}
+        for path in config.checkpoints:
+            ck = Checkpoint.from_path(path)
+            models[f"{ck.id}/epoch={ck.epoch}"] = _ResidentModel(ck, device)
+        return cls(config, models, device)
+
+    def __init__(self,
+                 config: "GenerateServer.Config",
+                 models: Dict[str, _ResidentModel],
+                 device: str):
+        self.config = config
+        self.models = models
+        self.device = device
+        self.executor = ThreadPoolExecutor(max_workers=max(1, len(models)))
+        self.server: Optional[asyncio.AbstractServer] = None
+        self._batchers: List[asyncio.Task] = []
+
+    async def start(self):
+        for model in self.models.values():
+            model.queue = asyncio.Queue()
+            self._batchers += [asyncio.ensure_future(self._batcher(model))]
+        if self.config.unix_socket is not None:
+            self.server = await asyncio.start_unix_server(self._handle, path=self.config.unix_socket)
+        else:
+            self.server = await asyncio.start_server(self._handle, self.config.host, self.config.port)
+        return self
+
+    async def stop(self):
+        for task in self._batchers:
+            task.cancel()
+        self._batchers = []
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.stop()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        request = None
+        try:
+            header = await _read_header(reader)
+            if header.get("command") == "info":
+                writer.write(_pack({"status": "ok",
+                                    "checkpoints": {k: m.sr for k, m in self.models.items()}}))
+                return
+            model = self.models.get(header.get("checkpoint"), None)
+            if model is None:
+                writer.write(_pack({"status": "error",
+                                    "message": f"unknown checkpoint '{header.get('checkpoint')}'"}))
+                return
+            data = await reader.readexactly(int(header["n_samples"]) * 4)
+            request = _Request(
+                prompt=np.frombuffer(data, dtype="<f4").astype(np.float32),
+                seconds=float(header.get("seconds", 1.)),
+                temperature=header.get("temperature", None),
+                blocks=asyncio.Queue(maxsize=self.config.max_queued_blocks)
+            )
+            await model.queue.put(request)
+            writer.write(_pack({"status": "ok", "sr": model.sr}))
+            while True:
+                block = await request.blocks.get()
+                if block is None:
+                    break
+                data = block.astype("<f4").tobytes()
+                writer.write(_LENGTH.pack(len(data)) + data)
+                await writer.drain()
+            writer.write(_LENGTH.pack(0))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            if request is not None:
+                # the client is gone: unblock the generation
+                request.cancelled = True
+                asyncio.ensure_future(_drain(request.blocks))
+        finally:
+            try:
+                await writer.drain()
+                writer.close()
+            except ConnectionError:
+                pass
+
+    async def _batcher(self, model: _ResidentModel):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = [await model.queue.get()]
+            deadline = loop.time() + self.config.batch_timeout_ms / 1000
+            while len(requests) < self.config.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    requests += [await asyncio.wait_for(model.queue.get(), timeout)]
+                except asyncio.TimeoutError:
+                    break
+            await loop.run_in_executor(self.executor, self._generate, model, requests, loop)
+
+    def _generate(self, model: _ResidentModel, requests: List[_Request], loop: asyncio.AbstractEventLoop):
+        """runs in the executor and pushes the blocks of each request to its queue (blocking = backpressure)"""
+
+        def put(request, block):
+            if not request.cancelled or block is None:
+                asyncio.run_coroutine_threadsafe(request.blocks.put(block), loop).result()
+
+        net, sr = model.network, model.sr
+        n_wanted = [int(r.seconds * sr) for r in requests]
+        n_sent = [0] * len(requests)
+        try:
+            # prompts are left-padded to the longest one
+            length = max(r.prompt.shape[0] for r in requests)
+            prompt = torch.zeros(len(requests), length)
+            for i, r in enumerate(requests):
+                prompt[i, length - r.prompt.shape[0]:] = torch.from_numpy(r.prompt)
+            prompt = tuple(spec.transform(prompt) for spec in net.config.io_spec.inputs)
+            temperature = [1. if r.temperature is None else r.temperature for r in requests]
+            cfg = GenerateLoopV2.Config(
+                output_duration_sec=max(r.seconds for r in requests),
+                parameters=dict(temperature=temperature),
+                display_waveform=False,
+                write_waveform=False,
+                yield_inversed_outputs=True,
+                device=self.device
+            )
+            gen_loop = GenerateLoopV2(
+                cfg, network=net,
+                n_steps=GenerateLoopV2.get_n_steps(cfg, net),
+                dataloader=[[torch.arange(len(requests)), *prompt]],
+                logger=None
+            )
+            stream = gen_loop.stream(self.config.block_size)
+            try:
+                for blocks in stream:
+                    audio = blocks[0].detach().cpu().numpy()
+                    for i, r in enumerate(requests):
+                        n = min(audio.shape[1], n_wanted[i] - n_sent[i])
+                        if n > 0:
+                            put(r, audio[i, :n])
+                            n_sent[i] += n
+                    if all(s >= w or r.cancelled for s, w, r in zip(n_sent, n_wanted, requests)):
+                        break
+            finally:
+                stream.close()
+        finally:
+            for r in requests:
+                put(r, None)
+
+
+class GenerateClient:
+    """talks to a `GenerateServer`"""
+
+    def __init__(self,
+                 host: str = "127.0.0.1",
+                 port: int = 8765,
+                 unix_socket: Optional[str] = None):
+        self.host = host
+        self.port = port
+        self.unix_socket = unix_socket
+
+    async def _connect(self):
+        if self.unix_socket is not None:
+            return await asyncio.open_unix_connection(self.unix_socket)
+        return await asyncio.open_connection(self.host, self.port)
+
+    async def info(self) -> Dict[str, int]:
+        reader, writer = await self._connect()
+        try:
+            writer.write(_pack({"command": "info"}))
+            await writer.drain()
+            return (await _read_header(reader))["checkpoints"]
+        finally:
+            writer.close()
+
+    async def generate(self,
+                       checkpoint: str,
+                       prompt: np.ndarray,
+                       seconds: float = 1.,
+                       temperature: Optional[float] = None
+                       ) -> AsyncIterator[np.ndarray]:
+        """yields the generated samples block by block"""
+        prompt = np.asarray(prompt, dtype="<f4").reshape(-1)
+        reader, writer = await self._connect()
+        try:
+            writer.write(_pack({"checkpoint": checkpoint, "n_samples": prompt.shape[0],
+                                "seconds": seconds, "temperature": temperature})
+                         + prompt.tobytes())
+            await writer.drain()
+            header = await _read_header(reader)
+            if header["status"] != "ok":
+                raise RuntimeError(header.get("message", "generation failed"))
+            while True:
+                n = await _read_length(reader)
+                if n == 0:
+                    break
+                yield np.frombuffer(await reader.readexactly(n), dtype="<f4")
+        finally:
+            writer.close()
+
+    def generate_sync(self,
+                      checkpoint: str,
+                      prompt: np.ndarray,
+                      seconds: float = 1.,
+                      temperature: Optional[float] = None
+                      ) -> np.ndarray:
+        async def collect():
+            return [b async for b in self.generate(checkpoint, prompt, seconds, temperature)]
+        blocks = asyncio.run(collect())
+        return np.concatenate(blocks) if blocks else np.zeros(0, dtype=np.float32)
+
+
+async def benchmark(client: GenerateClient,
+                    checkpoint: str,
+                    prompt: np.ndarray,
+                    seconds: float = 1.,
+                    temperature: Optional[float] = 1.,
+                    n_requests: int = 16,
+                    concurrency: int = 4,
+                    ) -> Dict[str, float]:
+    """
+    send `n_requests` requests, `concurrency` at a time, and measure
+    the latency to the first block and the overall throughput in generated samples per second
+    """
+    sr = (await client.info())[checkpoint]
+    semaphore = asyncio.Semaphore(concurrency)
+    first_block, totals, n_samples = [], [], []
+
+    async def one_request():
+        async with semaphore:
+            start, n, first = perf_counter(), 0, None
+            async for block in client.generate(checkpoint, prompt, seconds, temperature):
+                if first is None:
+                    first = perf_counter() - start
+                n += block.shape[0]
+            first_block.append(first if first is not None else float("nan"))
+            totals.append(perf_counter() - start)
+            n_samples.append(n)
+
+    start = perf_counter()
+    await asyncio.gather(*(one_request() for _ in range(n_requests)))
+    wall = perf_counter() - start
+    return dict(
+        n_requests=n_requests,
+        concurrency=concurrency,
+        mean_first_block_latency_sec=float(np.mean(first_block)),
+        max_first_block_latency_sec=float(np.max(first_block)),
+        mean_request_sec=float(np.mean(totals)),
+        samples_per_sec=sum(n_samples) / wall,
+        realtime_factor=sum(n_samples) / wall / sr,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="serve mimikit checkpoints over a local socket")
+    parser.add_argument("checkpoints", nargs="+", help="paths to .ckpt files")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix-socket", default=None)
+    parser.add_argument("--max-batch-size", type=int, default=16)
+    parser.add_argument("--batch-timeout-ms", type=float, default=5.)
+    parser.add_argument("--block-size", type=int, default=4096)
+    parser.add_argument("--device", default=None)
+    args = parser.parse_args()
+    server = GenerateServer.from_config(GenerateServer.Config(
+        checkpoints=tuple(args.checkpoints), host=args.host, port=args.port,
+        unix_socket=args.unix_socket, max_batch_size=args.max_batch_size,
+        batch_timeout_ms=args.batch_timeout_ms, block_size=args.block_size, device=args.device
+    ))
+    print("serving:", *server.models.keys())
+    asyncio.run(server.serve_forever())
+
+
+def benchmark_main():
+    parser = argparse.ArgumentParser(description="measure the latency and throughput of a generation server")
+    parser.add_argument("checkpoint", help="key of a served checkpoint, e.g. 'a1b2c3d4/epoch=10'")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix-socket", default=None)
+    parser.add_argument("--prompt-sec", type=float, default=.5)
+    parser.add_argument("--seconds", type=float, default=1.)
+    parser.add_argument("--temperature", type=float, default=1.)
+    parser.add_argument("--n-requests", type=int, default=16)
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+    client = GenerateClient(args.host, args.port, args.unix_socket)
+
+    async def run():
+        sr = (await client.info())[args.checkpoint]
+        prompt = (np.random.rand(int(args.prompt_sec * sr)) * 2 - 1).astype(np.float32)
+        return await benchmark(client, args.checkpoint, prompt, args.seconds, args.temperature,
+                               args.n_requests, args.concurrency)
+
+    for k, v in asyncio.run(run()).items():
+        print(f"{k}: {v}")
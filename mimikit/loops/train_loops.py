@@ -1,30 +1,40 @@
 import dataclasses as dtc
 import hashlib
-from typing import Optional, Tuple, Dict
+import time
+from copy import deepcopy
+from functools import partial
+from typing import Optional, Tuple, Dict, List
 
 import torch
 from pytorch_lightning import LightningModule, Trainer
 import os
 
 from torch.optim import Adam
+from torch.utils.data import DataLoader, Sampler
+from pytorch_lightning.strategies import DDPStrategy
 
 import h5mapper as h5m
 from .beta_scheduler import BetaScheduler
 
 from .logger import LoggingHooks
-from .callbacks import EpochProgressBarCallback, GenerateCallback, MMKCheckpoint, TrainingProgressBar, is_notebook
-from .samplers import TBPTTSampler
+from .callbacks import EpochProgressBarCallback, GenerateCallback, MMKCheckpoint, TrainingProgressBar, is_notebook, \
+    EMACallback
+from .samplers import TBPTTSampler, RandomBatchSampler, InRegions, FixedBatchSampler, \
+    is_batchable, serve_batched, source_regions, split_regions, item_regions
 from .generate import GenerateLoopV2, EncodeDecodeLoop
-from ..utils import default_device
+from .loader_tuning import autotune_loader
+from .profiling import StageTimer, ProfilerCallback
+from ..utils import default_device, available_cpus
 from ..features.dataset import DatasetConfig
 from ..features.item_spec import ItemSpec
-from ..networks.arm import ARM, NetworkConfig
+from ..networks.arm import ARM, ARMWithHidden, NetworkConfig
 from ..config import Config
 
 __all__ = [
     "TrainARMConfig",
     "ARMHP",
-    "TrainARMLoop"
+    "TrainARMLoop",
+    "benchmark_precision",
 ]
 
 
@@ -38,6 +48,28 @@ class TrainARMConfig(Config):
     sampling_jitter: int = 0
     shift_error: int = 0
     tbptt_chunk_length: Optional[int] = None
+    # split batches in slices of this size and accumulate their gradients (one hidden state per slice)
+    micro_batch_size: Optional[int] = None
+    num_workers: Optional[int] = None  # min(batch_size, available cpus - 1) if None
+    prefetch_factor: int = 2
+    pin_memory: Optional[bool] = None  # True with cuda if None
+    # time a few loader configurations before training and keep the fastest (see `autotune_loader`)
+    autotune_loader: bool = False
+
+    # hold out a fraction of the dataset for a teacher-forced evaluation:
+    # the last files of the index ("file") or the end of each file ("time")
+    val_split: Optional[float] = None
+    val_split_by: str = "file"
+    val_every_n_steps: Optional[int] = None  # at the end of every epoch if None
+    val_batch_size: Optional[int] = None  # 4 x batch_size if None
+    limit_val_batches: Optional[int] = None
+
+    # curriculum: ((start, batch_length), ...) trains with `batch_length` from `start` on (epochs or steps,
+    # see `schedule_unit`) and scales batch_size to keep batch_size x batch_length roughly constant.
+    # Step boundaries take effect at the start of the next epoch.
+    batch_length_schedule: Optional[Tuple[Tuple[int, int], ...]] = None
+    schedule_unit: str = "epoch"
+    max_batch_size: Optional[int] = None
 
     max_epochs: int = 2
     limit_train_batches: Optional[int] = None
@@ -47,6 +79,13 @@ class TrainARMConfig(Config):
     final_div_factor: float = 1.
     pct_start: float = 0.
     cycle_momentum: bool = False
+    # lightning's precision: "32-true", "16-mixed" (with grad scaling, bf16 on cpu) or "bf16-mixed"
+    precision: str = "32-true"
+    # distributed data parallel: "ddp", "ddp_spawn", "ddp_fork" or "ddp_notebook" (None for a single process)
+    strategy: Optional[str] = None
+    devices: Optional[int] = None  # number of gpus (or of cpu processes with a ddp strategy)
+    num_nodes: int = 1
+    process_group_backend: Optional[str] = None  # "nccl" with cuda, "gloo" otherwise if None
 
     CHECKPOINT_TRAINING: bool = True
 
@@ -54,11 +93,27 @@ class TrainARMConfig(Config):
     OUTPUT_TRAINING: str = ''
 
     save_optimizer: bool = False
+    # write checkpoints in a background thread
+    async_checkpoint: bool = True
+    # retention: keep only the last ones and/or the best ones by their epoch average of `checkpoint_monitor`
+    keep_last_checkpoints: Optional[int] = None
+    keep_best_checkpoints: Optional[int] = None
+    checkpoint_monitor: Optional[str] = None  # "val_loss" with a validation split, "loss" otherwise if None
+    # exponential moving average of the weights, saved as the checkpoints of id "ema" and used for generating
+    ema_decay: Optional[float] = None
+    ema_start_step: int = 0
     every_n_epochs: int = 2
     n_examples: int = 3
     prompt_length_sec: float = .5
     outputs_duration_sec: float = 1.
     temperature: Optional[Tuple[float, ...]] = None
+    # generate in a background thread on a snapshot of the weights (on `generate_device`, cpu if None)
+    async_generate: bool = True
+    generate_device: Optional[str] = None
+    # time the stages of the training steps and report the throughput (slows the training down with cuda)
+    profile: bool = False
+    # (first, last) training steps exported to `<root_dir>/trace.json` as a chrome trace
+    profile_trace_steps: Optional[Tuple[int, int]] = None
     trainer_kwargs: Dict = dtc.field(default_factory=dict)
 
 
@@ -85,6 +140,32 @@ class TrainARMLoop(LoggingHooks,
         filename_template = os.path.join(output_dir, "epoch{epoch}_prm{prompt_idx}.mp3")
         return root_dir, hash_, filename_template
 
+    @classmethod
+    def get_split(cls,
+                  dataset: h5m.TypedFile,
+                  cfg: TrainARMConfig
+                  ) -> Tuple[Optional[List[Tuple[int, int]]], Optional[List[Tuple[int, int]]]]:
+        """(train, validation) regions of the signal if `cfg.val_split` else (None, None)"""
+        if not cfg.val_split:
+            return None, None
+        # TODO: get rid of '.signal' assumption
+        return split_regions(source_regions(dataset.signal), cfg.val_split, by=cfg.val_split_by)
+
+    @classmethod
+    def get_loader_kwargs(cls, cfg: TrainARMConfig) -> Dict:
+        if cfg.num_workers is None:
+            # leave one cpu for the training process
+            n_workers = max(0, min(cfg.batch_size, available_cpus() - 1))
+        else:
+            n_workers = cfg.num_workers
+        pin_memory = torch.cuda.is_available() if cfg.pin_memory is None else cfg.pin_memory
+        return dict(
+            num_workers=n_workers,
+            prefetch_factor=cfg.prefetch_factor if n_workers > 0 else None,
+            pin_memory=pin_memory,
+            persistent_workers=n_workers > 0,
+        )
+
     @classmethod
     def get_dataloader(cls,
                        dataset: h5m.TypedFile,
@@ -93,42 +174,138 @@ class TrainARMLoop(LoggingHooks,
         user_spec = ItemSpec(shift=0, length=cfg.batch_length,
                              stride=cfg.downsampling, unit=net.config.io_spec.unit)
         batch = net.train_batch(user_spec)
+        regions, _ = cls.get_split(dataset, cfg)
+        if regions is not None:
+            regions = item_regions(regions, batch)
 
         if cfg.tbptt_chunk_length is not None:
             # feature MUST be in time domain
             seq_len = cfg.batch_length
             chunk_length = cfg.tbptt_chunk_length
             # TODO: get rid of '.signal' assumption
-            N = dataset.signal.shape[0]
-            loader_kwargs = dict(
-                batch_sampler=TBPTTSampler(
-                    N,
-                    batch_size=cfg.batch_size,
-                    chunk_length=chunk_length,
-                    seq_len=seq_len,
-                    oversampling=cfg.oversampling
-                )
+            N = dataset.signal.shape[0] if regions is None else InRegions.total_length(regions)
+            sampler = TBPTTSampler(
+                N,
+                batch_size=cfg.batch_size,
+                chunk_length=chunk_length,
+                seq_len=seq_len,
+                oversampling=cfg.oversampling
             )
+        elif regions is not None:
+            sampler = RandomBatchSampler(InRegions.total_length(regions), batch_size=cfg.batch_size)
         else:
-            loader_kwargs = dict(batch_size=cfg.batch_size, shuffle=True)
-        n_workers = max(os.cpu_count(), min(cfg.batch_size, os.cpu_count()))
-        with_cuda = torch.cuda.is_available()
-        return dataset.serve(batch,
-                             sampling_jitter=cfg.sampling_jitter,
-                             num_workers=n_workers,
-                             prefetch_factor=2,
-                             pin_memory=with_cuda,
-                             persistent_workers=True,
-                             **loader_kwargs
-                             )
+            sampler = partial(RandomBatchSampler, batch_size=cfg.batch_size)
+        if regions is not None:
+            # samplers draw in the concatenated training regions
+            sampler = InRegions(sampler, regions)
+        loader_kwargs = cls.get_loader_kwargs(cfg)
+        if is_batchable(batch):
+            # one read per batch
+            return serve_batched(dataset, batch, sampler, sampling_jitter=cfg.sampling_jitter, **loader_kwargs)
+        ds = h5m.ProgrammableDataset(dataset, batch, sampling_jitter=cfg.sampling_jitter)
+        if not isinstance(sampler, Sampler):
+            sampler = sampler(len(ds))
+        # the samplers shard the batches between the processes of distributed trainings
+        return DataLoader(ds, batch_sampler=sampler, **loader_kwargs)
 
     @classmethod
-    def get_lr_scheduler(cls, net, opt, dl, cfg: TrainARMConfig):
-        steps_per_epoch = min(len(dl), cfg.limit_train_batches) if cfg.limit_train_batches is not None else len(dl)
+    def get_val_dataloader(cls,
+                           dataset: h5m.TypedFile,
+                           net: ARM,
+                           cfg: TrainARMConfig):
+        """non-overlapping items of the validation regions in a fixed random order (None without `cfg.val_split`)"""
+        _, regions = cls.get_split(dataset, cfg)
+        if regions is None:
+            return None
+        user_spec = ItemSpec(shift=0, length=cfg.batch_length,
+                             stride=cfg.downsampling, unit=net.config.io_spec.unit)
+        batch = net.train_batch(user_spec)
+        regions = item_regions(regions, batch)
+        getters = []
+        h5m.process_batch(batch, lambda x: isinstance(x, h5m.Input), lambda x: getters.append(x.getter))
+        length = max(getattr(g, "length", 1) for g in getters)
+        step = max(1, length // max(getattr(g, "downsampling", 1) for g in getters))
+        indices = torch.cat([torch.arange(start, stop, step) for start, stop in regions])
+        indices = indices[torch.randperm(len(indices), generator=torch.Generator().manual_seed(0))]
+        sampler = FixedBatchSampler(indices, cfg.val_batch_size or 4 * cfg.batch_size)
+        loader_kwargs = cls.get_loader_kwargs(cfg)
+        if is_batchable(batch):
+            return serve_batched(dataset, batch, sampler, **loader_kwargs)
+        return DataLoader(h5m.ProgrammableDataset(dataset, batch), batch_sampler=sampler, **loader_kwargs)
+
+    @classmethod
+    def config_at(cls, cfg: TrainARMConfig, epoch: int, step: int) -> TrainARMConfig:
+        """`cfg` with the batch length and batch size scheduled for `epoch` (starting at `step`)"""
+        if not cfg.batch_length_schedule:
+            return cfg
+        t = epoch if cfg.schedule_unit == "epoch" else step
+        started = [length for start, length in sorted(cfg.batch_length_schedule, key=lambda x: x[0]) if start <= t]
+        if not started:
+            return cfg
+        length = started[-1]
+        # same number of time steps per batch
+        batch_size = max(1, round(cfg.batch_size * cfg.batch_length / length))
+        if cfg.max_batch_size is not None:
+            batch_size = min(batch_size, cfg.max_batch_size)
+        return dtc.replace(cfg, batch_length=length, batch_size=batch_size)
+
+    @classmethod
+    def get_total_steps(cls, dataset: h5m.TypedFile, net: ARM, cfg: TrainARMConfig) -> Optional[int]:
+        """number of training steps of a scheduled curriculum (None without a schedule)"""
+        if not cfg.batch_length_schedule:
+            return None
+        step, lengths = 0, {}
+        for epoch in range(cfg.max_epochs):
+            stage = cls.config_at(cfg, epoch, step)
+            key = stage.batch_length, stage.batch_size
+            if key not in lengths:
+                lengths[key] = len(cls.get_dataloader(dataset, net, stage))
+            n = lengths[key]
+            step += min(n, cfg.limit_train_batches) if cfg.limit_train_batches is not None else n
+        return step
+
+    @classmethod
+    def get_precision(cls, cfg: TrainARMConfig) -> str:
+        if cfg.precision.startswith("16") and not torch.cuda.is_available():
+            # fp16 autocast is cuda only
+            return "bf16-mixed"
+        return cfg.precision
+
+    @classmethod
+    def get_strategy(cls, cfg: TrainARMConfig):
+        if cfg.strategy is None:
+            return "auto"
+        start_methods = dict(ddp="popen", ddp_spawn="spawn", ddp_fork="fork", ddp_notebook="fork")
+        if cfg.strategy not in start_methods:
+            return cfg.strategy
+        backend = cfg.process_group_backend or ("nccl" if torch.cuda.is_available() else "gloo")
+        return DDPStrategy(start_method=start_methods[cfg.strategy], process_group_backend=backend)
+
+    @classmethod
+    def get_devices(cls, cfg: TrainARMConfig) -> int:
+        if cfg.devices is not None:
+            return cfg.devices
+        return torch.cuda.device_count() if torch.cuda.is_available() else 1
+
+    @classmethod
+    def get_val_kwargs(cls, cfg: TrainARMConfig) -> Dict:
+        kwargs = {}
+        if cfg.val_every_n_steps is not None:
+            kwargs.update(val_check_interval=cfg.val_every_n_steps, check_val_every_n_epoch=None)
+        if cfg.limit_val_batches is not None:
+            kwargs.update(limit_val_batches=cfg.limit_val_batches)
+        return kwargs
+
+    @classmethod
+    def get_lr_scheduler(cls, net, opt, dl, cfg: TrainARMConfig, total_steps: Optional[int] = None):
+        if total_steps is None:
+            steps_per_epoch = min(len(dl), cfg.limit_train_batches) if cfg.limit_train_batches is not None else len(dl)
+            steps = dict(steps_per_epoch=steps_per_epoch, epochs=cfg.max_epochs)
+        else:
+            steps = dict(total_steps=total_steps)
         sched = torch.optim.lr_scheduler.OneCycleLR(
             opt,
-            steps_per_epoch=steps_per_epoch,
-            epochs=cfg.max_epochs,
+            **steps,
             max_lr=cfg.max_lr,
             div_factor=cfg.div_factor,
             final_div_factor=cfg.final_div_factor,
@@ -153,9 +330,9 @@ class TrainARMLoop(LoggingHooks,
         return {"scheduler": beta_sched, "interval": "step", "frequency": 1}
 
     @classmethod
-    def get_optimizer(cls, net, dl, cfg: TrainARMConfig):
+    def get_optimizer(cls, net, dl, cfg: TrainARMConfig, total_steps: Optional[int] = None):
         opt = Adam(net.parameters(), lr=cfg.max_lr, betas=cfg.betas)
-        sched = cls.get_lr_scheduler(net, opt, dl, cfg)
+        sched = cls.get_lr_scheduler(net, opt, dl, cfg, total_steps=total_steps)
         return [opt], [sched]
 
     def reset_lr_scheduler(self, max_lr=None, div_factor=None, final_div_factor=None, pct_start=None):
@@ -186,10 +363,19 @@ class TrainARMLoop(LoggingHooks,
                       cfg: TrainARMConfig):
 
         callbacks = []
+        ema = None
+        if cfg.ema_decay is not None:
+            ema = EMACallback(decay=cfg.ema_decay, start_step=cfg.ema_start_step)
+            callbacks += [ema]
 
         if cfg.CHECKPOINT_TRAINING:
             callbacks += [
-                MMKCheckpoint(epochs=cfg.every_n_epochs, root_dir=root_dir)
+                MMKCheckpoint(epochs=cfg.every_n_epochs, root_dir=root_dir,
+                              asynchronous=cfg.async_checkpoint,
+                              keep_last=cfg.keep_last_checkpoints,
+                              keep_best=cfg.keep_best_checkpoints,
+                              monitor=cfg.checkpoint_monitor or ("val_loss" if cfg.val_split else "loss"),
+                              ema=ema)
             ]
         if cfg.MONITOR_TRAINING or cfg.OUTPUT_TRAINING:
             if isinstance(net, ARM):
@@ -225,6 +411,9 @@ class TrainARMLoop(LoggingHooks,
                 GenerateCallback(
                     generate_loop=gen_loop,
                     every_n_epochs=cfg.every_n_epochs,
+                    asynchronous=cfg.async_generate,
+                    device=cfg.generate_device,
+                    ema=ema,
                 )]
 
             gen_loop.plot_audios = gen_loop.play_audios = cfg.MONITOR_TRAINING
@@ -233,7 +422,7 @@ class TrainARMLoop(LoggingHooks,
 
     @classmethod
     def from_config(cls, train_cfg: TrainARMConfig, dataset, network: ARM, opt=None):
-        dataloader = cls.get_dataloader(dataset, network, train_cfg)
+        dataloader = cls.get_dataloader(dataset, network, cls.config_at(train_cfg, 0, 0))
         if not hasattr(dataset, "config"):
             ds_cfg = DatasetConfig(
                 filename=dataset.filename,
@@ -243,20 +432,21 @@ class TrainARMLoop(LoggingHooks,
             ds_cfg = dataset.config
         hp = ARMHP(training=train_cfg, network=network.config, dataset=ds_cfg)
         return cls(hp, dataset, dataloader, network,
-                   network.config.io_spec.loss_fn, opt)
+                   network.loss_fn, opt)
 
     @classmethod
     def from_checkpoint(cls, checkpoint: "Checkpoint"):
         dataset, network = checkpoint.dataset, checkpoint.network
         train_cfg = checkpoint.training_config
         optimizer_state = checkpoint.optimizer_state
-        dataloader = cls.get_dataloader(dataset, network, train_cfg)
-        opt = cls.get_optimizer(network, dataloader, train_cfg)
+        dataloader = cls.get_dataloader(dataset, network, cls.config_at(train_cfg, 0, 0))
+        opt = cls.get_optimizer(network, dataloader, train_cfg,
+                                total_steps=cls.get_total_steps(dataset, network, train_cfg))
         if optimizer_state is not None:
             opt[0][0].load_state_dict(optimizer_state)
         loop = cls(ARMHP(training=train_cfg, network=network.config, dataset=dataset.config),
                    dataset, dataloader, network,
-                   network.config.io_spec.loss_fn, opt)
+                   network.loss_fn, opt)
         loop.trainer_state = checkpoint.trainer_state
         return loop
 
@@ -278,36 +468,121 @@ class TrainARMLoop(LoggingHooks,
         self.root_dir, self.hash_, self.output_template = self.get_os_paths(hp)
         self.dataset = dataset
         self.loader = loader
+        self.val_loader = self.get_val_dataloader(dataset, net, hp.training)
+        self._train_hidden = None
         self.loss_fn = loss_fn
-        self.tbptt_len = self.train_cfg.tbptt_chunk_length
-        if self.tbptt_len is not None:
-            self.tbptt_len //= self.train_cfg.batch_length
+        self.stage_cfg = self.config_at(self.train_cfg, 0, 0)
+        self.tbptt_len = self.get_tbptt_len(self.stage_cfg)
         self.net = net
+        mb = self.train_cfg.micro_batch_size
+        # scheduled batch sizes can grow beyond micro_batch_size
+        self.micro_batching = mb is not None and (mb < self.train_cfg.batch_size
+                                                  or bool(self.train_cfg.batch_length_schedule))
+        if self.micro_batching:
+            self.automatic_optimization = False
+        # hidden states of the micro-batches
+        self._micro_hidden = None
         self.callbacks = self.get_callbacks(
             self.net, self.dataset, self.root_dir, self.output_template,
             self.train_cfg
         )
         self.opt = opt
         self.trainer_state = None
+        self.timer = StageTimer(enabled=self.train_cfg.profile, cuda_sync=torch.cuda.is_available())
+
+    @staticmethod
+    def get_tbptt_len(cfg: TrainARMConfig) -> Optional[int]:
+        """number of batches per tbptt chunk"""
+        if cfg.tbptt_chunk_length is None:
+            return None
+        return cfg.tbptt_chunk_length // cfg.batch_length
 
     def configure_optimizers(self):
         if self.opt is None:
-            self.opt = self.get_optimizer(self.net, self.loader, self.config.training)
+            self.opt = self.get_optimizer(self.net, self.loader, self.config.training,
+                                          total_steps=self.get_total_steps(self.dataset, self.net, self.train_cfg))
         return self.opt
 
     def train_dataloader(self):
+        stage = self.config_at(self.train_cfg, self.current_epoch, self.global_step)
+        if stage != self.stage_cfg:
+            # next stage of the curriculum: only the loader changes
+            if getattr(self.loader, "_iterator", None) is not None:
+                self.loader._iterator._shutdown_workers()
+            self.loader = self.get_dataloader(self.dataset, self.net, stage)
+            self.stage_cfg = stage
+            self.tbptt_len = self.get_tbptt_len(stage)
+            self._micro_hidden = None
+            self.print(f"batch_length={stage.batch_length}, batch_size={stage.batch_size}")
         return self.loader
 
     def on_train_batch_start(self, batch, batch_idx):
         if self.tbptt_len is not None and (batch_idx % self.tbptt_len) == 0:
             self.net.reset_hidden()
+            self._micro_hidden = None
+
+    def on_before_batch_transfer(self, batch, dataloader_idx):
+        self.timer.stop("data")
+        self.timer.start("transfer")
+        return batch
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        self.timer.stop("transfer")
+        return batch
+
+    def on_before_backward(self, loss: torch.Tensor) -> None:
+        super(TrainARMLoop, self).on_before_backward(loss)
+        self.timer.start("backward")
+
+    def on_after_backward(self) -> None:
+        self.timer.stop("backward")
+
+    def on_before_optimizer_step(self, optimizer) -> None:
+        self.timer.start("optimizer")
 
     def training_step(self, batch, batch_idx):
+        if self.micro_batching:
+            return self.micro_batches_step(batch, batch_idx)
         batch, target = batch
-        output = self.net.forward(batch)
+        with self.timer("forward"):
+            output = self.net.forward(batch)
         if not isinstance(output, tuple):
             output = output,
-        return self.loss_fn(output, target)
+        with self.timer("loss"):
+            return self.loss_fn(output, target)
+
+    def micro_batches_step(self, batch, batch_idx):
+        """accumulate the gradients of slices of `micro_batch_size` examples and make one optimizer step"""
+        batch, target = batch
+        net, mb = self.net, self.train_cfg.micro_batch_size
+        B = batch[0].size(0)
+        slices = [slice(i, i + mb) for i in range(0, B, mb)]
+        with_hidden = isinstance(net, ARMWithHidden)
+        if self._micro_hidden is None or len(self._micro_hidden) != len(slices):
+            self._micro_hidden = [None] * len(slices)
+        opt = self.optimizers()
+        opt.zero_grad()
+        out = {}
+        for k, slc in enumerate(slices):
+            if with_hidden:
+                net.reset_hidden() if self._micro_hidden[k] is None else net.set_hidden(self._micro_hidden[k])
+            with self.timer("forward"):
+                output = net.forward(tuple(x[slc] for x in batch))
+            if not isinstance(output, tuple):
+                output = output,
+            with self.timer("loss"):
+                L = self.loss_fn(output, tuple(t[slc] for t in target))
+            weight = output[0].size(0) / B
+            self.manual_backward(L["loss"] * weight)
+            if with_hidden:
+                self._micro_hidden[k] = net.get_hidden()
+            for key, v in L.items():
+                out[key] = out.get(key, 0.) + v.detach() * weight
+        opt.step()
+        sched = self.lr_schedulers()
+        if sched is not None:
+            sched.step()
+        return out
 
     def training_step_(self, batch, batch_idx):
         batch, target = batch
@@ -321,6 +596,26 @@ class TrainARMLoop(LoggingHooks,
             batch = (output[0].detach(),)
         return L
 
+    def validation_step(self, batch, batch_idx):
+        """teacher-forced losses of a validation batch, prefixed with 'val_'"""
+        batch, target = batch
+        if isinstance(self.net, ARMWithHidden):
+            self.net.reset_hidden()
+        # in training mode, the networks output what the losses expect
+        self.net.train()
+        output = self.net.forward(batch)
+        if not isinstance(output, tuple):
+            output = output,
+        return {f"val_{k}": v for k, v in self.loss_fn(output, target).items()}
+
+    def on_validation_start(self):
+        self._train_hidden = self.net.get_hidden() if isinstance(self.net, ARMWithHidden) else None
+
+    def on_validation_end(self):
+        if self._train_hidden is not None:
+            self.net.set_hidden(self._train_hidden)
+            self._train_hidden = None
+
     def on_train_epoch_end(self, *args):
         super(TrainARMLoop, self).on_train_epoch_end(*args)
 
@@ -331,25 +626,37 @@ class TrainARMLoop(LoggingHooks,
         print("*" * 64)
         print("training's id is:", self.hash_)
         print("*" * 64)
+        if self.train_cfg.autotune_loader:
+            self.tune_loader()
         epochs_bar = [EpochProgressBarCallback()] if is_notebook() else ()
+        callbacks = self.timer.wrap_callbacks([*epochs_bar, TrainingProgressBar(), *self.callbacks])
+        if self.train_cfg.profile:
+            callbacks = [ProfilerCallback(self.timer, self.train_cfg.profile_trace_steps,
+                                          os.path.join(self.root_dir, "trace.json")),
+                         *callbacks]
         self.trainer = Trainer(
             default_root_dir=self.root_dir,
             max_epochs=self.train_cfg.max_epochs,
             limit_train_batches=self.train_cfg.limit_train_batches,
-            callbacks=[
-                *epochs_bar,
-                TrainingProgressBar(),
-                *self.callbacks],
+            callbacks=callbacks,
             logger=False,
             enable_checkpointing=False,
             num_sanity_val_steps=0,
             accelerator=default_device(),
-            devices=torch.cuda.device_count() if torch.cuda.is_available() else 1,
-            **self.config.training.trainer_kwargs
+            devices=self.get_devices(self.train_cfg),
+            num_nodes=self.train_cfg.num_nodes,
+            strategy=self.get_strategy(self.train_cfg),
+            # our samplers are rank-aware
+            use_distributed_sampler=False,
+            # curriculum stages rebuild the loader
+            reload_dataloaders_every_n_epochs=int(bool(self.train_cfg.batch_length_schedule)),
+            **self.get_val_kwargs(self.train_cfg),
+            **{"precision": self.get_precision(self.train_cfg),
+               **self.config.training.trainer_kwargs}
         )
         if self.trainer_state is not None:
             self.trainer.fit_loop.load_state_dict(self.trainer_state['fit_loop'])
-        self.trainer.fit(self)
+        self.trainer.fit(self, val_dataloaders=self.val_loader)
         try:
             self.loader._iterator._shutdown_workers()
         except:
@@ -357,6 +664,78 @@ class TrainARMLoop(LoggingHooks,
         self.dataset.close()
         return self
 
+    def tune_loader(self):
+        """replace the loader with the fastest settings found by `autotune_loader` and save them in `loader.yaml`"""
+        settings = autotune_loader(self.dataset, self.net, self.stage_cfg)
+        print("loader settings:", settings)
+        with open(os.path.join(self.root_dir, "loader.yaml"), "w") as fp:
+            fp.write(settings.serialize())
+        torch.set_num_threads(settings.torch_threads)
+        # the next stages of a curriculum use the same settings
+        self.train_cfg = settings.apply(self.train_cfg)
+        self.stage_cfg = settings.apply(self.stage_cfg)
+        self.loader = self.get_dataloader(self.dataset, self.net, self.stage_cfg)
+        return self
+
     def save_hp(self):
         with open(os.path.join(self.root_dir, "hp.yaml"), "w") as fp:
             fp.write(self.config.serialize())
+
+
+def benchmark_precision(
+        train_cfg: TrainARMConfig,
+        dataset: h5m.TypedFile,
+        network: ARM,
+        precisions: Tuple[str, ...] = ("32-true", "16-mixed", "bf16-mixed"),
+        n_steps: int = 20,
+        n_warmup: int = 3,
+) -> Dict[str, Dict[str, float]]:
+    """
+    time `n_steps` training steps of a copy of `network` for each precision
+    and return the steps/sec, examples/sec and (on cuda) the peak memory in MB.
+    """
+    device = default_device()
+    results = {}
+    for precision in precisions:
+        cfg = dtc.replace(train_cfg, precision=precision)
+        precision = TrainARMLoop.get_precision(cfg)
+        net = deepcopy(network).to(device).train()
+        opt = Adam(net.parameters(), lr=cfg.max_lr, betas=cfg.betas)
+        scaler = torch.cuda.amp.GradScaler(enabled=precision.startswith("16"))
+        dtype = {"16": torch.float16, "bf16": torch.bfloat16}.get(precision.split("-")[0], None)
+        loss_fn = net.loss_fn
+        dl = TrainARMLoop.get_dataloader(dataset, net, cfg)
+        if device == "cuda":
+            torch.cuda.reset_peak_memory_stats()
+        start, n, steps = time.perf_counter(), 0, 0
+        for i, (inputs, targets) in enumerate(dl):
+            if i == n_warmup:
+                if device == "cuda":
+                    torch.cuda.synchronize()
+                start = time.perf_counter()
+            if i == n_warmup + n_steps:
+                break
+            inputs = tuple(x.to(device) for x in inputs)
+            targets = tuple(x.to(device) for x in targets)
+            with torch.autocast(device, dtype=dtype or torch.float32, enabled=dtype is not None):
+                outputs = net(inputs)
+                if not isinstance(outputs, tuple):
+                    outputs = outputs,
+                loss = loss_fn(outputs, targets)["loss"]
+            opt.zero_grad()
+            scaler.scale(loss).backward()
+            scaler.step(opt)
+            scaler.update()
+            if hasattr(net, "reset_hidden"):
+                net.reset_hidden()
+            if i >= n_warmup:
+                n, steps = n + inputs[0].size(0), steps + 1
+        if device == "cuda":
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - start
+        results[precision] = {
+            "steps_per_sec": steps / elapsed,
+            "examples_per_sec": n / elapsed,
+            "peak_memory_mb": torch.cuda.max_memory_allocated() / 2 ** 20 if device == "cuda" else float("nan"),
+        }
+    return results
@@ -0,0 +1,143 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+import os
+import threading
+from typing import Optional, Tuple, Dict, Union
+
+import torch
+import torch.nn as nn
+
+from .checkpoint import Checkpoint
+from .utils import default_device
+
+__all__ = [
+    "ModelPool",
+    "default_model_pool",
+]
+
+Key = Tuple[str, str, Optional[str]]
+
+
+def _nbytes(net: nn.Module) -> int:
+    return sum(t.numel() * t.element_size() for t in (*net.parameters(), *net.buffers()))
+
+
+class ModelPool:
+    """
+    cache of the networks of checkpoints, ready on a device.
+
+    Networks are keyed by `(checkpoint path, device, dtype)` and the least recently used ones are evicted
+    when the pool holds more than `max_models` networks or more than `max_bytes` of weights.
+    `prefetch()` loads a network in a background thread: its weights are memory-mapped, staged in pinned
+    memory and copied to cuda devices on a side stream, so that a later `get()` returns immediately.
+    """
+
+    def __init__(self, max_models: Optional[int] = 8, max_bytes: Optional[int] = None):
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        self.models: "OrderedDict[Key, nn.Module]" = OrderedDict()
+        self.pending: Dict[Key, Future] = {}
+        self.lock = threading.RLock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mmk-model-pool")
+
+    @staticmethod
+    def key(ckpt: Checkpoint, device: Union[str, torch.device], dtype: Optional[torch.dtype] = None) -> Key:
+        return os.path.abspath(ckpt.os_path), str(torch.device(device)), None if dtype is None else str(dtype)
+
+    def get(self,
+            ckpt: Checkpoint,
+            device: Union[str, torch.device, None] = None,
+            dtype: Optional[torch.dtype] = None) -> nn.Module:
+        """the network of `ckpt` on `device` (default_device() if None), loaded if it isn't in the pool"""
+        device = device or default_device()
+        key = self.key(ckpt, device, dtype)
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                return self.models[key]
+            future = self.pending.get(key)
+        if future is not None:
+            return future.result()
+        return self._load(key, ckpt, device, dtype)
+
+    def prefetch(self,
+                 ckpt: Checkpoint,
+                 device: Union[str, torch.device, None] = None,
+                 dtype: Optional[torch.dtype] = None) -> Optional[Future]:
+        """start loading the network of `ckpt` in the background (None if it is already in the pool)"""
+        device = device or default_device()
+        key = self.key(ckpt, device, dtype)
+        with self.lock:
+            if key in self.models:
+                return None
+            if key not in self.pending:
+                self.pending[key] = self.executor.submit(self._load, key, ckpt, device, dtype)
+            return self.pending[key]
+
+    def _load(self, key: Key, ckpt: Checkpoint, device, dtype) -> nn.Module:
+        try:
+            # a fresh checkpoint object: networks of the pool aren't shared with the caller's checkpoint
+            net = Checkpoint(id=ckpt.id, epoch=ckpt.epoch, root_dir=ckpt.root_dir).network
+            if dtype is not None:
+                net = net.to(dtype)
+            net = self._to_device(net.eval(), torch.device(device))
+            with self.lock:
+                self.models[key] = net
+                self.models.move_to_end(key)
+                self._evict(keep=key)
+            return net
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+    @staticmethod
+    def _to_device(net: nn.Module, device: torch.device) -> nn.Module:
+        if device.type != "cuda":
+            return net.to(device)
+        # page-locked host copies make the transfer asynchronous
+        for t in (*net.parameters(), *net.buffers()):
+            t.data = t.data.pin_memory()
+        stream = torch.cuda.Stream(device)
+        with torch.cuda.stream(stream):
+            net = net.to(device, non_blocking=True)
+        stream.synchronize()
+        return net
+
+    def _evict(self, keep: Key):
+        def too_much():
+            if self.max_models is not None and len(self.models) > self.max_models:
+                return True
+            return self.max_bytes is not None and self.nbytes > self.max_bytes
+
+        while too_much() and len(self.models) > 1:
+            oldest = next(iter(self.models))
+            if oldest == keep:
+                break
+            self.models.pop(oldest)
+
+    @property
+    def nbytes(self) -> int:
+        """bytes of the weights of the networks in the pool"""
+        with self.lock:
+            return sum(_nbytes(net) for net in self.models.values())
+
+    def __contains__(self, key: Key) -> bool:
+        return key in self.models
+
+    def __len__(self):
+        return len(self.models)
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+
+
+_POOL: Optional[ModelPool] = None
+
+
+def default_model_pool() -> ModelPool:
+    """the model pool of this process"""
+    global _POOL
+    if _POOL is None:
+        _POOL = ModelPool()
+    return _POOL
@@ -1,66 +1,223 @@
-from typing import Optional, Union, Generator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Optional, Union, Generator, Sequence, Dict, Any, List, Tuple, Set
 
 import torch.nn as nn
 import torch
+from torch.func import stack_module_state, functional_call, vmap
+from torchaudio.transforms import Resample
 from pprint import pprint
 import dataclasses as dtc
 
-from ..features.item_spec import convert, Sample
+from ..features.item_spec import convert, Sample, ItemSpec
 from ..utils import default_device
-from ..networks import ARM
-from ..features.functionals import Resample
-from ..loops import GenerateLoopV2
+from ..networks import ARM, ARMWithHidden, NetworkConfig
+from ..modules.targets import OutputWrapper, CategoricalSampler
+from ..runtime import fill, generate_steps, sampling_parameters, n_generate_steps
 from ..checkpoint import Checkpoint
+from ..model_pool import ModelPool, default_model_pool
 from .nnn import NearestNextNeighbor
 
 __all__ = [
-    "EnsembleGenerator"
+    "VotingEnsemble",
+    "EnsembleGenerator",
+    "Parallel",
 ]
 
 
-class VotingEnsemble(nn.Module):
-    device = property(lambda self: next(self.parameters()).device)
+class VotingEnsemble(ARM, nn.Module):
+    """
+    generate with the weighted votes of several networks at each step.
+
+    The outputs of the networks are mixed before being sampled by the samplers of the first network:
+    the log-probabilities of categorical outputs are mixed as a weighted mixture of the distributions
+    and other outputs are averaged. Networks with the same config and no generation state are stacked
+    with `torch.func.stack_module_state` and run in one vmapped forward pass per step.
+    """
 
-    def __init__(self, networks, weights=None):
+    def __init__(self, networks: Sequence[ARM], weights: Optional[Sequence[float]] = None, vectorize: bool = True):
         super(VotingEnsemble, self).__init__()
         self.nets = nn.ModuleList(networks)
         N = len(networks)
         W = [1 / N for _ in range(N)] if weights is None else weights
         if len(W) != N:
             raise ValueError(f"Expected `weights` to be of length {N} but got {len(W)}")
-        self.weights = torch.tensor(W) / sum(W)
+        for net in networks:
+            if getattr(net.config, "lookahead", 1) > 1:
+                raise ValueError("networks predicting several steps per pass can not vote")
+        self.register_buffer("weights", torch.tensor(W, dtype=torch.float32) / sum(W))
+        self.vectorize = vectorize and self.can_stack(networks)
+        self._stacked = None
+
+    @staticmethod
+    def can_stack(networks: Sequence[ARM]) -> bool:
+        """whether the networks can run in a single vmapped forward pass"""
+        first = networks[0]
+        if isinstance(first, ARMWithHidden) or getattr(first, "use_fast_generate", False):
+            return False
+        config = first.config.serialize()
+        return all(type(net) is type(first) and net.config.serialize() == config for net in networks[1:])
+
+    @classmethod
+    def from_config(cls, config):
+        raise TypeError("ensembles are built from networks, not from a config")
+
+    @property
+    def config(self) -> NetworkConfig:
+        return self.nets[0].config
+
+    @property
+    def rf(self):
+        return max(net.rf for net in self.nets)
+
+    def train_batch(self, item_spec: ItemSpec):
+        return self.nets[0].train_batch(item_spec)
+
+    def test_batch(self, item_spec: ItemSpec):
+        return self.nets[0].test_batch(item_spec)
+
+    @property
+    def samplers(self) -> List[nn.Module]:
+        # outputs without sampler are averaged as they are
+        return [m.sampler if isinstance(m, OutputWrapper) else nn.Identity() for m in self.nets[0].output_modules]
+
+    @property
+    def generate_params(self) -> Set[str]:
+        return {p for sampler in self.samplers for p in getattr(sampler, "sampling_params", {})}
+
+    @staticmethod
+    @contextmanager
+    def estimates(net: nn.Module):
+        """make the output wrappers of `net` return the parameters of their samplers"""
+        wrappers = [m for m in net.modules() if isinstance(m, OutputWrapper) and not m.training]
+        for m in wrappers:
+            m.training = True
+        try:
+            yield
+        finally:
+            for m in wrappers:
+                m.training = False
 
-    def before_generate(self, loop, batch, batch_idx):
+    def before_generate(self, prompts: Tuple[torch.Tensor, ...], batch_index: int) -> None:
         for net in self.nets:
-            net.before_generate(loop, batch, batch_idx)
-        return {}
-
-    def generate_step(self, t, inputs, ctx):
-        self.weights.to(inputs.device)
-        out = None
-        for w, net in zip(self.nets, self.weights):
-            if out is None:
-                out = net.generate_step(t, inputs, ctx) * w
-            else:
-                out += net.generate_step(t, inputs, ctx) * w
-        return out
+            net.before_generate(prompts, batch_index)
+        if self.vectorize:
+            params, buffers = stack_module_state(list(self.nets))
+            self._stacked = ({k: v.detach() for k, v in params.items()}, buffers)
+
+    def generate_step(self,
+                      inputs: Tuple[torch.Tensor, ...], *,
+                      t: int = 0,
+                      **parameters: Dict[str, torch.Tensor]
+                      ) -> Tuple[torch.Tensor, ...]:
+        if self._stacked is not None:
+            estimates = self._vmapped_estimates(inputs)
+        else:
+            outputs = []
+            for net in self.nets:
+                with self.estimates(net):
+                    out = net.generate_step(tuple(x[:, -net.rf:] for x in inputs), t=t)
+                outputs += [out if isinstance(out, tuple) else (out,)]
+            if any(len(out) == 0 for out in outputs):
+                # e.g. warm-up steps
+                return tuple()
+            estimates = tuple(torch.stack(outs) for outs in zip(*outputs))
+        return tuple(self._vote(sampler, est, x.dim(), parameters)
+                     for sampler, est, x in zip(self.samplers, estimates, inputs))
+
+    def _vmapped_estimates(self, inputs: Tuple[torch.Tensor, ...]) -> Tuple[torch.Tensor, ...]:
+        base = self.nets[0]
+        inputs = tuple(x[:, -base.rf:] for x in inputs)
+
+        def estimate(params, buffers, x):
+            out = functional_call(base, (params, buffers), (x,))
+            return out if isinstance(out, tuple) else (out,)
+
+        with self.estimates(base):
+            return vmap(estimate, in_dims=(0, 0, None))(*self._stacked, inputs)
 
-    def after_generate(self, *args, **kwargs):
+    def _vote(self, sampler: nn.Module, estimates: torch.Tensor, ndim: int, parameters: Dict[str, Any]):
+        """mix the (n_nets x batch x ...) `estimates` and sample them"""
+        w = self.weights.to(estimates.device).view(-1, *([1] * (estimates.dim() - 1)))
+        if isinstance(sampler, CategoricalSampler):
+            mixed = torch.logsumexp(estimates.log_softmax(dim=-1) + w.log(), dim=0)
+        else:
+            mixed = (estimates * w).sum(dim=0)
+        params = {k: v for k, v in parameters.items() if k in getattr(sampler, "sampling_params", {})}
+        out = sampler(mixed, **params)
+        # match the dimensions of the generated feature
+        return out.squeeze(-1) if out.dim() > ndim else out
+
+    def after_generate(self, final_outputs: Tuple[torch.Tensor, ...], batch_index: int) -> None:
         for net in self.nets:
-            net.after_generate(*args, **kwargs)
-        return self
+            net.after_generate(final_outputs, batch_index)
+        self._stacked = None
+
+    def reset_slots(self, slots: torch.Tensor) -> None:
+        for net in self.nets:
+            net.reset_slots(slots)
+
+
+@dtc.dataclass
+class Parallel:
+    """
+    independent branches generating from the same prompt (concurrently) and mixed with `weights`.
+    Each branch is a dict of the keys of an `Event` but "seconds" (e.g. `dict(generator=ckpt, temperature=.5)`)
+    """
+    branches: Sequence[Dict[str, Any]]
+    weights: Optional[Sequence[float]] = None
 
 
 @dtc.dataclass
 class Event:
-    generator: Union[ARM, Checkpoint, NearestNextNeighbor]
+    generator: Union[ARM, Checkpoint, NearestNextNeighbor, Parallel]
     seconds: float
     temperature: Optional[float] = None
 
 
+# (network, n_steps, params) of the event or of each branch of a Parallel event
+Plan = List[Tuple[ARM, int, Dict[str, Any]]]
+
+
+class _Session:
+    """generation state of a network, kept alive across consecutive events of the same generator"""
+
+    def __init__(self, net: ARM, prompt: Tuple[torch.Tensor, ...]):
+        self.net = net.eval()
+        self.tensors = prompt
+        self.n_prompt_steps = prompt[0].size(1)
+        self.batch_index = torch.arange(prompt[0].size(0))
+        net.before_generate(prompt, self.batch_index)
+
+    def generate(self, n_steps: int, params: Dict[str, Any]) -> torch.Tensor:
+        """the audio of the `n_steps` next steps, preceded by the inversion of the prompt steps"""
+        net = self.net
+        prior_t = self.tensors[0].size(1)
+        tensors = tuple(fill(x, prior_t=("data", prior_t), n_steps=("blank", n_steps)) for x in self.tensors)
+        generate_steps(net, tensors, prior_t, n_steps, sampling_parameters(net, params, net.device))
+        # the prompt steps before the new ones are inverted too (e.g. for the phases of griffin-lim)
+        # and cut in samples (ffts use LESS input samples than provided)
+        target = net.config.io_spec.targets[0]
+        start = prior_t - self.n_prompt_steps
+        n_prompt_samples = convert(self.n_prompt_steps, target.unit, Sample(sr=net.config.io_spec.sr), True)
+        out = target.inv(tensors[0][:, start:])[:, n_prompt_samples:]
+        # the next event continues from the last steps. They are trimmed by multiples of rf
+        # so that the step schedules of the networks (e.g. SampleRNN's tiers) stay aligned
+        trim = (tensors[0].size(1) - self.n_prompt_steps) // net.rf * net.rf
+        self.tensors = tuple(x[:, trim:] for x in tensors)
+        return out
+
+    def close(self):
+        self.net.after_generate(self.tensors, self.batch_index)
+
+
 class EnsembleGenerator:
     """
     generate form a prompt by chaining checkpoints/models
+
+    Consecutive events of the same generator continue its generation (the network keeps its state and
+    the prompt isn't transformed again), resamplers are cached on the device and
+    the branches of `Parallel` events run concurrently in `max_branches` threads.
     """
 
     def __init__(self,
@@ -69,7 +226,9 @@ class EnsembleGenerator:
                  base_sr: int = 22050,
                  stream: Generator = (),
                  print_events: bool = False,
-                 device=default_device()
+                 device=default_device(),
+                 pool: Optional[ModelPool] = None,
+                 max_branches: int = 4,
                  ):
         super(EnsembleGenerator, self).__init__()
         self.prompt = prompt.to(device)
@@ -78,6 +237,12 @@ class EnsembleGenerator:
         self.stream = stream
         self.print_events = print_events
         self.device = device
+        # networks of checkpoints are shared through the process' pool by default
+        self.pool = default_model_pool() if pool is None else pool
+        self.executor = ThreadPoolExecutor(max_workers=max_branches, thread_name_prefix="mmk-ensemble")
+        self._next_event = None
+        self._session: Optional[_Session] = None
+        self._resamplers: Dict[Tuple[int, int], nn.Module] = {}
 
     def run(self):
         prompt_length = t = self.prompt.size(-1)
@@ -85,79 +250,130 @@ class EnsembleGenerator:
         output = torch.zeros(self.prompt.size(0), n_samples,
                              dtype=self.prompt.dtype).to(self.device)
         output[:, :t] = self.prompt
-        while t < n_samples:
-            prompt = output[:, t-prompt_length:t]
-            step_output = self.generate_step(t, prompt)
-            if step_output is None:
-                break
-            output[:, t:t+step_output.size(1)] = step_output
-            t += step_output.size(1)
+        try:
+            while t < n_samples:
+                prompt = output[:, t-prompt_length:t]
+                step_output = self.generate_step(t, prompt)
+                if step_output is None:
+                    break
+                step_output = step_output[:, :n_samples - t]
+                output[:, t:t+step_output.size(1)] = step_output
+                t += step_output.size(1)
+        finally:
+            self.end_session()
         return output
 
     def generate_step(self, t, inputs):
         if t >= int(self.max_seconds * self.base_sr):
             return None
-        event, net, n_steps, params = self.next_event()
-        if hasattr(net, 'to'):
-            net = net.to(self.device)
+        event, plan = self.next_event()
 
         if (t / self.base_sr + event.seconds) < self.max_seconds:
             if self.print_events:
                 e = dtc.asdict(event)
                 e.update({"start": t / self.base_sr})
                 pprint(e)
-            out = self.run_event(inputs, net, n_steps, params)
-            return out
+            if isinstance(event.generator, Parallel):
+                return self.run_parallel(inputs, event.generator, plan)
+            return self.run_event(inputs, *plan[0])
         return torch.zeros(inputs.size(0), int(self.max_seconds * self.base_sr - t)).to(self.device)
 
+    def resampler(self, orig_sr: int, target_sr: int) -> nn.Module:
+        """a cached resampler on the device of the generator"""
+        key = (orig_sr, target_sr)
+        if key not in self._resamplers:
+            self._resamplers[key] = nn.Identity() if orig_sr == target_sr \
+                else Resample(orig_sr, target_sr).to(self.device)
+        return self._resamplers[key]
+
+    def start_session(self, inputs: torch.Tensor, net: ARM) -> _Session:
+        io_spec = net.config.io_spec
+        inputs_resampled = self.resampler(self.base_sr, io_spec.sr)(inputs)
+        prompt = tuple(in_spec.transform(inputs_resampled) for in_spec in io_spec.inputs)
+        return _Session(net, prompt)
+
+    def end_session(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    @torch.no_grad()
     def run_event(self,
                   inputs: torch.Tensor,
                   net: ARM,
                   n_steps: int,
                   params: dict
                   ):
-        network_sr = net.config.io_spec.sr
-        resample = Resample(self.base_sr, network_sr)
-        inputs_resampled = resample(inputs)
-        prompt = tuple(in_spec.transform(inputs_resampled) for in_spec in net.config.io_spec.inputs)
-        # ffts use LESS input samples than provided:
-        n_prompt_samples = convert(prompt[0].shape[1], net.config.io_spec.targets[0].unit, Sample(sr=network_sr), True)
-
-        cfg = GenerateLoopV2.Config(
-            parameters=params,
-            display_waveform=False,
-            write_waveform=False,
-            yield_inversed_outputs=True
-        )
-        loop = GenerateLoopV2(
-            cfg,
-            network=net,
-            n_steps=n_steps,
-            # the loop needs the indices of the prompt before the prompt for logging...
-            dataloader=[[torch.ones(1), *prompt]],
-            logger=None,
-        )
-        for outputs in loop.run():
-            inv_resample = Resample(network_sr, self.base_sr)
-            # prompt + generated in base_sr :
-            out = inv_resample(outputs[0][:, n_prompt_samples:])
-            return out
-
-    def next_event(self):
-        event = Event(**next(self.stream))
-        if isinstance(event.generator, Checkpoint):
-            ck = event.generator
-            net = ck.network
-        elif isinstance(event.generator, NearestNextNeighbor):
-            net = event.generator
-        # elif event["type"] == "Parallel":
-        #     pass
+        if self._session is None or self._session.net is not net:
+            self.end_session()
+            self._session = self.start_session(inputs, net)
+        out = self._session.generate(n_steps, params)
+        # prompt + generated in base_sr :
+        return self.resampler(net.config.io_spec.sr, self.base_sr)(out)
+
+    @torch.no_grad()
+    def run_branch(self,
+                   inputs: torch.Tensor,
+                   net: ARM,
+                   n_steps: int,
+                   params: dict
+                   ):
+        stream = torch.cuda.Stream(self.device) if torch.device(self.device).type == "cuda" else None
+        with torch.cuda.stream(stream):
+            session = self.start_session(inputs, net)
+            out = session.generate(n_steps, params)
+            session.close()
+            out = self.resampler(net.config.io_spec.sr, self.base_sr)(out)
+        if stream is not None:
+            stream.synchronize()
+        return out
+
+    def run_parallel(self, inputs: torch.Tensor, parallel: Parallel, plan: Plan):
+        if len({id(net) for net, _, _ in plan}) < len(plan):
+            raise ValueError("the branches of a Parallel event must have distinct generators")
+        self.end_session()
+        futures = [self.executor.submit(self.run_branch, inputs, *branch) for branch in plan]
+        outputs = [f.result() for f in futures]
+        W = [1.] * len(outputs) if parallel.weights is None else parallel.weights
+        if len(W) != len(outputs):
+            raise ValueError(f"Expected `weights` to be of length {len(outputs)} but got {len(W)}")
+        n = min(out.size(1) for out in outputs)
+        return sum(out[:, :n] * (w / sum(W)) for out, w in zip(outputs, W))
+
+    def get_network(self, generator) -> ARM:
+        if isinstance(generator, Checkpoint):
+            net = self.pool.get(generator, self.device)
+        elif isinstance(generator, NearestNextNeighbor):
+            net = generator
         else:
-            raise TypeError(f"event generator type '{type(event.generator)}' not supported")
-        cfg = GenerateLoopV2.Config(output_duration_sec=event.seconds)
-        n_steps = GenerateLoopV2.get_n_steps(cfg, net)
-        if event.temperature is not None:
-            params = dict(temperature=event.temperature)
+            raise TypeError(f"event generator type '{type(generator)}' not supported")
+        return net.to(self.device) if hasattr(net, 'to') else net
+
+    def prefetch(self, event: Event):
+        if isinstance(event.generator, Parallel):
+            generators = [branch["generator"] for branch in event.generator.branches]
+        else:
+            generators = [event.generator]
+        for generator in generators:
+            if isinstance(generator, Checkpoint):
+                self.pool.prefetch(generator, self.device)
+
+    def next_event(self) -> Tuple[Event, Plan]:
+        event = self._next_event if self._next_event is not None else Event(**next(self.stream))
+        # load the network(s) of the next event while this one generates
+        self._next_event = None
+        upcoming = next(self.stream, None)
+        if upcoming is not None:
+            self._next_event = Event(**upcoming)
+            self.prefetch(self._next_event)
+        if isinstance(event.generator, Parallel):
+            events = [Event(seconds=event.seconds, **branch) for branch in event.generator.branches]
         else:
-            params = {}
-        return event, net, n_steps, params
+            events = [event]
+        plan = []
+        for e in events:
+            net = self.get_network(e.generator)
+            n_steps = n_generate_steps(net, e.seconds)
+            params = dict(temperature=e.temperature) if e.temperature is not None else {}
+            plan += [(net, n_steps, params)]
+        return event, plan
@@ -1,3 +1,5 @@
+import math
+
 import torch
 import torch.nn as nn
 
@@ -23,12 +25,14 @@ class MeanL1Prop(nn.Module):
         self.l1loss = nn.L1Loss(reduction="none")
 
     def forward(self, output, target):
+        # reduce in float32 (fp16 sums overflow and eps underflows)
+        output, target = output.float(), target.float()
         if self.raise_on_nan and torch.any(torch.isnan(output)):
             raise RuntimeError("nan values in output")
         L = self.l1loss(output, target).sum(dim=(0, -1,), keepdim=True)
         target_sums = target.abs().sum(dim=(0, -1,), keepdim=True)
         # make the upcoming division safe
-        prop = torch.maximum(L.detach(), torch.tensor(self.eps).to(L.device))
+        prop = L.detach().clamp_min(self.eps)
         target_sums = target_sums + (target_sums < 1.).float() * prop
         if self.raise_on_nan and torch.any(torch.isnan(target_sums)):
             raise RuntimeError("nan values in target_sums")
@@ -43,10 +47,10 @@ class WeightedL1(nn.Module):
         self.l1loss = nn.L1Loss(reduction="none")
 
     def forward(self, output, target):
-        L = self.l1loss(output, target)
+        L = self.l1loss(output.float(), target.float())
         target_sums = L.detach().sum(dim=1, keepdims=True)
         # make the upcoming division safe
-        prop = target_sums / torch.maximum(target_sums.sum(dim=-1, keepdims=True), torch.tensor(self.eps).to(L.device))
+        prop = target_sums / target_sums.sum(dim=-1, keepdims=True).clamp_min(self.eps)
         L = (L * prop).sum()
         return L
 
@@ -58,8 +62,8 @@ class DiffOverTime(nn.Module):
         self.l1loss = nn.L1Loss(reduction="mean")
 
     def forward(self, output, target):
-        diff_output = torch.diff(output, dim=1)
-        diff_target = torch.diff(target, dim=1)
+        diff_output = torch.diff(output.float(), dim=1)
+        diff_target = torch.diff(target.float(), dim=1)
         return self.l1loss(diff_output, diff_target)
 
 
@@ -69,6 +73,7 @@ class DistanceOverTime(nn.Module):
         self.l1loss = nn.L1Loss(reduction="none")
 
     def forward(self, output, target):
+        output, target = output.float(), target.float()
         dists = torch.cdist(output, output)
         t_dists = torch.cdist(target, target)
         L = self.l1loss(dists, t_dists).mean()
@@ -80,7 +85,7 @@ class MaximizeStd(nn.Module):
         super(MaximizeStd, self).__init__()
 
     def forward(self, output, target):
-        std = output.std(dim=1, keepdims=True)
+        std = output.float().std(dim=1, keepdims=True)
         L = -std.mean()
         return L
 
@@ -90,7 +95,7 @@ class MaximizeMagnitude(nn.Module):
         super(MaximizeMagnitude, self).__init__()
 
     def forward(self, output, target):
-        mag = output.mean()
+        mag = output.float().mean()
         return -mag
 
 
@@ -141,9 +146,10 @@ class CosineSimilarity(nn.Module):
         self.register_buffer("eps", eps)
 
     def forward(self, X, Y):
+        X, Y = X.float(), Y.float()
         dot_prod = torch.matmul(X, Y.transpose(-2, -1))
         norms = torch.norm(X, p=2, dim=-1).unsqueeze(-1) * torch.norm(Y, p=2, dim=-1).unsqueeze(-2)
-        cos_theta = dot_prod.div_(torch.maximum(norms, self.eps.to(X.device)))
+        cos_theta = dot_prod.div_(torch.maximum(norms, self.eps.to(X)))
         return cos_theta
 
 
@@ -158,7 +164,7 @@ class AngularDistance(nn.Module):
 
     def safe_acos(self, x):
         # torch.acos returns nan near -1 and 1... see https://github.com/pytorch/pytorch/issues/8069
-        eps = self.eps.to(x.device)
+        eps = self.eps.to(x)
         return torch.acos(torch.clamp(x, min=-1 + eps / 2, max=1 - eps / 2))
 
     def forward(self, X, Y):
@@ -172,10 +178,10 @@ class AngularDistance(nn.Module):
         Y : (*, M, D)
         D_xy : (*, N, M)
         """
-        have_negatives = torch.any(X < 0) or torch.any(Y < 0)
+        # stays on device: no host sync
+        have_negatives = torch.any(X < 0) | torch.any(Y < 0)
         cos_theta = self.cosine_sim(X, Y)
-        pi = torch.acos(torch.zeros(1)).item() * 2
-        D_xy = (1 + int(not have_negatives)) * self.safe_acos(cos_theta) / pi
+        D_xy = (2. - have_negatives.float()) * self.safe_acos(cos_theta) / math.pi
         if self.reduction != 'none':
             D_xy = getattr(torch, self.reduction)(D_xy)
         return D_xy
@@ -35,18 +35,70 @@ def as_tensor(temperature, tensor):
 
 
 class CategoricalSampler(nn.Module):
-    sampling_params = {"temperature"}
+    """
+    sample the classes of `logits` with the Gumbel-max trick.
 
-    def forward(self, logits, *, temperature=None):
+    The Gumbel noise is drawn on the device of the logits by chunks of `noise_chunk` steps,
+    parameters are cached for as long as the same objects are passed and top-k/top-p filtering is done
+    with tensor ops, so that sampling doesn't synchronize with the host.
+    Each parameter can be a scalar, a tensor/array with one value per example in the batch,
+    or a (batch x time) schedule if the generate loop slices it at each step.
+    """
+    sampling_params = {"temperature", "top_k", "top_p"}
+
+    def __init__(self, noise_chunk: int = 64):
+        super(CategoricalSampler, self).__init__()
+        self.noise_chunk = noise_chunk
+        self._noise = None
+        self._noise_pos = 0
+        self._params = {}
+
+    def forward(self, logits, *, temperature=None, top_k=None, top_p=None):
         if self.training:
             return logits
         if temperature is None:
             return logits.argmax(dim=-1)
-        temperature = as_tensor(temperature, logits)
-        logits = logits / temperature
-        logits = logits - logits.logsumexp(-1, keepdim=True)
-        if logits.dim() > 2:
-            o_shape = logits.shape
-            logits = logits.view(-1, o_shape[-1])
-            return torch.multinomial(logits.exp_(), 1).reshape(*o_shape[:-1])
-        return torch.multinomial(logits.exp_(), 1)
+        logits = logits / self._as_tensor("temperature", temperature, logits)
+        if top_k is not None or top_p is not None:
+            logits = self._filter(logits, top_k, top_p)
+        idx = (logits + self._gumbel(logits)).argmax(dim=-1)
+        return idx if logits.dim() > 2 else idx.unsqueeze(-1)
+
+    def _as_tensor(self, name, value, like):
+        # arrays and lists can be modified in place, only scalars and tensors on the right device are cached
+        if not isinstance(value, (int, float)) and \
+                not (isinstance(value, torch.Tensor) and value.device == like.device):
+            return as_tensor(value, like)
+        cached = self._params.get(name, None)
+        if cached is not None and cached[0] is value and cached[1].ndim == like.ndim:
+            return cached[1]
+        tensor = as_tensor(value, like)
+        self._params[name] = (value, tensor)
+        return tensor
+
+    def _gumbel(self, logits):
+        n = logits.numel()
+        noise = self._noise
+        if noise is None or noise.device != logits.device or noise.dtype != logits.dtype \
+                or self._noise_pos + n > noise.numel():
+            noise = -torch.empty(n * self.noise_chunk, device=logits.device, dtype=logits.dtype).exponential_().log()
+            self._noise, self._noise_pos = noise, 0
+        g = noise[self._noise_pos:self._noise_pos + n]
+        self._noise_pos += n
+        return g.view_as(logits)
+
+    def _filter(self, logits, top_k, top_p):
+        sorted_logits = logits.sort(dim=-1, descending=True).values
+        n_classes = logits.size(-1)
+        threshold = sorted_logits[..., -1:]
+        if top_k is not None:
+            k = self._as_tensor("top_k", top_k, logits).long().clamp(1, n_classes)
+            threshold = torch.maximum(threshold, sorted_logits.gather(-1, (k - 1).expand(*logits.shape[:-1], 1)))
+        if top_p is not None:
+            p = self._as_tensor("top_p", top_p, logits)
+            probs = sorted_logits.softmax(dim=-1)
+            # keep the smallest prefix whose mass exceeds top_p (always at least one class)
+            drop = (probs.cumsum(dim=-1) - probs) >= p
+            threshold = torch.maximum(
+                threshold, sorted_logits.masked_fill(drop, float("inf")).amin(dim=-1, keepdim=True))
+        return logits.masked_fill(logits < threshold, -float("inf"))
@@ -1,6 +1,7 @@
 import abc
 import dataclasses as dtc
-from typing import Tuple, Dict, Set
+from copy import copy
+from typing import Tuple, Dict, Set, Any
 import torch
 import h5mapper as h5m
 
@@ -30,7 +31,9 @@ class ARM(Configurable, torch.nn.Module):
 
     @property
     def device(self):
-        return next(self.parameters()).device
+        # quantized networks can have no float parameters left (and run on cpu)
+        param = next(self.parameters(), None)
+        return param.device if param is not None else torch.device("cpu")
 
     @property
     @abc.abstractmethod
@@ -79,6 +82,24 @@ class ARM(Configurable, torch.nn.Module):
     def generate_params(self) -> Set[str]:
         ...
 
+    @property
+    def loss_fn(self):
+        """the training criterion of the network's outputs"""
+        return self.config.io_spec.loss_fn
+
+    def reset_slots(self, slots: torch.Tensor) -> None:
+        """reset the generation state of the examples at indices `slots` in the batch (no state by default)"""
+        return
+
+    def stateful_step(self) -> torch.nn.Module:
+        """
+        a module computing one generate step as `(inputs, state, t, temperature) -> (outputs, new_state)`
+        with all of its state passed explicitly (see `mimikit.export`).
+        By default, the outputs only depend on the `rf` last inputs.
+        """
+        from ..export import WindowStep
+        return WindowStep(self)
+
 
 class ARMWithHidden(ARM, abc.ABC):
 
@@ -86,6 +107,18 @@ class ARMWithHidden(ARM, abc.ABC):
     def reset_hidden(self) -> None:
         ...
 
+    def get_hidden(self) -> Dict[str, Any]:
+        """the `hidden` attributes of the network's modules (to be restored with `set_hidden`)"""
+        return {name: copy(m.hidden) for name, m in self.named_modules() if hasattr(m, "hidden")}
+
+    def set_hidden(self, hidden: Dict[str, Any]) -> None:
+        modules = dict(self.named_modules())
+        for name, h in hidden.items():
+            modules[name].hidden = copy(h)
+
+    def stateful_step(self) -> torch.nn.Module:
+        raise NotImplementedError(f"{type(self).__name__} has no stateful step")
+
 
 class AutoEncoder(Configurable, torch.nn.Module):
 
@@ -93,6 +126,11 @@ class AutoEncoder(Configurable, torch.nn.Module):
     def device(self):
         return next(self.parameters()).device
 
+    @property
+    def loss_fn(self):
+        """the training criterion of the network's outputs"""
+        return self.config.io_spec.loss_fn
+
     @property
     @abc.abstractmethod
     def config(self) -> NetworkConfig:
@@ -58,6 +58,8 @@ class MLP(nn.Module):
     def forward(self, x: torch.Tensor):
         logits = self.fc(x)
         if self.learn_temperature:
+            # dividing by min_temp overflows in half precision
+            logits = logits.float()
             temp = self.sigmoid(logits[..., -1:])
             logits = logits[..., :-1] / torch.maximum(temp, self.min_temp)
         return logits
@@ -22,9 +22,9 @@ class ParametrizedGaussian(nn.Module):
         self.return_params = return_params
 
     def forward(self, h):
-        mu, logvar = torch.chunk(self.fc(h), 2, dim=-1)
+        mu, logvar = torch.chunk(self.fc(h).float(), 2, dim=-1)
         std = logvar.mul(0.5).exp().clamp(min=self.min_std)
-        eps = torch.randn(*mu.size()).to(h.device)
+        eps = torch.randn_like(mu)
         z = mu + std * eps
         if self.return_params:
             return z, mu, std
@@ -61,7 +61,8 @@ class ParametrizedLogistic(nn.Module):
         self.min_std = min_std
 
     def forward(self, x):
-        mu, std = torch.chunk(self.params(x), 2, dim=self.chunk_dim)
+        mu, std = torch.chunk(self.params(x).float(), 2, dim=self.chunk_dim)
+        # in float32, fp16's finfo.tiny/eps would truncate the tails of the noise
         y = torch.rand_like(mu)
         finfo = torch.finfo(y.dtype)
         y = y.clamp(min=finfo.tiny, max=1. - finfo.eps)
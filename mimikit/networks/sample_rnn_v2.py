@@ -118,6 +118,90 @@ class SampleRNNTier(nn.Module):
     def _init_h0(self, *dims):
         return getattr(torch, self.h0_init)(*dims)
 
+    def reset_slots(self, slots: T) -> None:
+        if not self.has_rnn or self.hidden is None:
+            return
+        hidden = self.hidden if self.rnn_class == "lstm" else (self.hidden,)
+        for h in hidden:
+            h.data[:, slots] = self._init_h0(self.n_rnn, len(slots), self.hidden_dim).to(h)
+
+
+class SampleRNNStep(nn.Module):
+    """
+    the generate step of a SampleRNN with the outputs and hidden states of its tiers passed as state.
+
+    Every tier is computed at each step and its new state is only kept when `t` is a multiple
+    of its frame size, so that the traced graph has no data-dependent branches.
+    """
+    warmup_steps = True
+
+    def __init__(self, network: "SampleRNN"):
+        super(SampleRNNStep, self).__init__()
+        if network.config.h0_init == "randn":
+            raise NotImplementedError("h0_init='randn' draws random initial states and can not be exported")
+        self.tiers = network.tiers
+        self.output_modules = network.output_modules
+        self.frame_sizes = tuple(network.frame_sizes)
+        self.with_temperature = "temperature" in network.generate_params
+        self.h0 = 1. if network.config.h0_init == "ones" else 0.
+
+    def n_hidden(self, tier: SampleRNNTier) -> int:
+        return 0 if not tier.has_rnn else (2 if tier.rnn_class == "lstm" else 1)
+
+    def state_spec(self) -> List[Tuple[Tuple[int, ...], str, float]]:
+        """for each upper tier: its last output and its hidden state(s)"""
+        spec = []
+        for tier in self.tiers[:-1]:
+            spec += [((-1, tier.up_sampling, tier.hidden_dim), "float32", 0.)]
+            spec += [((tier.n_rnn, -1, tier.hidden_dim), "float32", self.h0)] * self.n_hidden(tier)
+        return spec
+
+    def _tier(self, i: int, inputs: Tuple[T, ...], prev_out: Optional[T], hidden: Tuple[T, ...]):
+        tier = self.tiers[i]
+        x = tier.input_module(inputs)
+        if prev_out is not None:
+            x = x + prev_out
+        if tier.has_rnn:
+            x, hidden = tier.rnn(x, hidden if tier.rnn_class == "lstm" else hidden[0])
+            hidden = hidden if tier.rnn_class == "lstm" else (hidden,)
+        if tier.has_up_sampling:
+            x = tier.up_sampler(x)
+        return x, hidden
+
+    def warmup(self, inputs: Tuple[T, ...], state: Tuple[T, ...], t: T) -> Tuple[T, ...]:
+        """update the upper tiers without sampling outputs"""
+        fs = self.frame_sizes
+        new_state, pos, prev = [], 0, None
+        for i, tier in enumerate(self.tiers[:-1]):
+            n = 1 + self.n_hidden(tier)
+            out_old, hidden_old = state[pos], tuple(state[pos + 1:pos + n])
+            pos += n
+            inpt = tuple(x[:, -fs[i]:] for x in inputs)
+            if i == 0:
+                prev_out = None
+            else:
+                idx = torch.div(t, fs[i], rounding_mode="floor") % (fs[i - 1] // fs[i])
+                prev_out = prev.index_select(1, idx.view(1))
+            out, hidden = self._tier(i, inpt, prev_out, hidden_old)
+            update = (t % fs[i]) == 0
+            prev = torch.where(update, out, out_old)
+            new_state += [prev, *(torch.where(update, h, h_old) for h, h_old in zip(hidden, hidden_old))]
+        return tuple(new_state)
+
+    def forward(self,
+                inputs: Tuple[T, ...],
+                state: Tuple[T, ...],
+                t: T,
+                temperature: T):
+        state = self.warmup(inputs, state, t)
+        fs = self.frame_sizes
+        inpt = tuple(x[:, -fs[-1]:] for x in inputs)
+        prev_out = state[-1 - self.n_hidden(self.tiers[-2])].index_select(1, (t % fs[-2]).view(1))
+        out, _ = self._tier(len(self.tiers) - 1, inpt, prev_out, ())
+        params = dict(temperature=temperature) if self.with_temperature else {}
+        outputs = tuple(mod(out, **params) for mod in self.output_modules)
+        return tuple(out.squeeze(-1) if out.dim() > 2 else out for out in outputs), state
+
 
 class SampleRNN(ARMWithHidden, nn.Module):
     @dtc.dataclass
@@ -267,6 +351,14 @@ class SampleRNN(ARMWithHidden, nn.Module):
         for t in self.tiers:
             t.hidden = None
 
+    def stateful_step(self) -> SampleRNNStep:
+        return SampleRNNStep(self)
+
+    def reset_slots(self, slots: torch.Tensor) -> None:
+        # the tiers' outputs are all recomputed at the next multiple of rf
+        for t in self.tiers:
+            t.reset_slots(slots)
+
     @property
     def config(self):
         return self._config
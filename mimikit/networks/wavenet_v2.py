@@ -201,6 +201,10 @@ class WaveNet(ARM, nn.Module):
         stride: int = 1
         bias: bool = True
         use_fast_generate: bool = False
+        # number of steps predicted per pass of the main stack (extra "draft" heads if > 1)
+        lookahead: int = 1
+        # drafts are accepted if their probability is at least `tolerance` * the probability of the argmax
+        tolerance: float = 1.
         tie_io_weights: bool = False
         layerwise_inputs: bool = False
         reverse_layer_order: bool = False
@@ -244,6 +248,15 @@ class WaveNet(ARM, nn.Module):
                              .set(in_dim=h_dim)
                              .module()
                          for spec, h_dim in zip(config.io_spec.targets, all_dims)]
+        if config.lookahead > 1:
+            if config.use_fast_generate:
+                raise ValueError("lookahead > 1 is not compatible with use_fast_generate")
+            # one head per target and per future step, ordered by step
+            output_module += [spec.module.copy()
+                                  .set(in_dim=h_dim)
+                                  .module()
+                              for _ in range(config.lookahead - 1)
+                              for spec, h_dim in zip(config.io_spec.targets, all_dims)]
         if config.tie_io_weights:
             for i, o in zip(input_modules, output_module):
                 for name, m in i.named_modules():
@@ -272,8 +285,21 @@ class WaveNet(ARM, nn.Module):
         self.output_modules = nn.ModuleList(output_modules)
         self.eval_slice = slice(-1, None) if config.pad_side == 1 else slice(0, 1)
         self._gen_context = {}
+        # drafts of the draft heads waiting for verification, by the step they start at
+        self._drafts = {}
+
+    @property
+    def n_heads(self) -> int:
+        return len(self.config.io_spec.targets)
 
     def forward(self, inputs: Tuple, **parameters):
+        y = self.hidden_states(inputs)
+        if not self.training:
+            y = y[:, self.eval_slice]
+            return tuple(mod(y, **parameters) for mod in self.output_modules[:self.n_heads])
+        return tuple(mod(y, **parameters) for mod in self.output_modules)
+
+    def hidden_states(self, inputs: Tuple) -> torch.Tensor:
         inputs = tuple(self.transpose(mod(x)) for mod, x in zip(self.input_modules, inputs))
         dilated, in_1x1, skips = inputs[0], inputs[1:], None
         for layer in self.layers:
@@ -285,12 +311,8 @@ class WaveNet(ARM, nn.Module):
             if not layer.needs_padding:
                 in_1x1 = tuple(layer.trim_cause(x) for x in in_1x1)
         if self.has_skips:
-            y = self.transpose(skips)
-        else:
-            y = self.transpose(dilated)
-        if not self.training:
-            y = y[:, self.eval_slice]
-        return tuple(mod(y, **parameters) for mod in self.output_modules)
+            return self.transpose(skips)
+        return self.transpose(dilated)
 
     @classmethod
     def get_kernels_and_dilation(cls, kernel_sizes, blocks):
@@ -353,7 +375,8 @@ class WaveNet(ARM, nn.Module):
             for spec in self.config.io_spec.inputs
         ), tuple(
             spec.to_batch_item(
-                item_spec + ItemSpec(self.shift, self.output_length(0), unit=Step())
+                # the draft heads need lookahead - 1 more steps
+                item_spec + ItemSpec(self.shift, self.output_length(0) + self.config.lookahead - 1, unit=Step())
             )
             for spec in self.config.io_spec.targets
         )
@@ -361,11 +384,31 @@ class WaveNet(ARM, nn.Module):
     def test_batch(self, item_spec: ItemSpec):
         return self.train_batch(item_spec)
 
+    @property
+    def loss_fn(self):
+        loss_fn, k, n = self.config.io_spec.loss_fn, self.config.lookahead, self.n_heads
+        if k == 1:
+            return loss_fn
+
+        def func(output, target):
+            out = {"loss": 0.}
+            for j in range(k):
+                heads = output[j * n:(j + 1) * n]
+                length = heads[0].size(1)
+                d = loss_fn(heads, tuple(tgt[:, j:j + length] for tgt in target))
+                out["loss"] += d.pop("loss")
+                out.update({(f"head{j}_{key}" if j > 0 else key): v for key, v in d.items()})
+            return out
+
+        return func
+
     @property
     def generate_params(self) -> Set[str]:
-        return getattr(self.output_modules, "sampling_params", {})
+        params = {p for m in self.output_modules for p in getattr(m, "sampling_params", {})}
+        return params | {"tolerance"} if self.config.lookahead > 1 else params
 
     def before_generate(self, prompts: Tuple[torch.Tensor, ...], batch_index: int) -> None:
+        self._drafts = {}
         if not self.use_fast_generate:
             return
 
@@ -449,9 +492,66 @@ class WaveNet(ARM, nn.Module):
             inputs: Tuple[torch.Tensor, ...], *,
             t: int = 0,
             **parameters: Dict[str, torch.Tensor]) -> Tuple[torch.Tensor, ...]:
+        if self.config.lookahead > 1:
+            return self.speculative_step(inputs, t=t, **parameters)
         return self.forward(inputs, **parameters)
 
+    def stateful_step(self) -> nn.Module:
+        if self.config.lookahead > 1:
+            raise NotImplementedError("speculative steps can not be exported")
+        return super(WaveNet, self).stateful_step()
+
+    def speculative_step(
+            self,
+            inputs: Tuple[torch.Tensor, ...], *,
+            t: int = 0,
+            tolerance: Optional[float] = None,
+            **parameters: Dict[str, torch.Tensor]) -> Tuple[torch.Tensor, ...]:
+        """
+        verify the drafts of the previous step and make new ones with a single pass of the main stack.
+
+        The drafts are appended to the inputs so that the main heads score every draft given the previous ones.
+        The longest prefix of drafts accepted by all the examples of the batch is returned, followed by the
+        sample of the main heads at the first rejected draft, and the draft heads predict the next `lookahead - 1`
+        steps from there. This returns between 1 and `lookahead` steps per call.
+        """
+        k, n = self.config.lookahead, self.n_heads
+        tolerance = self.config.tolerance if tolerance is None else tolerance
+        drafts = self._drafts.pop(t, None)
+        self._drafts = {}
+        if drafts is not None:
+            inputs = tuple(torch.cat((x, d.to(x.dtype)), dim=1) for x, d in zip(inputs, drafts))
+        n_drafts = 0 if drafts is None else drafts[0].size(1)
+        # hidden states predicting the steps t, ..., t + n_drafts
+        y = self.hidden_states(inputs)[:, -(n_drafts + 1):]
+        main_heads, draft_heads = self.output_modules[:n], self.output_modules[n:]
+        for mod in self.output_modules:
+            if not hasattr(mod, "estimator"):
+                raise TypeError("lookahead > 1 requires categorical targets")
+        logits = tuple(mod.estimator(y) for mod in main_heads)
+        n_accepted = 0
+        if n_drafts > 0:
+            accepted = torch.ones_like(drafts[0], dtype=torch.bool)
+            for lgt, d in zip(logits, drafts):
+                probs = lgt[:, :-1].softmax(dim=-1)
+                p_draft = probs.gather(-1, d.long().unsqueeze(-1)).squeeze(-1)
+                accepted &= p_draft >= tolerance * probs.amax(dim=-1)
+            n_accepted = int(accepted.long().cumprod(dim=-1).sum(dim=-1).min())
+        outputs = []
+        for mod, lgt, d in zip(main_heads, logits, drafts if drafts is not None else (None,) * n):
+            x = mod.sampler(lgt[:, n_accepted:n_accepted + 1], **parameters)
+            outputs += [x if d is None else torch.cat((d[:, :n_accepted].to(x.dtype), x), dim=1)]
+        # new drafts from the hidden state of the last returned step
+        h = y[:, n_accepted:n_accepted + 1]
+        new_drafts = tuple(
+            torch.cat([draft_heads[j * n + i](h, **parameters) for j in range(k - 1)], dim=1)
+            for i in range(n)
+        )
+        self._drafts = {t + n_accepted + 1: new_drafts}
+        return tuple(outputs)
+
     def after_generate(self, final_outputs: Tuple[torch.Tensor, ...], batch_index: int) -> None:
+        self._drafts = {}
         if not self.use_fast_generate:
             return
         # reset the layers' parameters
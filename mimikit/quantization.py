@@ -0,0 +1,161 @@
+import io
+import time
+from typing import Optional, Tuple, Dict, Iterable, List, Type
+
+import h5mapper as h5m
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.ao.quantization import QuantWrapper, get_default_qconfig, prepare, convert, quantize_dynamic
+from torch.nn.utils import parametrize
+from torch.nn.utils.weight_norm import WeightNorm
+from torch.utils.data import DataLoader
+
+from .features.item_spec import ItemSpec
+from .networks.arm import ARM, ARMWithHidden
+from .runtime import fill, sampling_parameters, generate_steps
+
+__all__ = [
+    "quantization_batches",
+    "quantize_network",
+    "benchmark_quantization",
+]
+
+Batch = Tuple[Tuple[torch.Tensor, ...], Tuple[torch.Tensor, ...]]
+
+
+def quantization_batches(network: ARM,
+                         dataset: h5m.TypedFile,
+                         n_batches: int = 8,
+                         batch_size: int = 4,
+                         batch_length: Optional[int] = None,
+                         ) -> List[Batch]:
+    """`n_batches` training batches `(inputs, targets)` of `network` evenly spaced in `dataset`"""
+    length = batch_length or 8 * network.rf
+    batch = network.train_batch(ItemSpec(shift=0, length=length, unit=network.config.io_spec.unit))
+    ds = h5m.ProgrammableDataset(dataset, batch)
+    indices = np.linspace(0, len(ds) - 1, n_batches * batch_size).astype(int).tolist()
+    loader = DataLoader(ds, batch_size=batch_size, sampler=indices)
+    return [(tuple(inputs), tuple(targets)) for inputs, targets in loader]
+
+
+def _remove_weight_norm(network: nn.Module):
+    for module in network.modules():
+        for hook in list(module._forward_pre_hooks.values()):
+            if isinstance(hook, WeightNorm):
+                nn.utils.remove_weight_norm(module, hook.name)
+        if parametrize.is_parametrized(module):
+            for name in list(module.parametrizations.keys()):
+                parametrize.remove_parametrizations(module, name, leave_parametrized=True)
+
+
+def _wrap_1x1_convs(network: nn.Module, qconfig) -> int:
+    """wrap the 1x1 convolutions of `network` between (de)quantization stubs"""
+    n = 0
+    for module in list(network.modules()):
+        for name, child in list(module.named_children()):
+            if type(child) is nn.Conv1d and child.kernel_size == (1,) and child.dilation == (1,) \
+                    and child.padding in (0, (0,)) and child.padding_mode == "zeros":
+                wrapper = QuantWrapper(child)
+                wrapper.qconfig = qconfig
+                setattr(module, name, wrapper)
+                n += 1
+    return n
+
+
+def _forward(network: ARM, inputs: Tuple[torch.Tensor, ...]):
+    if isinstance(network, ARMWithHidden):
+        network.reset_hidden()
+    outputs = network(inputs)
+    return outputs if isinstance(outputs, tuple) else (outputs,)
+
+
+@torch.no_grad()
+def quantize_network(network: ARM,
+                     calibration: Iterable[Tuple[torch.Tensor, ...]] = (),
+                     dynamic_types: Tuple[Type[nn.Module], ...] = (nn.Linear, nn.LSTM, nn.GRU),
+                     static_convs: bool = True,
+                     ) -> ARM:
+    """
+    a copy of `network` with int8 weights for generation on cpu.
+
+    Modules of `dynamic_types` are quantized dynamically (activations are quantized on the fly)
+    and, if `static_convs`, the 1x1 convolutions are quantized statically with the ranges of
+    their activations observed on the `calibration` inputs. Weight norms are folded in the weights.
+    """
+    quantized = type(network).from_config(network.config)
+    quantized.load_state_dict(network.state_dict())
+    quantized = quantized.cpu()
+    _remove_weight_norm(quantized)
+    calibration = list(calibration)
+    if static_convs and calibration:
+        qconfig = get_default_qconfig(torch.backends.quantized.engine)
+        if _wrap_1x1_convs(quantized, qconfig) > 0:
+            # in training mode, the networks output what the losses expect (as in validation)
+            quantized.train()
+            prepare(quantized, inplace=True)
+            for inputs in calibration:
+                _forward(quantized, tuple(x.cpu() for x in inputs))
+            convert(quantized, inplace=True)
+    quantized = quantize_dynamic(quantized, set(dynamic_types), dtype=torch.qint8)
+    if isinstance(quantized, ARMWithHidden):
+        quantized.reset_hidden()
+    return quantized.eval()
+
+
+@torch.no_grad()
+def _teacher_forced_loss(network: ARM, batches: List[Batch]) -> float:
+    was_training = network.training
+    network.train()
+    losses = []
+    for inputs, targets in batches:
+        outputs = _forward(network, inputs)
+        losses += [network.loss_fn(outputs, targets)["loss"].item()]
+    network.train(was_training)
+    return float(np.mean(losses))
+
+
+@torch.no_grad()
+def _sec_per_step(network: ARM, prompts: Tuple[torch.Tensor, ...], n_steps: int) -> float:
+    network.eval()
+    network.before_generate(prompts, torch.arange(prompts[0].size(0)))
+    prior_t = prompts[0].size(1)
+    tensors = tuple(fill(x, prior_t=("data", prior_t), n_steps=("blank", n_steps)) for x in prompts)
+    params = sampling_parameters(network, dict(temperature=1.), "cpu")
+    start = time.perf_counter()
+    generate_steps(network, tensors, prior_t, n_steps, params)
+    elapsed = time.perf_counter() - start
+    network.after_generate(tuple(x.data for x in tensors), torch.arange(prompts[0].size(0)))
+    return elapsed / n_steps
+
+
+def _size_mb(network: nn.Module) -> float:
+    buffer = io.BytesIO()
+    torch.save(network.state_dict(), buffer)
+    return buffer.tell() / 2 ** 20
+
+
+def benchmark_quantization(network: ARM,
+                           quantized: ARM,
+                           batches: List[Batch],
+                           n_steps: int = 256,
+                           seed: int = 0,
+                           ) -> Dict[str, float]:
+    """
+    compare `quantized` with the float `network` on cpu: the teacher-forced loss on `batches`,
+    the seconds per generate step from the inputs of the first batch and the size of the weights.
+    """
+    if network.device.type != "cpu":
+        copy = type(network).from_config(network.config)
+        copy.load_state_dict(network.state_dict())
+        network = copy
+    prompts = tuple(x[:, :network.rf] for x in batches[0][0])
+    results = {}
+    for name, net in (("float", network), ("quantized", quantized)):
+        torch.manual_seed(seed)
+        results[f"{name}_loss"] = _teacher_forced_loss(net, batches)
+        results[f"{name}_sec_per_step"] = _sec_per_step(net, prompts, n_steps)
+        results[f"{name}_mb"] = _size_mb(net)
+    results["speedup"] = results["float_sec_per_step"] / results["quantized_sec_per_step"]
+    results["loss_increase"] = results["quantized_loss"] - results["float_loss"]
+    return results
@@ -0,0 +1,213 @@
+"""
+Headless generation from checkpoints.
+
+This module doesn't import `mimikit.loops` (lightning, notebook display, plotting) so that generation
+workers only need the networks and their features:
+
+    mmk-generate path/to/<id>/epoch=<N>.ckpt prompt1.wav prompt2.wav --seconds 8 --out-dir outputs/
+"""
+import argparse
+import os
+from typing import Optional, Any, Tuple, Dict, Union, Sequence, Callable, Iterable, List
+from typing_extensions import Literal
+
+import numpy as np
+import torch
+
+from .checkpoint import Checkpoint
+from .features.item_spec import Frame, Sample, convert
+from .networks.arm import ARM
+from .utils import default_device
+
+__all__ = [
+    "fill",
+    "parameters_at",
+    "sampling_parameters",
+    "n_generate_steps",
+    "generate_steps",
+    "load_network",
+    "generate_audio",
+]
+
+FillType = Union[Literal["blank", "data"], torch.Tensor]
+
+
+def fill(
+        x: Optional[torch.Tensor],
+        prior_t: Tuple[FillType, int],
+        n_steps: Tuple[FillType, int],
+):
+    if isinstance(x, np.ndarray):
+        x = torch.from_numpy(x)
+    if x is not None:
+        to_cat = [x]
+        dt, dev = x.dtype, x.device
+        B, D = x.size(0), x.shape[2:]
+    else:
+        to_cat = []
+        dt, dev = torch.float32, "cpu"
+        B, D = 1, (1,)
+    for fill_type, n in [prior_t, n_steps]:
+        if isinstance(fill_type, torch.Tensor):
+            assert fill_type.shape == (B,)
+            to_cat += [fill_type.expand(B, n, 1)]
+        elif fill_type == "blank":
+            to_cat += [torch.zeros(B, n, *D, dtype=dt, device=dev)]
+        elif fill_type == "data":
+            pass
+    return torch.cat(to_cat, dim=1)
+
+
+def parameters_at(params: Dict[str, Any], step: int) -> Dict[str, Any]:
+    """slice the (batch x time) schedules in `params` at `step` (their last value is held)"""
+    return {
+        k: v[:, min(step, v.size(1) - 1)] if isinstance(v, torch.Tensor) and v.ndim == 2 else v
+        for k, v in params.items()
+    }
+
+
+def sampling_parameters(network: ARM, params: Optional[Dict[str, Any]], device) -> Dict[str, Any]:
+    """
+    the sampling parameters of `network` in `params`. Arrays are moved once to the device and
+    2d arrays are (batch x time) schedules sliced by `parameters_at()`
+    """
+    params = {} if params is None else params
+    params = {k: v for k, v in params.items() if k in network.generate_params}
+    for k, v in params.items():
+        if isinstance(v, (list, tuple, np.ndarray, torch.Tensor)):
+            v = torch.as_tensor(np.asarray(v) if isinstance(v, (list, tuple)) else v, device=device)
+            params[k] = v.float() if v.is_floating_point() else v
+    return params
+
+
+def n_generate_steps(network: ARM, seconds: float) -> int:
+    """number of steps of `network` for generating `seconds` of audio"""
+    io_spec = network.config.io_spec
+    output_n_samples = int(io_spec.sr * seconds)
+    if isinstance(io_spec.unit, Frame):
+        return convert(output_n_samples, Sample(1), io_spec.unit, as_length=True) + 1
+    return output_n_samples
+
+
+def generate_steps(
+        network: ARM,
+        tensors: Tuple[torch.Tensor, ...],
+        prior_t: int,
+        n_steps: int,
+        params: Dict[str, Any],
+        progress: Optional[Callable[[Iterable[int]], Iterable[int]]] = None,
+) -> Tuple[torch.Tensor, ...]:
+    """
+    fill the `n_steps` steps after the `prior_t` prompt steps of `tensors` with the outputs of `network`.
+    `progress` can wrap the range of steps (e.g. in a progress bar).
+    """
+    rf = network.rf
+    steps = range(prior_t, prior_t + n_steps)
+    until = 0
+    for t in (steps if progress is None else progress(steps)):
+        if t < until:
+            continue
+        inputs = tuple(tensor[:, t - rf:t] for tensor in tensors)
+        outputs = network.generate_step(inputs, t=t, **parameters_at(params, t - prior_t))
+        if not isinstance(outputs, tuple):
+            outputs = outputs,
+        for tensor, out in zip(tensors, outputs):
+            # let the net return None when ignoring this step
+            if out is not None:
+                n_out = min(out.size(1), tensor.size(1) - t)
+                tensor.data[:, t:t + n_out] = out[:, :n_out]
+                until = t + n_out
+    return tensors
+
+
+def load_network(checkpoint: Union[str, Checkpoint], device: Optional[str] = None) -> ARM:
+    """the network of a checkpoint (or of the path of a .ckpt file) in eval mode on `device`"""
+    if isinstance(checkpoint, str):
+        checkpoint = Checkpoint.from_path(checkpoint)
+    return checkpoint.network.to(device or default_device()).eval()
+
+
+@torch.no_grad()
+def generate_audio(
+        network: ARM,
+        prompts: Sequence[np.ndarray],
+        seconds: float = 1.,
+        parameters: Optional[Dict[str, Any]] = None,
+        device: Optional[str] = None,
+        include_prompts: bool = True,
+) -> List[np.ndarray]:
+    """
+    continue each of the `prompts` (mono signals at the sample rate of `network`) for `seconds`
+    and return the inversed target feature of each generation.
+    Prompts are generated together in one batch, left-padded with silence to the longest one.
+    """
+    device = device or default_device()
+    network = network.to(device).eval()
+    length = max(p.shape[0] for p in prompts)
+    signal = torch.zeros(len(prompts), length)
+    for i, p in enumerate(prompts):
+        signal[i, length - p.shape[0]:] = torch.as_tensor(p, dtype=torch.float32)
+    io_spec = network.config.io_spec
+    batch = tuple(spec.transform(signal).to(device) for spec in io_spec.inputs)
+    prompt_idx = torch.arange(len(prompts))
+    network.before_generate(batch, prompt_idx)
+    prior_t, n_steps = batch[0].size(1), n_generate_steps(network, seconds)
+    tensors = tuple(fill(x, prior_t=("data", prior_t), n_steps=("blank", n_steps)) for x in batch)
+    params = sampling_parameters(network, parameters, device)
+    generate_steps(network, tensors, prior_t, n_steps, params)
+    network.after_generate(tuple(x.data for x in tensors), prompt_idx)
+    audio = io_spec.targets[0].inv(tensors[0]).detach().cpu().numpy()
+    n_samples = int(io_spec.sr * seconds)
+    outputs = []
+    for i, p in enumerate(prompts):
+        # the padding, and the prompt if not wanted, are cut away
+        start = audio.shape[1] - n_samples - (p.shape[0] if include_prompts else 0)
+        outputs += [audio[i, max(start, 0):]]
+    return outputs
+
+
+def _read_prompt(path: str, sr: int, seconds: Optional[float]) -> np.ndarray:
+    import soundfile
+
+    y, file_sr = soundfile.read(path, dtype="float32", always_2d=True)
+    y = y.mean(axis=1)
+    if file_sr != sr:
+        import soxr
+
+        y = soxr.resample(y, file_sr, sr).astype(np.float32)
+    if seconds is not None:
+        y = y[:int(seconds * sr)]
+    return y
+
+
+def main(argv: Optional[Sequence[str]] = None):
+    parser = argparse.ArgumentParser(description="generate audio files from a mimikit checkpoint")
+    parser.add_argument("checkpoint", help="path to a .ckpt file")
+    parser.add_argument("prompts", nargs="+", help="audio files to continue")
+    parser.add_argument("--prompt-sec", type=float, default=None, help="only use the beginning of the prompts")
+    parser.add_argument("--seconds", type=float, default=4.)
+    parser.add_argument("--temperature", type=float, nargs="+", default=None,
+                        help="one value for all the prompts or one per prompt")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--device", default=None)
+    parser.add_argument("--out-dir", default="./outputs")
+    parser.add_argument("--no-prompt", action="store_true", help="only write the generated samples")
+    args = parser.parse_args(argv)
+    import soundfile
+
+    network = load_network(args.checkpoint, args.device)
+    sr = network.config.io_spec.sr
+    os.makedirs(args.out_dir, exist_ok=True)
+    temperature = args.temperature
+    if temperature is not None and len(temperature) == 1:
+        temperature = temperature * len(args.prompts)
+    for start in range(0, len(args.prompts), args.batch_size):
+        paths = args.prompts[start:start + args.batch_size]
+        prompts = [_read_prompt(p, sr, args.prompt_sec) for p in paths]
+        params = None if temperature is None else dict(temperature=temperature[start:start + len(paths)])
+        outputs = generate_audio(network, prompts, args.seconds, params, args.device,
+                                 include_prompts=not args.no_prompt)
+        for path, audio in zip(paths, outputs):
+            out = os.path.join(args.out_dir, os.path.splitext(os.path.basename(path))[0] + "_mmk.wav")
+            soundfile.write(out, audio, sr)
+            print(out)
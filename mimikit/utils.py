@@ -1,12 +1,17 @@
 from enum import Enum
+import functools
 import re
+import types
+from typing import Optional
 
 __all__ = [
     "AutoStrEnum",
     "SOUND_FILE_REGEX",
     "CHECKPOINT_REGEX",
     "DATASET_REGEX",
-    "default_device"
+    "default_device",
+    "available_cpus",
+    "benchmark_import",
 ]
 
 
@@ -24,6 +29,15 @@ class AutoStrEnum(str, Enum):
         return name
 
 
+def available_cpus() -> int:
+    """number of cpus this process may run on (cpu affinity / cgroup aware when the os supports it)"""
+    import os
+
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
 def default_device():
     import torch  # don't force user to install torch...(?)
 
@@ -33,3 +47,69 @@ def default_device():
     elif torch.backends.mps.is_available():
         device = "mps"
     return device
+
+
+def benchmark_import(statement: str = "import mimikit",
+                     n_repeats: int = 3,
+                     watch=("torch", "pytorch_lightning", "IPython", "ipywidgets", "matplotlib",
+                            "numba", "pandas", "librosa", "sklearn")) -> dict:
+    """
+    run `statement` in fresh interpreters and return its best time (in seconds)
+    and which of the `watch`ed modules it imported.
+    """
+    import json
+    import subprocess
+    import sys
+
+    script = (
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        f"{statement}\n"
+        "elapsed = time.perf_counter() - start\n"
+        f"print(json.dumps(dict(seconds=elapsed, imported=[m for m in {list(watch)!r} if m in sys.modules])))\n"
+    )
+    runs = [json.loads(subprocess.check_output([sys.executable, "-c", script]).decode().splitlines()[-1])
+            for _ in range(n_repeats)]
+    return dict(seconds=min(r["seconds"] for r in runs), imported=runs[0]["imported"])
+
+
+class _LazyKernel:
+    """a numba function compiled (and cached to disk) at its first call"""
+
+    def __init__(self, func, signature, options):
+        self.func = func
+        self.signature = signature
+        self.options = options
+        self.dispatcher = None
+        functools.update_wrapper(self, func)
+
+    def compile(self):
+        if self.dispatcher is None:
+            import numba
+
+            # the kernels called by this one are compiled first and numba's prange replaces python's range
+            glb = dict(self.func.__globals__, prange=numba.prange)
+            for name in self.func.__code__.co_names:
+                if isinstance(glb.get(name), _LazyKernel):
+                    glb[name] = glb[name].compile()
+            func = types.FunctionType(self.func.__code__, glb, self.func.__name__,
+                                      self.func.__defaults__, self.func.__closure__)
+            func.__qualname__ = self.func.__qualname__
+            self.dispatcher = numba.njit(self.signature, **self.options)(func)
+        return self.dispatcher
+
+    def __call__(self, *args, **kwargs):
+        return self.compile()(*args, **kwargs)
+
+
+def lazy_njit(signature: Optional[str] = None, **options):
+    """
+    like `numba.njit(signature, cache=True, **options)` but numba is imported and the function
+    compiled at its first call instead of at import. `signature` is a string, e.g. "float32[:](float32[:], intp)".
+    In module code, `prange` must be bound to `range`.
+    """
+    options.setdefault("cache", True)
+
+    def decorator(func):
+        return _LazyKernel(func, signature, options)
+    return decorator
@@ -1,8 +1,10 @@
 import dataclasses as dtc
+import os
 
 import torch
 import torch.nn as nn
 from assertpy import assert_that
+from omegaconf import OmegaConf
 
 import mimikit as mmk
 import mimikit.networks.arm
@@ -56,3 +58,76 @@ def test_should_save_and_load_class_defined_outside_mmk(tmp_path_factory):
     loaded = ckpt.network
 
     assert_that(type(loaded)).is_equal_to(MyCustom)
+
+
+def test_writer_should_save_the_weights_of_the_submit_time(tmp_path_factory):
+    model = MyCustom.from_config(MyCustom.CustomConfig())
+    expected = {k: v.clone() for k, v in model.state_dict().items()}
+    root = str(tmp_path_factory.mktemp("ckpt"))
+    writer = mmk.CheckpointWriter()
+
+    ckpt = writer.submit(mmk.Checkpoint(id="123", epoch=1, root_dir=root), network=model)
+    with torch.no_grad():
+        for p in model.parameters():
+            p.add_(1.)
+    writer.wait()
+    loaded = ckpt.network
+
+    assert_that(sorted(os.listdir(os.path.join(root, "123")))).is_equal_to(["epoch=1.ckpt", "epoch=1.pt"])
+    for k, v in loaded.state_dict().items():
+        assert_that(torch.equal(v, expected[k])).is_true()
+
+
+def test_should_load_memory_mapped_weights_without_initializing_the_network(tmp_path_factory):
+    model = MyCustom.from_config(MyCustom.CustomConfig())
+    root = str(tmp_path_factory.mktemp("ckpt"))
+    ckpt = mmk.Checkpoint(id="123", epoch=1, root_dir=root).create(network=model)
+
+    loaded = mmk.Checkpoint(id="123", epoch=1, root_dir=root).network
+
+    assert_that(loaded.mod.weight.is_meta).is_false()
+    assert_that(torch.equal(loaded.mod.weight, model.mod.weight)).is_true()
+    assert_that(ckpt.bank).is_same_as(mmk.Checkpoint(id="123", epoch=1, root_dir=root).bank)
+
+
+def test_model_pool_should_reuse_and_evict_networks(tmp_path_factory):
+    root = str(tmp_path_factory.mktemp("ckpt"))
+    ckpts = [mmk.Checkpoint(id="123", epoch=e, root_dir=root)
+             .create(network=MyCustom.from_config(MyCustom.CustomConfig())) for e in range(3)]
+    pool = mmk.ModelPool(max_models=2)
+
+    first = pool.get(ckpts[0], "cpu")
+    pool.prefetch(ckpts[1], "cpu").result()
+    again = pool.get(mmk.Checkpoint(id="123", epoch=0, root_dir=root), "cpu")
+    pool.get(ckpts[2], "cpu")
+
+    assert_that(again).is_same_as(first)
+    assert_that(len(pool)).is_equal_to(2)
+    assert_that(pool.key(ckpts[1], "cpu") in pool).is_false()
+    assert_that(pool.key(ckpts[0], "cpu") in pool).is_true()
+
+
+def test_should_average_the_weights_of_checkpoints(tmp_path_factory):
+    root = str(tmp_path_factory.mktemp("ckpt"))
+    models = [MyCustom.from_config(MyCustom.CustomConfig()) for _ in range(3)]
+    ckpts = [mmk.Checkpoint(id="123", epoch=e, root_dir=root).create(network=m) for e, m in enumerate(models)]
+
+    averaged = ckpts[0].average(*ckpts[1:], weights=(1., 1., 2.))
+
+    expected = (models[0].mod.weight + models[1].mod.weight + 2 * models[2].mod.weight) / 4
+    assert_that(type(averaged)).is_equal_to(MyCustom)
+    assert_that(torch.allclose(averaged.mod.weight, expected)).is_true()
+
+
+def test_deserialize_should_build_the_same_configs_as_omegaconf(tmp_path_factory):
+    root = str(tmp_path_factory.mktemp("ckpt"))
+    model = MyCustom.from_config(MyCustom.CustomConfig(x=3))
+    ckpt = mmk.Checkpoint(id="123", epoch=1, root_dir=root).create(network=model)
+    raw = ckpt.bank.network.attrs["config"]
+
+    fast = mmk.Config.deserialize(raw)
+    reference = mmk.Config.object(OmegaConf.create(raw), MyCustom.CustomConfig)
+
+    assert_that(fast).is_equal_to(reference)
+    assert_that(fast.io_spec.inputs[0].extractor).is_instance_of(mmk.Extractor)
+    assert_that(mmk.benchmark_config_loading(root, n_repeats=1)).contains_key("speedup")
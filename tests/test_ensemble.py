@@ -2,6 +2,7 @@ import h5mapper as h5m
 import mimikit as mmk
 from pbind import Pseq, Pbind, Prand, Pwhite, inf
 import pytest
+import torch
 from assertpy import assert_that
 
 from .test_utils import tmp_db
@@ -81,4 +82,55 @@ def test_should_generate(tmp_db, checkpoints):
     )
     outputs = ensemble.run()
 
-    assert_that(outputs.size(1)/BASE_SR).is_equal_to(TOTAL_SECONDS)
\ No newline at end of file
+    assert_that(outputs.size(1)/BASE_SR).is_equal_to(TOTAL_SECONDS)
+
+def test_should_run_parallel_branches_and_continue_consecutive_events(tmp_db, checkpoints):
+    BASE_SR = 22050
+    db = tmp_db("ensemble-test.h5")
+    prompts = next(iter(db.serve(
+        (h5m.Input(data='signal', getter=h5m.AsSlice(shift=0, length=BASE_SR // 4)),),
+        shuffle=False, batch_size=2,
+        sampler=mmk.IndicesSampler(indices=(0, BASE_SR // 2))
+    )))[0]
+    stream = Pseq([
+        Pbind(
+            "generator", mmk.Parallel(branches=(
+                dict(generator=checkpoints["freqnet"]),
+                dict(generator=checkpoints["srnn"], temperature=.5),
+            ), weights=(1., 3.)),
+            "seconds", Pwhite(lo=.1, hi=.2, repeats=1)
+        ),
+        # two consecutive events of the same generator
+        Pbind(
+            "generator", checkpoints["srnn"],
+            "temperature", .9,
+            "seconds", Pwhite(lo=.05, hi=.1, repeats=2)
+        ),
+    ], inf).asStream()
+
+    ensemble = mmk.EnsembleGenerator(prompts, 1., BASE_SR, stream, device="cpu")
+    outputs = ensemble.run()
+
+    assert_that(outputs.shape).is_equal_to((2, BASE_SR))
+    assert_that(ensemble._session).is_none()
+
+
+def test_voting_ensemble_should_generate_the_same_when_vectorized():
+    config = mmk.WaveNet.Config(io_spec=mmk.IOSpec.mulaw_io(
+        mmk.IOSpec.MuLawIOConfig(input_module_type="embedding")
+    ), blocks=(3,), dims_dilated=(16,))
+    nets = [mmk.WaveNet.from_config(config) for _ in range(3)]
+    prompt = torch.randint(0, 256, (2, 32))
+
+    outputs = []
+    for vectorize in (True, False):
+        ensemble = mmk.VotingEnsemble(nets, weights=(1., 2., 1.), vectorize=vectorize)
+        assert_that(ensemble.vectorize).is_equal_to(vectorize)
+        loop = mmk.GenerateLoopV2(
+            mmk.GenerateLoopV2.Config(display_waveform=False, yield_inversed_outputs=False, device="cpu"),
+            network=ensemble, n_steps=16, dataloader=[[torch.arange(2), prompt]], logger=None
+        )
+        outputs += list(loop.run())
+
+    assert_that(outputs[0][0].shape).is_equal_to((2, 32 + 16))
+    assert_that(torch.equal(outputs[0][0], outputs[1][0])).is_true()
@@ -55,3 +55,84 @@ def test_should_run(tmp_db):
         assert_that(len(outputs)).is_equal_to(2)
         assert_that(outputs[0]).is_instance_of(torch.Tensor)
         assert_that(torch.all(outputs[0][:, -loop.n_steps:] != 0)).is_true()
+
+
+def test_stream_should_yield_the_same_outputs_as_run_by_blocks(tmp_db):
+    db: TestDB = tmp_db("gen-test.h5")
+    extractor = mimikit.features.extractor.Extractor("signal", mmk.FileToSignal(16000))
+    net = TestARM(
+        TestARM.Config(io_spec=mmk.IOSpec(
+            inputs=(
+                mmk.InputSpec(
+                    extractor_name=extractor.name,
+                    transform=mmk.MuLawCompress(256),
+                    module=mmk.LinearIO()
+                ).bind_to(extractor),
+            ),
+            targets=(
+                mmk.TargetSpec(
+                    extractor_name=extractor.name,
+                    transform=mmk.MuLawCompress(256),
+                    module=mmk.LinearIO(),
+                    objective=mmk.Objective("none")
+                ).bind_to(extractor),
+            )
+        ))
+    )
+    loop = mmk.GenerateLoopV2.from_config(
+        mmk.GenerateLoopV2.Config(
+            output_duration_sec=.1,
+            prompts_length_sec=.05,
+            prompts_position_sec=(0.,),
+            batch_size=1,
+            display_waveform=False,
+        ),
+        db, net
+    )
+    expected = next(loop.run())[0][:, -loop.n_steps:]
+
+    blocks = [block[0] for block in loop.stream(block_size=100)]
+
+    assert_that(len(blocks)).is_equal_to(-(-loop.n_steps // 100))
+    assert_that(all(b.size(1) == 100 for b in blocks[:-1])).is_true()
+    assert_that(torch.allclose(torch.cat(blocks, dim=1), expected)).is_true()
+
+
+def test_scheduler_should_batch_requests_of_different_lengths():
+    extractor = mimikit.features.extractor.Extractor("signal", mmk.FileToSignal(16000))
+    net = TestARM(
+        TestARM.Config(io_spec=mmk.IOSpec(
+            inputs=(
+                mmk.InputSpec(
+                    extractor_name=extractor.name,
+                    transform=mmk.MuLawCompress(256),
+                    module=mmk.LinearIO()
+                ).bind_to(extractor),
+            ),
+            targets=(
+                mmk.TargetSpec(
+                    extractor_name=extractor.name,
+                    transform=mmk.MuLawCompress(256),
+                    module=mmk.LinearIO(),
+                    objective=mmk.Objective("none")
+                ).bind_to(extractor),
+            )
+        ))
+    )
+    scheduler = mmk.GenerateScheduler(
+        mmk.GenerateScheduler.Config(batch_size=2, buffer_size=16, yield_inversed_outputs=False, device="cpu"),
+        net
+    )
+    # TestARM repeats the last step of its inputs
+    requests = {}
+    for n_prompt, n_steps, last in [(3, 5, 10), (30, 40, 20), (17, 20, 30), (8, 1, 40)]:
+        prompt = torch.randint(0, 256, (n_prompt,))
+        prompt[-1] = last
+        requests[scheduler.submit(prompt, n_steps)] = (n_steps, last)
+
+    results = dict(scheduler.run())
+
+    assert_that(sorted(results)).is_equal_to(sorted(requests))
+    for i, (n_steps, last) in requests.items():
+        assert_that(results[i][0].shape).is_equal_to((1, n_steps))
+        assert_that(torch.all(results[i][0] == last)).is_true()
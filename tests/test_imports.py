@@ -0,0 +1,18 @@
+from assertpy import assert_that
+
+import mimikit as mmk
+
+
+def test_import_should_not_load_the_training_and_notebook_stacks():
+    result = mmk.benchmark_import("import mimikit as mmk; mmk.Checkpoint; mmk.SampleRNN", n_repeats=1)
+
+    assert_that(result["imported"]).does_not_contain(
+        "pytorch_lightning", "ipywidgets", "matplotlib", "numba", "pandas"
+    )
+
+
+def test_lazy_names_should_be_those_of_the_subpackages():
+    assert_that(mmk.TrainARMLoop).is_same_as(mmk.loops.TrainARMLoop)
+    assert_that(mmk.Checkpoint).is_same_as(mmk.checkpoint.Checkpoint)
+    assert_that(dir(mmk)).contains("TrainARMLoop", "IOSpec", "loops")
+    assert_that(mmk.__all__).contains("Checkpoint", "SampleRNN")
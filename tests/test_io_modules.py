@@ -26,3 +26,25 @@ def test_vector_mix(in_dim, hidden_dim, out_dim):
     assert_that(output.size(0)).is_equal_to(input.size(0))
     assert_that(output.size(1)).is_equal_to(input.size(1))
     assert_that(output.size(2)).is_equal_to(out_dim)
+
+
+@pytest.mark.parametrize(
+    "shape",
+    [(8, 256), (8, 3, 256)]
+)
+def test_categorical_sampler_should_filter_per_row(shape):
+    under_test = mmk.CategoricalSampler(noise_chunk=4).eval()
+    logits = torch.randn(*shape)
+    temperature = torch.linspace(.5, 1.5, shape[0])
+
+    for _ in range(10):
+        greedy = under_test(logits, temperature=temperature, top_k=1)
+        nucleus = under_test(logits, temperature=1., top_p=1e-6)
+        sampled = under_test(logits, temperature=temperature, top_k=16, top_p=.9)
+
+        expected_shape = shape[:-1] if len(shape) > 2 else (shape[0], 1)
+        assert_that(tuple(greedy.shape)).is_equal_to(expected_shape)
+        assert_that(torch.equal(greedy.view(shape[:-1]), logits.argmax(-1))).is_true()
+        assert_that(torch.equal(nucleus.view(shape[:-1]), logits.argmax(-1))).is_true()
+        top16 = logits.topk(16, dim=-1).indices
+        assert_that(bool((top16 == sampled.view(*shape[:-1], 1)).any(-1).all())).is_true()
@@ -0,0 +1,27 @@
+import numpy as np
+import soundfile
+from assertpy import assert_that
+
+import mimikit as mmk
+
+
+def test_should_generate_files_without_the_training_stack(tmp_path):
+    net = mmk.SampleRNN.from_config(mmk.SampleRNN.Config(
+        io_spec=mmk.IOSpec.mulaw_io(mmk.IOSpec.MuLawIOConfig(sr=16000))
+    ))
+    ckpt = mmk.Checkpoint(id="srnn", epoch=1, root_dir=str(tmp_path / "ckpts")).create(net)
+    prompts = []
+    for i, n in enumerate((800, 1200)):
+        prompts += [str(tmp_path / f"prompt{i}.wav")]
+        soundfile.write(prompts[-1], np.random.rand(n).astype(np.float32) * 2 - 1, 16000)
+
+    mmk.runtime.main([ckpt.os_path, *prompts, "--seconds", ".05", "--temperature", ".9",
+                      "--device", "cpu", "--out-dir", str(tmp_path / "out")])
+
+    y0, sr = soundfile.read(str(tmp_path / "out" / "prompt0_mmk.wav"))
+    y1, _ = soundfile.read(str(tmp_path / "out" / "prompt1_mmk.wav"))
+    assert_that(sr).is_equal_to(16000)
+    assert_that(y0.shape).is_equal_to((800 + 800,))
+    assert_that(y1.shape).is_equal_to((1200 + 800,))
+    imported = mmk.benchmark_import("import mimikit.runtime", n_repeats=1)["imported"]
+    assert_that(imported).does_not_contain("pytorch_lightning", "matplotlib")
@@ -11,6 +11,7 @@ from .test_utils import TestDB, tmp_db
 from mimikit.networks.sample_rnn_v2 import SampleRNN
 from mimikit.checkpoint import Checkpoint
 from mimikit.io_spec import IOSpec
+from mimikit.export import export_step, validate_export, ExportedStep
 
 
 def test_should_instantiate_from_default_config():
@@ -142,4 +143,18 @@ def test_should_train(tmp_db, tmp_path):
     assert_that(content).contains("hp.yaml", "outputs", "epoch=1.ckpt")
 
     outputs = os.listdir(os.path.join(str(tmp_path), loop.hash_, "outputs"))
-    assert_that([os.path.splitext(o)[-1] for o in outputs]).contains(".mp3")
\ No newline at end of file
+    assert_that([os.path.splitext(o)[-1] for o in outputs]).contains(".mp3")
+
+@pytest.mark.parametrize("rnn_class", ["lstm", "gru"])
+def test_exported_step_should_generate_like_the_network(tmp_path, rnn_class):
+    srnn = SampleRNN.from_config(SampleRNN.Config(
+        io_spec=IOSpec.mulaw_io(IOSpec.MuLawIOConfig(sr=4000)),
+        frame_sizes=(8, 4, 2), hidden_dim=32, rnn_class=rnn_class
+    ))
+    path = export_step(srnn, str(tmp_path / "srnn.pt"), batch_size=2)
+    prompts = (torch.randint(0, 256, (2, 37)),)
+
+    report = validate_export(srnn, path, prompts, n_steps=40, temperature=.8, seed=3)
+
+    assert_that(report["equal_fraction"]).is_equal_to(1.)
+    assert_that(ExportedStep.load(path).meta["warmup"]).is_true()
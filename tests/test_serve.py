@@ -0,0 +1,49 @@
+import asyncio
+
+import numpy as np
+from assertpy import assert_that
+
+import mimikit as mmk
+
+
+def test_should_serve_concurrent_requests_in_one_batch(tmp_path):
+    root = str(tmp_path / "ckpts")
+    net = mmk.SampleRNN.from_config(mmk.SampleRNN.Config(
+        io_spec=mmk.IOSpec.mulaw_io(mmk.IOSpec.MuLawIOConfig(sr=16000))
+    ))
+    ckpt = mmk.Checkpoint(id="srnn", epoch=1, root_dir=root).create(net)
+
+    server = mmk.GenerateServer.from_config(mmk.GenerateServer.Config(
+        checkpoints=(ckpt.os_path,), port=0, batch_timeout_ms=50., block_size=256, device="cpu"
+    ))
+    batch_sizes = []
+    generate = server._generate
+
+    def spy(model, requests, loop):
+        batch_sizes.append(len(requests))
+        return generate(model, requests, loop)
+
+    server._generate = spy
+
+    async def run():
+        await server.start()
+        port = server.server.sockets[0].getsockname()[1]
+        client = mmk.GenerateClient(port=port)
+        info = await client.info()
+        prompt = np.random.rand(800).astype(np.float32) * 2 - 1
+
+        async def collect(seconds):
+            return np.concatenate([b async for b in client.generate("srnn/epoch=1", prompt, seconds, .9)])
+
+        outputs = await asyncio.gather(collect(.05), collect(.1))
+        stats = await mmk.benchmark(client, "srnn/epoch=1", prompt, .02, n_requests=2, concurrency=2)
+        await server.stop()
+        return info, outputs, stats
+
+    info, outputs, stats = asyncio.run(run())
+
+    assert_that(info).is_equal_to({"srnn/epoch=1": 16000})
+    assert_that(outputs[0].shape).is_equal_to((800,))
+    assert_that(outputs[1].shape).is_equal_to((1600,))
+    assert_that(batch_sizes[0]).is_equal_to(2)
+    assert_that(stats["samples_per_sec"]).is_greater_than(0)
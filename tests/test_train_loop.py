@@ -1,6 +1,8 @@
 import os
 
 import pytest
+import torch
+import h5mapper as h5m
 from assertpy import assert_that
 
 from .test_utils import tmp_db, TestARM
@@ -126,3 +128,337 @@ def test_should_resume_from_checkpoint(tmp_db, tmp_path, save_optimizer):
         must_contain += ["epoch=2.opt"]
     content = os.listdir(os.path.join(str(tmp_path), loop.hash_))
     assert_that(content).contains("hp.yaml", "outputs", *must_contain)
+
+
+@pytest.mark.parametrize(
+    "precision",
+    ["16-mixed", "bf16-mixed"]
+)
+def test_should_train_in_mixed_precision(tmp_db, tmp_path, precision):
+    db = tmp_db("train-loop.h5")
+    net = mmk.SampleRNN.from_config(mmk.SampleRNN.Config(
+        frame_sizes=(4, 2), hidden_dim=32,
+        io_spec=mmk.IOSpec.mulaw_io(mmk.IOSpec.MuLawIOConfig(sr=16000))
+    ))
+    config = mmk.TrainARMConfig(
+        root_dir=str(tmp_path),
+        batch_size=2,
+        batch_length=16,
+        limit_train_batches=2,
+        max_epochs=1,
+        precision=precision,
+        CHECKPOINT_TRAINING=False,
+        MONITOR_TRAINING=False,
+        OUTPUT_TRAINING=False,
+    )
+
+    loop = mmk.TrainARMLoop.from_config(
+        config, dataset=db, network=net
+    )
+    loop.run()
+
+    assert_that(loop.trainer.precision).is_equal_to(mmk.TrainARMLoop.get_precision(config))
+    assert_that(all(p.dtype == torch.float32 for p in net.parameters())).is_true()
+
+
+def test_should_autotune_the_loader(tmp_db, tmp_path):
+    db = tmp_db("train-loop.h5")
+    net = mmk.SampleRNN.from_config(mmk.SampleRNN.Config(
+        frame_sizes=(4, 2), hidden_dim=32,
+        io_spec=mmk.IOSpec.mulaw_io(mmk.IOSpec.MuLawIOConfig(sr=16000))
+    ))
+    config = mmk.TrainARMConfig(
+        root_dir=str(tmp_path),
+        batch_size=2,
+        batch_length=16,
+        limit_train_batches=2,
+        max_epochs=1,
+        autotune_loader=True,
+        CHECKPOINT_TRAINING=False,
+        MONITOR_TRAINING=False,
+        OUTPUT_TRAINING=False,
+    )
+
+    loop = mmk.TrainARMLoop.from_config(
+        config, dataset=db, network=net
+    )
+    loop.run()
+
+    with open(os.path.join(str(tmp_path), loop.hash_, "loader.yaml"), "r") as fp:
+        settings = mmk.LoaderSettings.deserialize(fp.read())
+    assert_that(settings.batches_per_sec).is_greater_than(0)
+    assert_that(loop.loader.num_workers).is_equal_to(settings.num_workers)
+
+
+def test_batched_loader_should_read_the_same_items_as_the_default_loader(tmp_db):
+    db = tmp_db("train-loop.h5")
+    batch = ((h5m.Input(data="signal", getter=h5m.AsSlice(shift=3, length=64), transform=mmk.MuLawCompress(256)),),
+             (h5m.Input(data="label", getter=h5m.AsSlice(length=8)),))
+    # close indices are read at once, far apart ones one by one
+    indices = [[0, 100, 31000], [5000, 7, 2], [40, 41, 42]]
+
+    expected = list(db.serve(batch, batch_sampler=indices))
+    given = list(mmk.serve_batched(db, batch, indices))
+
+    assert_that(len(given)).is_equal_to(len(expected))
+    for (x, y), (x_hat, y_hat) in zip(expected, given):
+        assert_that(torch.equal(x[0], x_hat[0])).is_true()
+        assert_that(torch.equal(y[0], y_hat[0])).is_true()
+
+
+def test_tbptt_schedule_should_keep_tracks_contiguous():
+    sampler = mmk.TBPTTSampler(32000, batch_size=4, chunk_length=4000, seq_len=500)
+
+    schedule = sampler.schedule()
+
+    assert_that(tuple(schedule.shape)).is_equal_to((len(sampler), 4))
+    per_track = schedule.view(-1, sampler.n_per_chunk, 4)
+    assert_that(bool((per_track.diff(dim=1) == 500).all())).is_true()
+
+
+def test_should_accumulate_micro_batches_with_one_hidden_state_each(tmp_db, tmp_path):
+    db = tmp_db("train-loop.h5")
+    net = mmk.SampleRNN.from_config(mmk.SampleRNN.Config(
+        frame_sizes=(4, 2), hidden_dim=32,
+        io_spec=mmk.IOSpec.mulaw_io(mmk.IOSpec.MuLawIOConfig(sr=16000))
+    ))
+    config = mmk.TrainARMConfig(
+        root_dir=str(tmp_path),
+        batch_size=4,
+        micro_batch_size=2,
+        batch_length=16,
+        tbptt_chunk_length=64,
+        limit_train_batches=8,
+        max_epochs=1,
+        CHECKPOINT_TRAINING=False,
+        MONITOR_TRAINING=False,
+        OUTPUT_TRAINING=False,
+    )
+
+    loop = mmk.TrainARMLoop.from_config(
+        config, dataset=db, network=net
+    )
+    loop.run()
+
+    assert_that(loop.automatic_optimization).is_false()
+    assert_that(len(loop._micro_hidden)).is_equal_to(2)
+    assert_that(loop._micro_hidden[0]["tiers.0"][0].size(1)).is_equal_to(2)
+
+
+def test_samplers_should_give_distinct_tracks_to_each_process():
+    tbptt = [mmk.TBPTTSampler(32000, batch_size=2, chunk_length=4000, seq_len=500, num_replicas=2, rank=r)
+             for r in range(2)]
+    random = [mmk.RandomBatchSampler(101, batch_size=8, num_replicas=2, rank=r) for r in range(2)]
+    for sampler in (*tbptt, *random):
+        sampler.set_epoch(3)
+
+    tracks = [s.schedule().view(-1, s.n_per_chunk, 2)[:, 0] for s in tbptt]
+    indices = [torch.cat(list(s)) for s in random]
+
+    assert_that(len(tbptt[0])).is_equal_to(len(tbptt[1])).is_equal_to(16)
+    assert_that(set(tracks[0].flatten().tolist()) & set(tracks[1].flatten().tolist())).is_empty()
+    assert_that(bool((tbptt[1].schedule().view(-1, 8, 2).diff(dim=1) == 500).all())).is_true()
+    assert_that(len(random[0])).is_equal_to(len(random[1])).is_equal_to(7)
+    assert_that(set(indices[0].tolist()) & set(indices[1].tolist())).is_empty()
+    assert_that(len(indices[0]) + len(indices[1])).is_equal_to(100)
+
+
+def test_generate_callback_should_write_outputs_from_a_background_thread(tmp_db, tmp_path):
+    db = tmp_db("train-loop.h5")
+    net = mmk.SampleRNN.from_config(mmk.SampleRNN.Config(
+        frame_sizes=(4, 2), hidden_dim=32,
+        io_spec=mmk.IOSpec.mulaw_io(mmk.IOSpec.MuLawIOConfig(sr=16000))
+    ))
+    config = mmk.TrainARMConfig(
+        root_dir=str(tmp_path),
+        batch_size=4,
+        batch_length=16,
+        limit_train_batches=4,
+        max_epochs=2,
+        every_n_epochs=1,
+        outputs_duration_sec=.01,
+        prompt_length_sec=.01,
+        n_examples=1,
+        async_generate=True,
+        CHECKPOINT_TRAINING=False,
+        MONITOR_TRAINING=False,
+        OUTPUT_TRAINING=True,
+    )
+
+    loop = mmk.TrainARMLoop.from_config(
+        config, dataset=db, network=net
+    )
+    callback = next(cb for cb in loop.callbacks if isinstance(cb, mmk.GenerateCallback))
+    loop.run()
+
+    assert_that(callback.is_running).is_false()
+    assert_that(next(net.parameters()).requires_grad).is_true()
+    outputs = os.listdir(os.path.join(str(tmp_path), loop.hash_, "outputs"))
+    assert_that([os.path.splitext(o)[-1] for o in outputs]).contains(".mp3")
+
+
+def test_should_only_keep_the_last_and_the_best_checkpoints(tmp_db, tmp_path):
+    db = tmp_db("train-loop.h5")
+    net = mmk.SampleRNN.from_config(mmk.SampleRNN.Config(
+        frame_sizes=(4, 2), hidden_dim=32,
+        io_spec=mmk.IOSpec.mulaw_io(mmk.IOSpec.MuLawIOConfig(sr=16000))
+    ))
+    config = mmk.TrainARMConfig(
+        root_dir=str(tmp_path),
+        batch_size=4,
+        batch_length=16,
+        limit_train_batches=2,
+        max_epochs=4,
+        every_n_epochs=1,
+        async_checkpoint=True,
+        keep_last_checkpoints=1,
+        keep_best_checkpoints=1,
+        CHECKPOINT_TRAINING=True,
+        MONITOR_TRAINING=False,
+        OUTPUT_TRAINING=False,
+    )
+
+    loop = mmk.TrainARMLoop.from_config(
+        config, dataset=db, network=net
+    )
+    loop.run()
+
+    content = os.listdir(os.path.join(str(tmp_path), loop.hash_))
+    checkpoints = [c for c in content if c.endswith(".ckpt")]
+    assert_that(checkpoints).contains("epoch=4.ckpt")
+    assert_that(len(checkpoints)).is_between(1, 2)
+    assert_that([c for c in content if c.endswith(".tmp")]).is_empty()
+
+
+def test_should_save_an_exponential_moving_average_of_the_weights(tmp_db, tmp_path):
+    db = tmp_db("train-loop.h5")
+    net = mmk.SampleRNN.from_config(mmk.SampleRNN.Config(
+        frame_sizes=(4, 2), hidden_dim=32,
+        io_spec=mmk.IOSpec.mulaw_io(mmk.IOSpec.MuLawIOConfig(sr=16000))
+    ))
+    config = mmk.TrainARMConfig(
+        root_dir=str(tmp_path),
+        batch_size=4,
+        batch_length=16,
+        limit_train_batches=4,
+        max_epochs=2,
+        every_n_epochs=1,
+        ema_decay=0.9,
+        CHECKPOINT_TRAINING=True,
+        MONITOR_TRAINING=False,
+        OUTPUT_TRAINING=False,
+    )
+
+    loop = mmk.TrainARMLoop.from_config(
+        config, dataset=db, network=net
+    )
+    loop.run()
+
+    ema = mmk.Checkpoint(id="ema", epoch=2, root_dir=os.path.join(str(tmp_path), loop.hash_))
+    trained = mmk.Checkpoint(id=loop.hash_, epoch=2, root_dir=str(tmp_path))
+    averaged, last = ema.network.state_dict(), trained.network.state_dict()
+    assert_that(averaged.keys()).is_equal_to(last.keys())
+    assert_that(any(not torch.equal(averaged[k], last[k]) for k in last)).is_true()
+
+
+def test_should_profile_the_training_stages(tmp_db, tmp_path):
+    db = tmp_db("train-loop.h5")
+    net = mmk.SampleRNN.from_config(mmk.SampleRNN.Config(
+        frame_sizes=(4, 2), hidden_dim=32,
+        io_spec=mmk.IOSpec.mulaw_io(mmk.IOSpec.MuLawIOConfig(sr=16000))
+    ))
+    config = mmk.TrainARMConfig(
+        root_dir=str(tmp_path),
+        batch_size=4,
+        batch_length=16,
+        limit_train_batches=6,
+        max_epochs=1,
+        profile=True,
+        profile_trace_steps=(2, 4),
+        CHECKPOINT_TRAINING=False,
+        MONITOR_TRAINING=False,
+        OUTPUT_TRAINING=False,
+    )
+
+    loop = mmk.TrainARMLoop.from_config(
+        config, dataset=db, network=net
+    )
+    loop.run()
+
+    assert_that(loop._ep_metrics).contains_key(
+        "time/data", "time/forward", "time/loss", "time/backward", "time/optimizer",
+        "samples_per_sec", "tokens_per_sec"
+    )
+    assert_that(os.path.join(str(tmp_path), loop.hash_, "trace.json")).exists()
+
+
+@pytest.mark.parametrize(
+    "split_by",
+    ["file", "time"]
+)
+def test_should_evaluate_on_a_held_out_split(tmp_db, tmp_path, split_by):
+    db = tmp_db("train-loop.h5")
+    net = mmk.SampleRNN.from_config(mmk.SampleRNN.Config(
+        frame_sizes=(4, 2), hidden_dim=32,
+        io_spec=mmk.IOSpec.mulaw_io(mmk.IOSpec.MuLawIOConfig(sr=16000))
+    ))
+    config = mmk.TrainARMConfig(
+        root_dir=str(tmp_path),
+        batch_size=4,
+        batch_length=16,
+        limit_train_batches=4,
+        max_epochs=1,
+        val_split=.5,
+        val_split_by=split_by,
+        val_every_n_steps=2,
+        limit_val_batches=2,
+        CHECKPOINT_TRAINING=False,
+        MONITOR_TRAINING=False,
+        OUTPUT_TRAINING=False,
+    )
+    train_regions, val_regions = mmk.TrainARMLoop.get_split(db, config)
+
+    loop = mmk.TrainARMLoop.from_config(
+        config, dataset=db, network=net
+    )
+    train_indices = torch.cat([torch.as_tensor(b) for b in loop.loader.sampler])
+    val_indices = torch.cat([torch.as_tensor(b) for b in loop.val_loader.sampler])
+    loop.run()
+
+    def in_regions(indices, regions):
+        return all(any(a <= i < b for a, b in regions) for i in indices.tolist())
+
+    assert_that(in_regions(train_indices, train_regions)).is_true()
+    assert_that(in_regions(val_indices, val_regions)).is_true()
+    assert_that(loop._ep_metrics).contains_key("loss", "val_loss")
+
+
+def test_should_follow_the_batch_length_schedule(tmp_db, tmp_path):
+    db = tmp_db("train-loop.h5")
+    net = mmk.SampleRNN.from_config(mmk.SampleRNN.Config(
+        frame_sizes=(4, 2), hidden_dim=32,
+        io_spec=mmk.IOSpec.mulaw_io(mmk.IOSpec.MuLawIOConfig(sr=16000))
+    ))
+    config = mmk.TrainARMConfig(
+        root_dir=str(tmp_path),
+        batch_size=4,
+        batch_length=32,
+        batch_length_schedule=((0, 8), (1, 16), (2, 32)),
+        limit_train_batches=3,
+        max_epochs=3,
+        CHECKPOINT_TRAINING=False,
+        MONITOR_TRAINING=False,
+        OUTPUT_TRAINING=False,
+    )
+    stages = [mmk.TrainARMLoop.config_at(config, epoch, 0) for epoch in range(3)]
+
+    loop = mmk.TrainARMLoop.from_config(
+        config, dataset=db, network=net
+    )
+    opt = loop.configure_optimizers()[0][0]
+    loop.run()
+
+    assert_that([(s.batch_length, s.batch_size) for s in stages]).is_equal_to([(8, 16), (16, 8), (32, 4)])
+    assert_that(loop.stage_cfg.batch_length).is_equal_to(32)
+    assert_that(loop.opt[0][0]).is_same_as(opt)
+    assert_that(loop.trainer.global_step).is_equal_to(9)
@@ -12,6 +12,7 @@ from mimikit import IOSpec, InputSpec, TargetSpec, LinearIO, Objective, \
 from mimikit.features.extractor import Extractor
 from mimikit.checkpoint import Checkpoint
 from mimikit.networks.wavenet_v2 import WNLayer, WaveNet
+from mimikit.quantization import quantization_batches, quantize_network, benchmark_quantization
 
 from .test_utils import tmp_db
 
@@ -274,3 +275,48 @@ def test_rf_should_be_correct(given_blocks):
     with pytest.raises(RuntimeError):
         y = wn((x,))[0]
 
+
+
+def test_lookahead_should_train_draft_heads_and_generate_several_steps():
+    given_config = WaveNet.Config(io_spec=IOSpec.mulaw_io(
+        IOSpec.MuLawIOConfig(input_module_type="embedding")
+    ), lookahead=3)
+    q_levels = given_config.io_spec.inputs[0].elem_type.size
+    wn = WaveNet.from_config(given_config)
+
+    x = torch.randint(0, q_levels, (2, 32))
+    outputs = wn((x,))
+    target = torch.randint(0, q_levels, (2, outputs[0].size(1) + 2))
+    loss = wn.loss_fn(outputs, (target,))
+
+    assert_that(len(outputs)).is_equal_to(3)
+    assert_that(loss).contains_key("loss", "head1_categorical_dist", "head2_categorical_dist")
+
+    wn.eval()
+    given_prompt = torch.randint(0, q_levels, (2, 64))
+    with torch.no_grad():
+        wn.before_generate((given_prompt,), batch_index=0)
+        first = wn.generate_step((given_prompt[:, -wn.rf:],), t=64, temperature=1., tolerance=0.)
+        given_prompt = torch.cat((given_prompt, first[0]), dim=1)
+        # tolerance=0 accepts all the drafts
+        second = wn.generate_step((given_prompt[:, -wn.rf:],), t=65, temperature=1., tolerance=0.)
+        wn.after_generate(second, batch_index=0)
+
+    assert_that(tuple(first[0].shape)).is_equal_to((2, 1))
+    assert_that(tuple(second[0].shape)).is_equal_to((2, 3))
+
+
+def test_quantized_network_should_generate_and_report_its_quality(tmp_db):
+    given_config = WaveNet.Config(io_spec=IOSpec.mulaw_io(
+        IOSpec.MuLawIOConfig(input_module_type="embedding")
+    ), blocks=(3,), dims_dilated=(32,), skips_dim=32)
+    wn = WaveNet.from_config(given_config)
+    db = tmp_db("quantize.h5")
+    batches = quantization_batches(wn, db, n_batches=2, batch_size=2)
+
+    quantized = quantize_network(wn, (inputs for inputs, _ in batches))
+    report = benchmark_quantization(wn, quantized, batches, n_steps=8)
+
+    assert_that(quantized.layers[0].conv_skip).is_not_instance_of(torch.nn.Conv1d)
+    assert_that(report).contains_key("speedup", "float_loss", "quantized_loss", "quantized_mb")
+    assert_that(report["quantized_mb"]).is_less_than(report["float_mb"])